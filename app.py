@@ -4,19 +4,59 @@ import sys
 
 from flask import (
     Flask,
+    g,
     request,
     abort,
     jsonify,
     flash,
-    render_template
+    render_template,
+    Response,
+    stream_with_context
 )
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_cors import CORS
 from flask_moment import Moment
+from sqlalchemy import func, text
+from sqlalchemy.orm import joinedload, selectinload
 
-from models import setup_db, Trademark, Spec
+from models import setup_db, Trademark, Spec, RowCount, Change
 from auth import AuthError, requires_auth
+from pagination import (
+    page_query,
+    paginate_query,
+    count_results,
+    clear_count_cache,
+    get_cursor,
+    CHANGES_PER_PAGE,
+    MAX_CHANGES_PER_PAGE,
+    NUM_RESULTS_PER_PAGE
+)
+from pool import pool_stats
+from instrumentation import setup_instrumentation
+from replicas import read_only, remember_write
+from search import get_search_backend
+from filters import get_filters, get_sort, DEFAULT_SORT
+from bulk import get_batch, validate_record, SPEC_FIELDS, TRADEMARK_FIELDS
+from cache import create_response_cache
+from export import (
+    export_lines,
+    gzip_chunks,
+    merge_children,
+    EXPORT_FETCH_SIZE,
+    EXPORT_FORMATS
+)
+from conditional import conditional, make_etag
+from serializers import (
+    get_json_backend,
+    json_response,
+    row_formatter,
+    select_fields,
+    JSON_BACKEND,
+    SPEC_COLUMNS,
+    TRADEMARK_COLUMNS,
+    TRADEMARK_LONG_COLUMNS
+)
 
 """
 App Config
@@ -26,9 +66,26 @@ App Config
 def create_app(test_config=None):
     """Create and configure the app."""
     app = Flask(__name__)
+    if test_config is not None:
+        app.config.update(test_config)
     moment = Moment(app)
     db = setup_db(app)
     migrate = Migrate(app, db)
+    search = get_search_backend(db.engine.dialect.name)
+
+    def data_version():
+        # The seq of the last change, read alike by every worker process
+        if 'data_version' not in g:
+            g.data_version = Change.last_seq()
+        return g.data_version
+
+    response_cache = create_response_cache(app.config, data_version)
+    app.extensions['response_cache'] = response_cache
+    # Read at call time, as instrumentation replaces it with a timed one
+    app.extensions['json_backend'] = get_json_backend(
+        app.config.get('JSON_BACKEND', JSON_BACKEND))
+    # Opt-in profiling of requests, see GET /metrics
+    instrumentation = setup_instrumentation(app)
 
     # Set up CORS that allows any origins for the api resources
     cors = CORS(app, resources={r"/api/*": {"origin": "*"}})
@@ -45,53 +102,300 @@ def create_app(test_config=None):
         return response
 
     '''
-    Results Pagination
+    Response Cache
+    Read endpoints are decorated with @response_cache.cached. The data
+    version of the cache keys, and of the cached totals of search results,
+    is the seq of the last change in the database, so that every write,
+    whichever worker or process handled it, e.g. manage.py import_register,
+    keeps the responses and totals cached before it from being served again.
+    Any successful write also drops the cached totals of its worker. With
+    read replicas, the client of the write also reads from the primary for
+    a while, see replicas.read_only.
+    '''
+    @app.after_request
+    def invalidate_cached_responses(response):
+        if (request.method in ('POST', 'PATCH', 'PUT', 'DELETE') and
+                request.endpoint not in response_cache.endpoints and
+                response.status_code < 400):
+            clear_count_cache()
+            if app.config['REPLICA_BINDS']:
+                remember_write(response)
+        return response
+
+    '''
+    Mutation Responses
+    Writes respond with the affected entity and the total only; ?full=true
+    also returns the current page of the table, as it did originally.
+    '''
+    def wants_full_response(request):
+        return request.args.get('full', 'false').lower() == 'true'
+
+    '''
+    Projections
+    The list and search endpoints select the columns of the short format by
+    default, or those named in the fields argument, as tuples.
+    '''
+    def get_projection(available, default, key_column):
+        try:
+            return select_fields(request.args.get('fields'), available,
+                                 default, key_column)
+        except ValueError:
+            abort(400)
+
+    '''
+    Trademark Details
+    The specifications of trademarks are loaded along with them, with only
+    the class number and specification columns, instead of lazily one
+    trademark at a time.
     '''
-    def paginate_results(request, results, num_results_per_page=100):
-        page = request.args.get('page', 1, type=int)
-        start = (page - 1) * num_results_per_page
-        end = start + num_results_per_page
+    def load_specs(loader):
+        return loader(Trademark.specs).load_only(Spec.class_no,
+                                                 Spec.class_spec)
 
-        results_lists = [result.format() for result in results]
-        current_results = results_lists[start:end]
+    def get_trademarks_details(app_nos):
+        """Handle GET requests for the details of many trademarks.
 
-        return current_results
+        The trademarks and their specifications are fetched in two queries,
+        whatever the number of application numbers requested.
+        """
+        if not 0 < len(app_nos) <= NUM_RESULTS_PER_PAGE:
+            abort(422)
+
+        try:
+            trademarks = Trademark.query.options(
+                load_specs(selectinload)
+            ).filter(
+                Trademark.app_no.in_(app_nos)
+            ).order_by(Trademark.app_no).all()
+            if len(trademarks) == 0:
+                abort(404)
+            found = {trademark.app_no for trademark in trademarks}
+            return json_response({
+                'success': True,
+                'trademarks': [trademark.details()
+                               for trademark in trademarks],
+                'total_trademarks': len(trademarks),
+                'not_found': [app_no for app_no in app_nos
+                              if app_no not in found]
+            })
+        except Exception:
+            abort(404)
+            print(sys.exc_info())
+
+    '''
+    Validators
+    Entity tags and Last-Modified times are derived from the updated_at row
+    versions with aggregate queries, without loading the trademarks, so that
+    conditional requests are answered with a 304 before the views are
+    reached. They only run when the response cache misses: cached responses
+    keep their validators, which answer the conditional requests of hits.
+    Pages of the list have no Last-Modified time: a deleted row brings an
+    older one onto the page, which the entity tag tells but the latest row
+    version does not. A trademark's is advanced when one of its
+    specifications is deleted or moved, see models.
+    '''
+    def count_trademarks(*criteria):
+        # The same query whatever the projection, sort or caller, e.g. the
+        # validators and the view, so that they share the cached total
+        return count_results(
+            db.session.query(Trademark.app_no).filter(*criteria),
+            version=data_version())
+
+    def trademark_list_validators():
+        if 'app_no' in request.args:
+            return None
+        try:
+            after = get_cursor(request, Trademark.app_no)
+            sort, order_by = get_sort(request)
+            filters, applied = get_filters(request.args, search)
+        except ValueError:
+            return None
+        if after is not None and sort != DEFAULT_SORT:
+            return None
+
+        trademarks = Trademark.query.filter(*filters).order_by(*order_by)
+        query = page_query(request, trademarks, Trademark.app_no, after)
+        if query is None:
+            return None
+        page = query.subquery()
+        rows, first, last, updated_at = db.session.query(
+            func.count(), func.min(page.c.app_no), func.max(page.c.app_no),
+            func.max(page.c.updated_at)).one()
+        if filters:
+            total = count_trademarks(*filters)
+        else:
+            total = RowCount.get(Trademark.__tablename__, count_trademarks)
+        return (make_etag('trademarks', request.args.get('fields'), sort,
+                          applied, rows, first, last, updated_at, total),
+                None)
+
+    def trademark_validators(app_no):
+        version = db.session.query(
+            Trademark.updated_at, func.max(Spec.updated_at),
+            func.count(Spec.id)
+        ).outerjoin(Trademark.specs).filter(
+            Trademark.app_no == app_no
+        ).group_by(Trademark.app_no, Trademark.updated_at).one_or_none()
+        if version is None:
+            return None
+        updated_at, specs_updated_at, specs = version
+        last_modified = max(filter(None, (updated_at, specs_updated_at)))
+        return (make_etag('trademark', app_no, updated_at, specs_updated_at,
+                          specs), last_modified)
+
+    '''
+    Exports
+    Rows are read through a server-side cursor, EXPORT_FETCH_SIZE at a time,
+    and written to the response as they come, so that memory use does not
+    grow with the size of the tables.
+    '''
+    def stream_export(name, records, fieldnames):
+        file_format = request.args.get('format', 'ndjson')
+        if file_format not in EXPORT_FORMATS:
+            abort(400)
+
+        chunks = export_lines(records, fieldnames, file_format,
+                              dumps=app.extensions['json_backend'].dumps)
+        headers = {
+            'Content-Disposition': 'attachment; filename={}.{}'.format(
+                name, file_format),
+            'Vary': 'Accept-Encoding'
+        }
+        if request.accept_encodings['gzip']:
+            chunks = gzip_chunks(chunks)
+            headers['Content-Encoding'] = 'gzip'
+        return Response(stream_with_context(chunks),
+                        mimetype=EXPORT_FORMATS[file_format],
+                        headers=headers)
 
     '''
     Controllers
     '''
     @app.route('/trademarks', methods=['GET'])
+    @read_only
+    @response_cache.cached
+    @conditional(trademark_list_validators)
     def get_trademarks():
         """Handle GET requests for all available trademarks.
         ---
         get:
             description: Get paginated trademarks info and its total number.
+            parameters:
+                - name: page
+                  type: integer
+                  required: false
+                - name: cursor
+                  type: string
+                  required: false
+                  description: next_cursor of the previous page; seeks on
+                      app_no instead of counting past earlier pages.
+                - name: after
+                  type: string
+                  required: false
+                  description: return trademarks whose app_no sorts after it.
+                - name: status
+                  type: string
+                  required: false
+                  description: comma-separated statuses, e.g. Registered.
+                - name: type
+                  type: string
+                  required: false
+                  description: comma-separated types, e.g. Word.
+                - name: class_no
+                  type: string
+                  required: false
+                  description: comma-separated Nice classes, return the
+                      trademarks with a specification in any of them.
+                - name: owner
+                  type: string
+                  required: false
+                  description: return trademarks whose owners contain it,
+                      case-insensitively.
+                - name: sort
+                  type: string
+                  required: false
+                  description: app_no (default), -app_no, name or -name;
+                      only app_no can be combined with a cursor.
+                - name: app_no
+                  type: string
+                  required: false
+                  description: comma-separated application numbers, up to
+                      100, to get the details of these trademarks instead.
+                - name: fields
+                  type: string
+                  required: false
+                  description: comma-separated fields of the long format to
+                      return instead of app_no, name, status and owners;
+                      app_no is always returned.
             responses:
                 200:
                     description: a list of paginaged trademarks and the total
                         number of trademarks in the database.
                     trademarks: a list of trademarks objects with app_no, name,
                         status and owners.
-                    total_trademarks: total number of trademarks.
+                    total_trademarks: total number of trademarks, or of the
+                        trademarks matching the filters.
+                    next_cursor: cursor of the next page, or null on the last
+                        page or when sorting by another key than app_no.
+                    not_found: with app_no, the requested application
+                        numbers that do not exist.
+                304:
+                    description: the page is unchanged since the ETag given
+                        in If-None-Match.
+                400:
+                    description: cursor cannot be decoded, or is combined
+                        with another sort than app_no, or fields, filters or
+                        sort are invalid.
                 404:
                     description: trademarks not found.
+                422:
+                    description: too many application numbers requested.
         """
+        if 'app_no' in request.args:
+            app_nos = request.args.get('app_no').split(',')
+            return get_trademarks_details(
+                list(dict.fromkeys(app_no for app_no in app_nos if app_no)))
+
+        try:
+            after = get_cursor(request, Trademark.app_no)
+            sort, order_by = get_sort(request)
+            filters, _ = get_filters(request.args, search)
+        except ValueError:
+            abort(400)
+        seek = sort == DEFAULT_SORT
+        if after is not None and not seek:
+            abort(400)
+        columns = get_projection(TRADEMARK_LONG_COLUMNS, TRADEMARK_COLUMNS,
+                                 Trademark.app_no)
+
         try:
-            trademarks = Trademark.query.order_by(Trademark.app_no).all()
-            current_trademarks = paginate_results(request, trademarks)
+            trademarks = db.session.query(*columns).filter(
+                *filters).order_by(*order_by)
+            current_trademarks, next_cursor = paginate_query(
+                request, trademarks, Trademark.app_no if seek else None,
+                after, format_rows=row_formatter(columns))
             # Output 404 error if no more records in the current page
-            if len(current_trademarks) == 0:
+            if len(current_trademarks) == 0 and after is None:
                 abort(404)
-            return jsonify({
+            if filters:
+                total = count_trademarks(*filters)
+            else:
+                total = RowCount.get(Trademark.__tablename__,
+                                     count_trademarks)
+            return json_response({
                 'success': True,
                 'trademarks': current_trademarks,
-                'total_trademarks': len(trademarks)
-            }), 200
+                'total_trademarks': total,
+                'next_cursor': next_cursor
+            })
         except Exception:
             abort(404)
             print(sys.exc_info())
 
     @app.route('/trademarks/<string:app_no>', methods=['GET'])
+    @read_only
+    @response_cache.cached
+    @conditional(trademark_validators)
     def get_trademark_class_details(app_no):
         """Handle Get requests for trademark details given application number.
         ---
@@ -102,29 +406,30 @@ def create_app(test_config=None):
                     description: a trademark object to be returned.
                     trademark: a trademark object with more detailed info in
                         long format.
+                304:
+                    description: the trademark and its specifications are
+                        unchanged since the ETag given in If-None-Match or the
+                        If-Modified-Since date.
                 404:
                     description: trademark not found.
         """
         try:
-            trademark = Trademark.query.get(app_no)
-            return jsonify({
+            trademark = Trademark.query.options(
+                load_specs(joinedload)
+            ).filter(Trademark.app_no == app_no).one_or_none()
+            if trademark is None:
+                abort(404)
+            return json_response({
                 'success': True,
-                'app_no': app_no,
-                'name': trademark.name,
-                'status': trademark.status,
-                'owners': trademark.owners,
-                'applicant': trademark.applicant,
-                'type': trademark.type,
-                'id': trademark.trademark_id,
-                'class_numbers_and_specifications': {
-                    spec.class_no: spec.class_spec for spec in trademark.specs
-                }
-            }), 200
+                **trademark.details()
+            })
         except Exception:
             abort(404)
             print(sys.exc_info())
 
     @app.route('/trademarks/search', methods=['POST'])
+    @read_only
+    @response_cache.cached
     def search_trademarks():
         """Handle search on trademarks using POST endpoint.
         ---
@@ -134,6 +439,22 @@ def create_app(test_config=None):
                 - name: searchTerm
                   type: string
                   required: true
+                - name: sort
+                  type: string
+                  required: false
+                  description: "relevance" ranks the closest matches first,
+                      or app_no (default), -app_no, name or -name; only
+                      app_no can be combined with a cursor.
+                - name: status, type, class_no, owner
+                  type: string
+                  required: false
+                  description: filters, as for GET /trademarks.
+                - name: fields
+                  type: string
+                  required: false
+                  description: comma-separated fields of the long format to
+                      return instead of app_no, name, status and owners;
+                      app_no is always returned.
             responses:
                 200:
                     description: a list of paginated trademarks whose names
@@ -141,6 +462,12 @@ def create_app(test_config=None):
                     trademarks: a list of trademarks objects with app_no, name,
                         status and owners.
                     total_trademarks: total number of the relevant trademarks.
+                    next_cursor: cursor of the next page, or null on the last
+                        page.
+                400:
+                    description: cursor cannot be decoded, or is combined
+                        with another sort than app_no, or fields, filters or
+                        sort are invalid.
                 404:
                     description: relevant trademarks not found.
                 422:
@@ -150,22 +477,45 @@ def create_app(test_config=None):
         search_term = req.get('searchTerm')
         if search_term is None or search_term == '':
             abort(422)
+        ranked = request.args.get('sort') == 'relevance'
+        try:
+            after = get_cursor(request, Trademark.app_no)
+            if ranked:
+                sort, order_by = 'relevance', (
+                    *search.ranking(Trademark.name, search_term),
+                    Trademark.app_no)
+            else:
+                sort, order_by = get_sort(request)
+            filters, _ = get_filters(request.args, search)
+        except ValueError:
+            abort(400)
+        seek = sort == DEFAULT_SORT
+        if after is not None and not seek:
+            abort(400)
+        columns = get_projection(TRADEMARK_LONG_COLUMNS, TRADEMARK_COLUMNS,
+                                 Trademark.app_no)
 
         # Case-insensitive search term
         try:
-            results = Trademark.query.filter(Trademark.name.ilike(
-                "%" + search_term + "%")).all()
-            current_results = paginate_results(request, results)
-            return jsonify({
+            criteria = (search.match(Trademark.name, search_term), *filters)
+            results = db.session.query(*columns).filter(
+                *criteria).order_by(*order_by)
+            current_results, next_cursor = paginate_query(
+                request, results, Trademark.app_no if seek else None,
+                after, format_rows=row_formatter(columns))
+            return json_response({
                 'success': True,
                 'trademarks': current_results,
-                'total_trademarks': len(results)
-            }), 200
+                'total_trademarks': count_trademarks(*criteria),
+                'next_cursor': next_cursor
+            })
         except Exception:
             abort(404)
             print(sys.exc_info())
 
     @app.route('/trademark_specs/search', methods=['POST'])
+    @read_only
+    @response_cache.cached
     def search_trademark_specs():
         """Handle search on trademark specifications using POST endpoint.
         ---
@@ -175,6 +525,16 @@ def create_app(test_config=None):
                 - name: searchTerm
                   type: string
                   required: true
+                - name: sort
+                  type: string
+                  required: false
+                  description: "relevance" ranks the closest matches first;
+                      cannot be combined with a cursor.
+                - name: fields
+                  type: string
+                  required: false
+                  description: comma-separated fields among id, class_no,
+                      class_spec and tm_app_no; id is always returned.
             responses:
                 200:
                     description: a list of paginated trademarks specifcations
@@ -184,6 +544,11 @@ def create_app(test_config=None):
                         class_spec, and tm_app_no.
                     total_specs: total number of the relevant
                         specifications.
+                    next_cursor: cursor of the next page, or null on the last
+                        page.
+                400:
+                    description: cursor cannot be decoded, or is combined
+                        with relevance sorting, or fields are unknown.
                 404:
                     description: relevant specifications not found.
                 422:
@@ -193,21 +558,237 @@ def create_app(test_config=None):
         search_term = req.get('searchTerm')
         if search_term is None or search_term == '':
             abort(422)
+        ranked = request.args.get('sort') == 'relevance'
+        try:
+            after = get_cursor(request, Spec.id)
+        except ValueError:
+            abort(400)
+        if ranked and after is not None:
+            abort(400)
+        columns = get_projection(SPEC_COLUMNS, SPEC_COLUMNS, Spec.id)
 
         # Case-insensitive search term
         try:
-            results = Spec.query.filter(Spec.class_spec.ilike(
-                "%" + search_term + "%")).all()
-            current_results = paginate_results(request, results)
-            return jsonify({
+            results = db.session.query(*columns).filter(
+                search.match(Spec.class_spec, search_term))
+            if ranked:
+                results = results.order_by(
+                    *search.ranking(Spec.class_spec, search_term), Spec.id)
+            else:
+                results = results.order_by(Spec.id)
+            current_results, next_cursor = paginate_query(
+                request, results, None if ranked else Spec.id, after,
+                format_rows=row_formatter(columns))
+            return json_response({
                 'success': True,
                 'specs': current_results,
-                'total_specs': len(results)
-            }), 200
+                'total_specs': count_results(
+                    db.session.query(Spec.id).filter(
+                        search.match(Spec.class_spec, search_term)),
+                    version=data_version()),
+                'next_cursor': next_cursor
+            })
         except Exception:
             abort(404)
             print(sys.exc_info())
 
+    @app.route('/health', methods=['GET'])
+    def health():
+        """Handle GET requests for the health of the app.
+        ---
+        get:
+            description: Check the database connection and report the state
+                of the connection pool of this worker process.
+            responses:
+                200:
+                    description: the database answered.
+                    database: ok.
+                    pool: class of the pool, its size, the connections
+                        checked out and in overflow, and the checkouts,
+                        overflow checkouts, timeouts and seconds waited for
+                        a connection since the process started.
+                503:
+                    description: the database cannot be reached.
+        """
+        try:
+            db.session.execute(text('SELECT 1'))
+            database, status = 'ok', 200
+        except Exception:
+            db.session.rollback()
+            database, status = 'unavailable', 503
+            print(sys.exc_info())
+        return json_response({
+            'success': status == 200,
+            'database': database,
+            'pool': pool_stats(db.engine)
+        }, status)
+
+    if instrumentation is not None:
+        @app.route('/metrics', methods=['GET'])
+        def metrics():
+            """Handle GET requests for the metrics of the app.
+            ---
+            get:
+                description: Get the metrics of this worker process in the
+                    Prometheus text format, with INSTRUMENTATION enabled.
+                responses:
+                    200:
+                        description: requests, latency histogram, SQL
+                            statements and time, JSON encoding time, N+1
+                            queries and swallowed errors by endpoint, and the
+                            connection pools of the primary and replicas.
+            """
+            pools = {'primary': pool_stats(db.engine)}
+            for bind in app.config['REPLICA_BINDS']:
+                pools[bind] = pool_stats(db.get_engine(app, bind=bind))
+            return Response(instrumentation.metrics.render(pools),
+                            mimetype='text/plain; version=0.0.4')
+
+    @app.route('/changes', methods=['GET'])
+    def get_changes():
+        """Handle GET requests for the changes made after a sequence number.
+        ---
+        get:
+            description: Stream the inserts, updates and deletes of
+                trademarks and specifications in the order of their commits.
+            parameters:
+                - name: since
+                  type: integer
+                  required: false
+                  description: seq of the last change already applied,
+                      0 by default.
+                - name: limit
+                  type: integer
+                  required: false
+                  description: number of changes, 1000 by default and
+                      10000 at most.
+            responses:
+                200:
+                    description: a page of changes, streamed.
+                    changes: a list of change objects with seq, table, key,
+                        operation (insert, update, upsert or delete) and
+                        changed_at.
+                    next_since: since of the next request.
+                    has_more: whether more changes follow this page.
+                    last_seq: seq of the latest change when the request
+                        started.
+                400:
+                    description: since or limit is invalid.
+        """
+        since = request.args.get('since', 0, type=int)
+        limit = request.args.get('limit', CHANGES_PER_PAGE, type=int)
+        if since < 0 or not 0 < limit <= MAX_CHANGES_PER_PAGE:
+            abort(400)
+
+        last_seq = Change.last_seq()
+        changes = Change.query.filter(
+            Change.seq > since,
+            Change.seq <= last_seq
+        ).order_by(Change.seq).limit(limit + 1)
+        dumps = app.extensions['json_backend'].dumps
+
+        def generate():
+            yield b'{"success":true,"changes":['
+            next_since = since
+            has_more = False
+            for index, change in enumerate(changes.yield_per(500)):
+                if index == limit:
+                    has_more = True
+                    break
+                yield (b',' if index else b'') + dumps(change.format())
+                next_since = change.seq
+            yield '],"next_since":{},"has_more":{},"last_seq":{}}}'.format(
+                next_since, 'true' if has_more else 'false',
+                last_seq).encode()
+
+        return Response(stream_with_context(generate()),
+                        mimetype='application/json')
+
+    @app.route('/export/trademarks', methods=['GET'])
+    @read_only
+    def export_trademarks():
+        """Handle GET requests for exporting all the trademarks.
+        ---
+        get:
+            description: Stream all the trademarks ordered by app_no, gzip
+                compressed if the client accepts it.
+            parameters:
+                - name: format
+                  type: string
+                  required: false
+                  description: ndjson (default) or csv.
+                - name: include
+                  type: string
+                  required: false
+                  description: specs, to include the specifications of each
+                      trademark.
+            responses:
+                200:
+                    description: one trademark per line in long format, with
+                        a list of specifications objects with id, class_no
+                        and class_spec under specs if included, encoded as
+                        JSON in CSV.
+                400:
+                    description: unknown format or include.
+        """
+        include = request.args.get('include')
+        if include not in (None, 'specs'):
+            abort(400)
+
+        fieldnames = [column.key for column in TRADEMARK_LONG_COLUMNS]
+        trademarks = db.session.query(*TRADEMARK_LONG_COLUMNS).order_by(
+            Trademark.app_no).yield_per(EXPORT_FETCH_SIZE)
+        if include is None:
+            return stream_export('trademarks', (
+                trademark._asdict() for trademark in trademarks), fieldnames)
+
+        # The join leaves out specifications without a trademark
+        specs = db.session.query(
+            Spec.tm_app_no, Spec.id, Spec.class_no, Spec.class_spec
+        ).join(Spec.trademark).order_by(
+            Spec.tm_app_no, Spec.id).yield_per(EXPORT_FETCH_SIZE)
+        as_csv = request.args.get('format') == 'csv'
+
+        def records():
+            for trademark, children in merge_children(
+                    trademarks, specs, lambda trademark: trademark.app_no,
+                    lambda spec: spec.tm_app_no):
+                record = trademark._asdict()
+                record['specs'] = [{'id': spec.id,
+                                    'class_no': spec.class_no,
+                                    'class_spec': spec.class_spec}
+                                   for spec in children]
+                if as_csv:
+                    record['specs'] = json.dumps(record['specs'])
+                yield record
+
+        return stream_export('trademarks', records(), fieldnames + ['specs'])
+
+    @app.route('/export/specs', methods=['GET'])
+    @read_only
+    def export_specs():
+        """Handle GET requests for exporting all the specifications.
+        ---
+        get:
+            description: Stream all the specifications ordered by id, gzip
+                compressed if the client accepts it.
+            parameters:
+                - name: format
+                  type: string
+                  required: false
+                  description: ndjson (default) or csv.
+            responses:
+                200:
+                    description: one specification per line with id,
+                        class_no, class_spec and tm_app_no.
+                400:
+                    description: unknown format.
+        """
+        specs = db.session.query(*SPEC_COLUMNS).order_by(
+            Spec.id).yield_per(EXPORT_FETCH_SIZE)
+        return stream_export('specs', (spec._asdict() for spec in specs),
+                             [column.key for column in SPEC_COLUMNS])
+
     @app.route('/trademarks/<string:app_no>', methods=['PATCH'])
     @requires_auth('patch:trademark')
     def update_trademark(payload, app_no):
@@ -354,13 +935,19 @@ def create_app(test_config=None):
                 - name: trademark_id
                   type: string
                   required: false
+                - name: full
+                  type: boolean
+                  required: false
+                  description: also return the current page of the table.
             responses:
                 200:
                     description: inserted a trademark record.
                     added_trademark_app_no: the inserted trademark application
                         number.
-                    trademarks: a list of trademarks objects with app_no, name,
-                        status and owners.
+                    trademark: the inserted trademark object with app_no,
+                        name, status and owners.
+                    trademarks: with full=true, a list of trademarks objects
+                        with app_no, name, status and owners.
                     total_trademarks: total number of trademarks.
                 422:
                     description: insertion cannot be processed.
@@ -385,14 +972,17 @@ def create_app(test_config=None):
                                   type=tm_type,
                                   trademark_id=trademark_id)
             trademark.insert()
-            trademarks = Trademark.query.order_by(Trademark.app_no).all()
-            current_trademarks = paginate_results(request, trademarks)
-            return jsonify({
+            response = {
                 'success': True,
                 'added_trademark_app_no': app_no,
-                'trademarks': current_trademarks,
-                'total_trademarks': len(trademarks)
-            }), 200
+                'trademark': trademark.format(),
+                'total_trademarks': RowCount.get(Trademark.__tablename__)
+            }
+            if wants_full_response(request):
+                response['trademarks'], _ = paginate_query(
+                    request, Trademark.query.order_by(Trademark.app_no),
+                    Trademark.app_no)
+            return jsonify(response), 200
         except Exception:
             abort(422)
             print(sys.exc_info())
@@ -416,15 +1006,19 @@ def create_app(test_config=None):
                 - name: tm_app_no
                   type: string
                   required: true
+                - name: full
+                  type: boolean
+                  required: false
+                  description: also return the current page of the table.
             responses:
                 200:
                     description: inserted a trademark specification record.
                     added_spec_class_no: the inserted trademark specification
                         class number.
-                    specs: a list of specification objects with id, class_no,
-                        class_spec, and tm_app_no.
-                    updated_spec: a specifcation object with id, class_no,
+                    spec: the inserted specifcation object with id, class_no,
                         class_spec, and tm_app_no.
+                    specs: with full=true, a list of specification objects
+                        with id, class_no, class_spec, and tm_app_no.
                     total_specs: total number of the specifications.
                 422:
                     description: insertion cannot be processed.
@@ -441,19 +1035,246 @@ def create_app(test_config=None):
                         class_spec=class_spec,
                         tm_app_no=tm_app_no)
             spec.insert()
-            specs = Spec.query.order_by(Spec.id).all()
-            current_specs = paginate_results(request, specs)
-            return jsonify({
+            response = {
                 'success': True,
                 'added_spec_class_no': class_no,
-                'specs': current_specs,
-                'total_specs': len(specs)
+                'spec': spec.format(),
+                'total_specs': RowCount.get(Spec.__tablename__)
+            }
+            if wants_full_response(request):
+                response['specs'], _ = paginate_query(
+                    request, Spec.query.order_by(Spec.id), Spec.id)
+            return jsonify(response), 200
+        except Exception:
+            abort(422)
+            print(sys.exc_info())
+
+    @app.route('/trademarks/batch', methods=['POST'])
+    @requires_auth('post:trademark')
+    def add_trademarks_batch(payload):
+        """Handle POST requests for inserting many trademark records.
+        ---
+        post:
+            description: Insert the valid trademark records of a batch in
+                one transaction.
+            security:
+                - payload: decoded payload.
+            parameters:
+                - name: trademarks
+                  type: array
+                  required: true
+                  description: up to MAX_BATCH_SIZE trademark objects with
+                      the fields of POST /trademarks.
+            responses:
+                200:
+                    description: inserted the valid trademark records.
+                    results: a list of objects with the index of each record,
+                        its app_no, its status (created, invalid or conflict)
+                        and an error for records that were not inserted.
+                    created: number of inserted trademarks.
+                    total_trademarks: total number of trademarks.
+                422:
+                    description: the batch is malformed, too large or cannot
+                        be processed.
+        """
+        records = get_batch(request.get_json(), 'trademarks')
+        if records is None:
+            abort(422)
+
+        try:
+            validated = [validate_record(record, TRADEMARK_FIELDS)
+                         for record in records]
+            app_nos = [row['app_no'] for row, error in validated if row]
+            existing = {app_no for app_no, in db.session.query(
+                Trademark.app_no).filter(Trademark.app_no.in_(app_nos))}
+
+            results = []
+            rows = []
+            for index, (row, error) in enumerate(validated):
+                result = {'index': index, 'app_no': row and row['app_no']}
+                if error:
+                    result.update(status='invalid', error=error)
+                elif row['app_no'] in existing:
+                    result.update(status='conflict',
+                                  error='trademark already exists')
+                else:
+                    existing.add(row['app_no'])
+                    rows.append(row)
+                    result['status'] = 'created'
+                results.append(result)
+
+            Change.lock()
+            db.session.bulk_insert_mappings(Trademark, rows)
+            RowCount.adjust(Trademark.__tablename__, len(rows))
+            Change.record(Trademark.__tablename__,
+                          [row['app_no'] for row in rows], 'insert')
+            db.session.commit()
+            return jsonify({
+                'success': True,
+                'results': results,
+                'created': len(rows),
+                'total_trademarks': RowCount.get(Trademark.__tablename__)
+            }), 200
+        except Exception:
+            db.session.rollback()
+            abort(422)
+            print(sys.exc_info())
+
+    @app.route('/trademark_specs/batch', methods=['POST'])
+    @requires_auth('post:trademark_spec')
+    def add_specs_batch(payload):
+        """Handle POST requests for inserting many specification records.
+        ---
+        post:
+            description: Insert the valid specification records of a batch
+                in one transaction.
+            security:
+                - payload: decoded payload.
+            parameters:
+                - name: specs
+                  type: array
+                  required: true
+                  description: up to MAX_BATCH_SIZE specification objects
+                      with class_no, class_spec and tm_app_no.
+            responses:
+                200:
+                    description: inserted the valid specification records.
+                    results: a list of objects with the index of each record,
+                        its tm_app_no, its status (created or invalid) and an
+                        error for records that were not inserted.
+                    created: number of inserted specifications.
+                    total_specs: total number of the specifications.
+                422:
+                    description: the batch is malformed, too large or cannot
+                        be processed.
+        """
+        records = get_batch(request.get_json(), 'specs')
+        if records is None:
+            abort(422)
+
+        try:
+            validated = [validate_record(record, SPEC_FIELDS)
+                         for record in records]
+            app_nos = {row['tm_app_no'] for row, error in validated if row}
+            existing = {app_no for app_no, in db.session.query(
+                Trademark.app_no).filter(Trademark.app_no.in_(app_nos))}
+
+            results = []
+            rows = []
+            for index, (row, error) in enumerate(validated):
+                result = {'index': index,
+                          'tm_app_no': row and row['tm_app_no']}
+                if error:
+                    result.update(status='invalid', error=error)
+                elif row['tm_app_no'] not in existing:
+                    result.update(status='invalid',
+                                  error='trademark not found')
+                else:
+                    rows.append(row)
+                    result['status'] = 'created'
+                results.append(result)
+
+            Change.lock()
+            # One INSERT for the batch, returning the ids for the change log
+            spec_ids = Spec.insert_many(rows)
+            RowCount.adjust(Spec.__tablename__, len(rows))
+            Change.record(Spec.__tablename__, spec_ids, 'insert')
+            db.session.commit()
+            return jsonify({
+                'success': True,
+                'results': results,
+                'created': len(rows),
+                'total_specs': RowCount.get(Spec.__tablename__)
             }), 200
         except Exception:
+            db.session.rollback()
             abort(422)
             print(sys.exc_info())
 
     # Handle DELETE requests for a given trademark
+    @app.route('/trademarks', methods=['DELETE'])
+    @requires_auth('delete:trademark')
+    def delete_trademarks(payload):
+        """Handle DELETE requests for deleting many trademark records.
+        ---
+        delete:
+            description: Delete the trademarks given by their application
+                numbers or matching filters, and their specifications, in
+                one transaction.
+            security:
+                - payload: decoded payload.
+            parameters:
+                - name: app_nos
+                  type: array
+                  required: false
+                  description: up to MAX_BATCH_SIZE application numbers.
+                - name: filters
+                  type: object
+                  required: false
+                  description: status, type, class_no and owner filters, as
+                      for GET /trademarks, at least one; given instead of
+                      app_nos.
+            responses:
+                200:
+                    description: deleted the trademark records.
+                    deleted_trademarks: number of deleted trademarks.
+                    deleted_specs: number of deleted specifications.
+                    not_found: with app_nos, the application numbers that
+                        do not exist.
+                    total_trademarks: total number of trademarks.
+                    total_specs: total number of specifications.
+                400:
+                    description: filters are invalid.
+                422:
+                    description: neither app_nos nor filters are given, there
+                        are too many app_nos, or the deletion cannot be
+                        processed.
+        """
+        req = request.get_json(silent=True)
+        if not isinstance(req, dict):
+            abort(422)
+
+        if 'filters' in req:
+            if not isinstance(req['filters'], dict):
+                abort(422)
+            try:
+                criteria, _ = get_filters(req['filters'], search)
+            except ValueError:
+                abort(400)
+            # Purging the whole register takes an explicit filter
+            if not criteria:
+                abort(422)
+            app_nos = None
+        else:
+            app_nos = get_batch(req, 'app_nos')
+            if app_nos is None:
+                abort(422)
+            app_nos = list(dict.fromkeys(str(app_no) for app_no in app_nos))
+            criteria = [Trademark.app_no.in_(app_nos)]
+
+        try:
+            if app_nos is not None:
+                found = {app_no for app_no, in db.session.query(
+                    Trademark.app_no).filter(*criteria)}
+            deleted_trademarks, deleted_specs = Trademark.delete_matching(
+                *criteria)
+            db.session.commit()
+            response = {
+                'success': True,
+                'deleted_trademarks': deleted_trademarks,
+                'deleted_specs': deleted_specs,
+                'total_trademarks': RowCount.get(Trademark.__tablename__),
+                'total_specs': RowCount.get(Spec.__tablename__)
+            }
+            if app_nos is not None:
+                response['not_found'] = [app_no for app_no in app_nos
+                                         if app_no not in found]
+            return jsonify(response), 200
+        except Exception:
+            db.session.rollback()
+            abort(422)
+            print(sys.exc_info())
+
     @app.route('/trademarks/<string:app_no>', methods=['DELETE'])
     @requires_auth('delete:trademark')
     def delete_trademark(payload, app_no):
@@ -467,13 +1288,17 @@ def create_app(test_config=None):
                 - name: app_no
                   type: string
                   required: true
+                - name: full
+                  type: boolean
+                  required: false
+                  description: also return the current page of the table.
             responses:
                 200:
                     description: deleted a trademark record.
                     deleted_trademark_app_no: the application number of the
                         deleted trademark.
-                    trademarks: a list of trademarks objects with app_no, name,
-                        status and owners.
+                    trademarks: with full=true, a list of trademarks objects
+                        with app_no, name, status and owners.
                     total_trademarks: total number of the relevant trademarks.
                 404:
                     description: trademark not found.
@@ -486,14 +1311,16 @@ def create_app(test_config=None):
 
         try:
             trademark.delete()
-            trademarks = Trademark.query.order_by(Trademark.app_no).all()
-            current_trademarks = paginate_results(request, trademarks)
-            return jsonify({
+            response = {
                 'success': True,
                 'deleted_trademark_app_no': app_no,
-                'trademarks': current_trademarks,
-                'total_trademarks': len(trademarks)
-            }), 200
+                'total_trademarks': RowCount.get(Trademark.__tablename__)
+            }
+            if wants_full_response(request):
+                response['trademarks'], _ = paginate_query(
+                    request, Trademark.query.order_by(Trademark.app_no),
+                    Trademark.app_no)
+            return jsonify(response), 200
         except Exception:
             abort(422)
             print(sys.exc_info())
@@ -511,12 +1338,16 @@ def create_app(test_config=None):
                 - name: id
                   type: integer
                   required: true
+                - name: full
+                  type: boolean
+                  required: false
+                  description: also return the current page of the table.
             responses:
                 200:
                     description: deleted a trademark specification record.
                     deleted_spec_id: the deleted trademark specification id.
-                    specs: a list of specification objects with id, class_no,
-                        class_spec, and tm_app_no.
+                    specs: with full=true, a list of specification objects
+                        with id, class_no, class_spec, and tm_app_no.
                     total_specs: total number of the specifications.
                 404:
                     description: specification not found.
@@ -529,14 +1360,15 @@ def create_app(test_config=None):
 
         try:
             spec.delete()
-            specs = Spec.query.order_by(Spec.id).all()
-            current_specs = paginate_results(request, specs)
-            return jsonify({
+            response = {
                 'success': True,
                 'deleted_spec_id': id,
-                'specs': current_specs,
-                'total_specs': len(specs)
-            }), 200
+                'total_specs': RowCount.get(Spec.__tablename__)
+            }
+            if wants_full_response(request):
+                response['specs'], _ = paginate_query(
+                    request, Spec.query.order_by(Spec.id), Spec.id)
+            return jsonify(response), 200
         except Exception:
             abort(422)
             print(sys.exc_info())
@@ -576,6 +1408,15 @@ def create_app(test_config=None):
             'message': 'Unprocessable'
         }), 422
 
+    @app.errorhandler(AuthError)
+    def auth_error(error):
+        return jsonify({
+            'success': False,
+            'error': str(error.status_code),
+            'code': error.error['code'],
+            'message': error.error['description']
+        }), error.status_code
+
     @app.errorhandler(500)
     def server_error(error):
         return jsonify({
@@ -1,15 +1,45 @@
+from collections import OrderedDict
 from functools import wraps
+import hashlib
 import json
 import os
+import tempfile
+import threading
+import time
 from urllib.request import urlopen
 
 from flask import request, _request_ctx_stack
-from jose import jwt
+from jose import jwk, jwt
+import rsa
 
 AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN')
 ALGORITHMS = [os.environ.get('ALGORITHM')]
 API_AUDIENCE = os.environ.get('API_AUDIENCE')
 
+# Seconds the signing keys are trusted before /.well-known/jwks.json is
+# fetched again
+JWKS_CACHE_TTL = float(os.environ.get('JWKS_CACHE_TTL', 600))
+# Minimum seconds between refreshes triggered by an unknown key id
+JWKS_MIN_REFRESH_INTERVAL = float(
+    os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = float(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+# Load the signing keys from a local JWKS file instead, e.g. offline
+JWKS_FILE = os.environ.get('JWKS_FILE')
+# Number of verified tokens remembered, 0 disables the cache
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+# "auth0" verifies tokens with the signing keys of AUTH0_DOMAIN, "local" with
+# the key pair of a LocalIssuer, e.g. for tests and benchmarks offline
+AUTH_MODE = os.environ.get('AUTH_MODE', 'auth0')
+# PEM file of the private key of the local issuer, shared by the processes
+# that mint and verify tokens; a key is generated in memory without it
+LOCAL_ISSUER_KEY_FILE = os.environ.get('LOCAL_ISSUER_KEY_FILE')
+LOCAL_ISSUER = 'https://hktm.local/'
+
+# Permissions checked by the endpoints
+PERMISSIONS = ('post:trademark', 'post:trademark_spec', 'patch:trademark',
+               'patch:trademark_spec', 'delete:trademark',
+               'delete:trademark_spec')
+
 # AuthError Exception
 '''
 AuthError Exception
@@ -23,6 +53,285 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# JWKS Cache
+'''
+JWKSCache class that keeps the signing keys of the identity provider for the
+whole process, so that verifying a token does not need a network round trip.
+(1) keys are served from memory until they are older than the TTL,
+(2) an unknown key id triggers a refresh, at most once per
+        min_refresh_interval, in case the provider rotated its keys,
+(3) only one thread fetches at a time, the others wait for its result,
+(4) if a refresh fails, the keys already loaded keep being served,
+(5) hits, misses and refreshes are counted and returned by stats().
+'''
+
+
+class JWKSCache:
+    def __init__(self, url=None, path=None, ttl=JWKS_CACHE_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 timeout=JWKS_FETCH_TIMEOUT):
+        self.url = url
+        self.path = path
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._keys = {}
+        self._fetched_at = None
+        self._refresh_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'refreshes': 0, 'errors': 0}
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def _load(self):
+        if self.path:
+            with open(self.path) as jwks_file:
+                jwks = json.load(jwks_file)
+        else:
+            jsonurl = urlopen(self.url, timeout=self.timeout)
+            jwks = json.loads(jsonurl.read())
+
+        return {
+            key['kid']: {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            } for key in jwks['keys']
+        }
+
+    def _refresh(self, seen_fetched_at):
+        with self._refresh_lock:
+            # Another thread refreshed the keys while this one was waiting
+            if self._fetched_at != seen_fetched_at:
+                return
+            try:
+                self._keys = self._load()
+            except Exception:
+                self._count('errors')
+                if not self._keys:
+                    raise AuthError({
+                        'code': 'jwks_unavailable',
+                        'description': 'Unable to fetch the signing keys.'
+                    }, 503)
+            self._fetched_at = time.monotonic()
+            self._count('refreshes')
+
+    def get_key(self, kid):
+        fetched_at = self._fetched_at
+        now = time.monotonic()
+        expired = fetched_at is None or now - fetched_at >= self.ttl
+        key = None if expired else self._keys.get(kid)
+        if key is not None:
+            self._count('hits')
+            return key
+
+        self._count('misses')
+        if expired or now - fetched_at >= self.min_refresh_interval:
+            self._refresh(fetched_at)
+        return self._keys.get(kid)
+
+    def clear(self):
+        with self._refresh_lock:
+            self._keys = {}
+            self._fetched_at = None
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._stats, keys=len(self._keys))
+
+
+jwks_cache = JWKSCache(url=f'https://{AUTH0_DOMAIN}/.well-known/jwks.json',
+                       path=JWKS_FILE)
+
+
+# Key Providers
+'''
+A key provider returns the public key of a key id with get_key(kid), or None
+if it does not know the key id, and the claims that verified tokens must
+hold with claims(): the accepted algorithms, the audience and the issuer.
+The provider used by verify_decode_jwt is set with set_key_provider.
+'''
+
+
+class Auth0KeyProvider:
+    """Signing keys of the Auth0 tenant of AUTH0_DOMAIN, from jwks_cache."""
+
+    def get_key(self, kid):
+        return jwks_cache.get_key(kid)
+
+    def claims(self):
+        return {
+            'algorithms': ALGORITHMS,
+            'audience': API_AUDIENCE,
+            'issuer': 'https://' + AUTH0_DOMAIN + '/'
+        }
+
+
+'''
+LocalIssuer class that stands in for Auth0 without network access.
+(1) it holds an RSA key pair, generated locally or loaded from a PEM file,
+(2) mint() signs RS256 tokens with the given permissions, as Auth0 does,
+(3) as a key provider, it verifies only the tokens it signed, so that the
+        cost of the signature verification is the same as with Auth0.
+Anyone holding the private key can mint tokens with any permission, so the
+local mode must never be enabled in production.
+'''
+
+
+class LocalIssuer:
+    def __init__(self, private_key=None, issuer=LOCAL_ISSUER, audience=None,
+                 key_size=2048):
+        if private_key is None:
+            _, key = rsa.newkeys(key_size)
+            private_key = key.save_pkcs1().decode()
+        key = rsa.PrivateKey.load_pkcs1(private_key.encode())
+        self.private_key = private_key
+        self.issuer = issuer
+        self.audience = audience or API_AUDIENCE or 'hk-trademark'
+        self.kid = hashlib.sha256(str(key.n).encode()).hexdigest()[:16]
+        self.public_key = jwk.construct(
+            rsa.PublicKey(key.n, key.e).save_pkcs1().decode(),
+            'RS256').to_dict()
+        self.public_key.update({'kid': self.kid, 'use': 'sig'})
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """Load the private key from path, or generate and save it there.
+
+        A generated key is written to a temporary file, readable by its owner
+        only, and published with a hard link, which fails if the path exists.
+        Processes starting together, e.g. the workers of gunicorn, thus never
+        read a partly written key, and all load the key published first.
+        """
+        try:
+            with open(path) as key_file:
+                return cls(key_file.read(), **kwargs)
+        except FileNotFoundError:
+            pass
+        issuer = cls(**kwargs)
+        descriptor, temporary = tempfile.mkstemp(
+            suffix='.pem', dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(descriptor, 'w') as key_file:
+                key_file.write(issuer.private_key)
+                key_file.flush()
+                os.fsync(key_file.fileno())
+            os.link(temporary, path)
+        except FileExistsError:
+            with open(path) as key_file:
+                return cls(key_file.read(), **kwargs)
+        finally:
+            os.unlink(temporary)
+        return issuer
+
+    def get_key(self, kid):
+        return self.public_key if kid == self.kid else None
+
+    def claims(self):
+        return {
+            'algorithms': ['RS256'],
+            'audience': self.audience,
+            'issuer': self.issuer
+        }
+
+    def jwks(self):
+        """Return the public key as a JWKS document, e.g. for JWKS_FILE."""
+        return {'keys': [self.public_key]}
+
+    def mint(self, permissions, subject='local', expires_in=3600):
+        now = int(time.time())
+        return jwt.encode({'iss': self.issuer,
+                           'aud': self.audience,
+                           'sub': subject,
+                           'iat': now,
+                           'exp': now + expires_in,
+                           'permissions': list(permissions)},
+                          self.private_key, algorithm='RS256',
+                          headers={'kid': self.kid})
+
+
+def create_key_provider(mode=AUTH_MODE, key_file=LOCAL_ISSUER_KEY_FILE):
+    """Create the key provider of AUTH_MODE: auth0 or local."""
+    if mode == 'auth0':
+        return Auth0KeyProvider()
+    if mode == 'local':
+        if key_file:
+            return LocalIssuer.from_file(key_file)
+        return LocalIssuer()
+    raise ValueError('Unknown auth mode: {}'.format(mode))
+
+
+key_provider = create_key_provider()
+
+
+# Verified Token Cache
+'''
+VerifiedTokenCache class that remembers the payloads of tokens whose
+signature and claims were already verified, so that clients sending the same
+bearer token repeatedly skip the RSA verification.
+(1) entries are keyed by the SHA-256 digest of the token, not the token,
+(2) each entry expires at the exp claim of its token,
+(3) the least recently used entry is evicted beyond maxsize entries.
+'''
+
+
+class VerifiedTokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        digest = self._digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            payload, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[digest]
+                return None
+            self._entries.move_to_end(digest)
+            return payload
+
+    def set(self, token, payload):
+        expires_at = payload.get('exp')
+        if self.maxsize <= 0 or not isinstance(expires_at, (int, float)):
+            return
+        digest = self._digest(token)
+        with self._lock:
+            self._entries[digest] = (payload, expires_at)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+token_cache = VerifiedTokenCache()
+
+
+def set_key_provider(provider):
+    """Verify tokens with the provider from now on, and forget the tokens
+    verified with the previous one."""
+    global key_provider
+    key_provider = provider
+    token_cache.clear()
+
+
 # Auth Header
 '''
 get_token_auth_header function that
@@ -93,43 +402,26 @@ def check_permissions(permission, payload):
 '''
 verify_decode_jwt function that
 (1) confirms the jwt token as an Auth0 token with key id (kid),
-(2) verifies the token using Auth0 /.well-known/jwks.json,
+(2) verifies the token using the key of its key id from key_provider, by
+        default Auth0 /.well-known/jwks.json, as cached by jwks_cache,
 (3) decodes the payload from the token,
-(4) validates the claims,
+(4) validates the claims required by key_provider,
 (5) returns the decoded payload
 '''
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-
+    rsa_key = key_provider.get_key(unverified_header['kid'])
     if rsa_key:
         try:
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
-            )
+            payload = jwt.decode(token, rsa_key, **key_provider.claims())
 
             return payload
 
@@ -161,7 +453,8 @@ def verify_decode_jwt(token):
 '''
 @requires_auth decorator method that
 (1) uses the get_token_auth_header function to get the token,
-(2) uses the verify_decode_jwt function to decode the jwt, and
+(2) looks the token up in token_cache, or uses the verify_decode_jwt function
+        to decode the jwt and caches its payload until it expires, and
 (3) uses the check_permissions function to validate the claims and verify the
         requested permission
 (4) and returns the decorator which passes the decoded payload to the decorated
@@ -174,7 +467,10 @@ def requires_auth(permission=''):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
+            payload = token_cache.get(token)
+            if payload is None:
+                payload = verify_decode_jwt(token)
+                token_cache.set(token, payload)
             check_permissions(permission, payload)
             return f(payload, *args, **kwargs)
 
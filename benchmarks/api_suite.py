@@ -0,0 +1,404 @@
+"""Benchmark suite of the HTTP API on a synthetic register.
+
+Generates a register with generate_register.py, then drives every endpoint
+of create_app() through the Flask test client, one request at a time, and
+through a threaded WSGI server with --concurrency keep-alive clients. The
+latency percentiles, throughput, response statuses and peak RSS of every
+scenario are written as JSON, e.g. to compare two commits:
+
+    python benchmarks/api_suite.py --trademarks 100000 --output before.json
+    python benchmarks/api_suite.py --trademarks 100000 --output after.json
+    python benchmarks/compare.py before.json after.json
+
+Write scenarios send a token with all the permissions, minted by a local
+issuer, see auth.LocalIssuer, or given in --token or BENCHMARK_TOKEN. A
+server given with --url verifies minted tokens when it runs with
+AUTH_MODE=local and LOCAL_ISSUER_KEY_FILE set to the --issuer-key file. The
+rows written are deleted at the end of each mode.
+"""
+import argparse
+from collections import Counter, namedtuple
+import contextlib
+import datetime
+import itertools
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from sqlalchemy import func  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+
+import auth  # noqa: E402
+from auth import LocalIssuer, PERMISSIONS  # noqa: E402
+from generate_register import generate_register  # noqa: E402
+from load_test import run, summarize  # noqa: E402
+from models import db, Trademark, Spec, RowCount  # noqa: E402
+
+DEFAULT_DATABASE_URL = 'sqlite:///' + os.path.join(tempfile.gettempdir(),
+                                                   'hktm_benchmark.db')
+BATCH_SIZE = 10
+
+"""
+Scenarios
+"""
+
+'''
+A scenario makes the n-th request of a run from its number, as the method,
+the path and the JSON payload or None. Read scenarios use a sample of the
+register, write scenarios the rows written earlier in the same mode, see
+Workload. Heavy scenarios, the exports, are run a few times only in the test
+client and by a single client of the server.
+'''
+
+Scenario = namedtuple('Scenario', 'name method make_request writes heavy')
+
+
+def read(name, make_request, method='GET', heavy=False):
+    return Scenario(name, method, make_request, False, heavy)
+
+
+def write(name, method, make_request):
+    return Scenario(name, method, make_request, True, False)
+
+
+class Workload:
+    """Keys of the register read by the scenarios, and of the rows written
+    by the write scenarios of one mode, which all start with prefix."""
+
+    def __init__(self, app, prefix, sample_size=1000):
+        self.app = app
+        self.prefix = prefix
+        self.marker = 'benchmark {}'.format(prefix)
+        with app.app_context():
+            self.app_nos = [app_no for app_no, in db.session.query(
+                Trademark.app_no).order_by(func.random()).limit(sample_size)]
+            self.total_trademarks = RowCount.get(Trademark.__tablename__)
+            db.session.remove()
+        if not self.app_nos:
+            raise RuntimeError('The register is empty.')
+        self.created_app_nos = []
+        self.created_spec_ids = []
+
+    def refresh(self):
+        """Read the keys of the rows written so far."""
+        with self.app.app_context():
+            self.created_app_nos = [app_no for app_no, in db.session.query(
+                Trademark.app_no).filter(
+                Trademark.app_no.like(self.prefix + '%')).order_by(
+                Trademark.app_no)]
+            self.created_spec_ids = [spec_id for spec_id, in db.session.query(
+                Spec.id).filter(Spec.class_spec == self.marker).order_by(
+                Spec.id)]
+            db.session.remove()
+
+    def cleanup(self):
+        """Delete the rows written by the write scenarios."""
+        with self.app.app_context():
+            written = Trademark.app_no.like(self.prefix + '%')
+            Spec.query.filter((Spec.class_spec == self.marker) |
+                              Spec.tm_app_no.like(self.prefix + '%')).delete(
+                synchronize_session=False)
+            Trademark.query.filter(written).delete(synchronize_session=False)
+            db.session.commit()
+            for model in (Trademark, Spec):
+                RowCount.refresh(model.__tablename__)
+            db.session.remove()
+
+    def sample(self, n, keys):
+        return keys[n % len(keys)] if keys else '0'
+
+    def created(self, n, keys, missing):
+        return keys[n] if n < len(keys) else missing
+
+
+def scenarios(workload):
+    words = ['APPLE', 'DRAGON', 'PEARL', 'TEA', 'STAR']
+    goods = ['software', 'clothing', 'restaurant', 'tea', 'watches']
+    deep_page = max(1, workload.total_trademarks // 200)
+
+    def trademark(app_no):
+        return {'app_no': app_no, 'name': 'BENCHMARK', 'status': 'Pending',
+                'owners': "['Benchmark Limited']"}
+
+    def spec(n):
+        return {'class_no': n % 45 + 1, 'class_spec': workload.marker,
+                'tm_app_no': workload.sample(n, workload.created_app_nos)}
+
+    return [
+        read('list_first_page', lambda n: ('/trademarks', None)),
+        read('list_deep_page', lambda n: (
+            '/trademarks?page={}'.format(deep_page), None)),
+        read('list_after_cursor', lambda n: ('/trademarks?after={}'.format(
+            workload.sample(n, workload.app_nos)), None)),
+        read('list_fields', lambda n: (
+            '/trademarks?fields=app_no,name,type,trademark_id', None)),
+        read('list_filtered', lambda n: (
+            '/trademarks?status=Registered&class_no={}'.format(
+                n % 45 + 1), None)),
+        read('list_sorted_by_name', lambda n: ('/trademarks?sort=name',
+                                               None)),
+        read('list_by_app_nos', lambda n: ('/trademarks?app_no={}'.format(
+            ','.join(workload.sample(n + index, workload.app_nos)
+                     for index in range(10))), None)),
+        read('trademark_details', lambda n: ('/trademarks/{}'.format(
+            workload.sample(n, workload.app_nos)), None)),
+        read('search_trademarks', lambda n: (
+            '/trademarks/search', {'searchTerm': words[n % len(words)]}),
+            method='POST'),
+        read('search_specs', lambda n: (
+            '/trademark_specs/search', {'searchTerm': goods[n % len(goods)]}),
+            method='POST'),
+        read('changes', lambda n: ('/changes?limit=100', None)),
+        read('health', lambda n: ('/health', None)),
+        read('export_trademarks', lambda n: (
+            '/export/trademarks?include=specs', None), heavy=True),
+        read('export_specs', lambda n: (
+            '/export/specs?format=csv', None), heavy=True),
+        write('create_trademark', 'POST', lambda n: (
+            '/trademarks', trademark('{}{:07d}'.format(workload.prefix, n)))),
+        write('create_trademarks_batch', 'POST', lambda n: (
+            '/trademarks/batch', {'trademarks': [
+                trademark('{}b{:06d}{:02d}'.format(workload.prefix, n, index))
+                for index in range(BATCH_SIZE)]})),
+        write('update_trademark', 'PATCH', lambda n: (
+            '/trademarks/{}'.format(workload.sample(
+                n, workload.created_app_nos)),
+            {'name': 'BENCHMARK {}'.format(n)})),
+        write('create_spec', 'POST', lambda n: ('/trademark_specs', spec(n))),
+        write('create_specs_batch', 'POST', lambda n: (
+            '/trademark_specs/batch', {'specs': [
+                spec(n * BATCH_SIZE + index)
+                for index in range(BATCH_SIZE)]})),
+        write('update_spec', 'PATCH', lambda n: (
+            '/trademark_specs/{}'.format(workload.sample(
+                n, workload.created_spec_ids)),
+            {'class_spec': workload.marker, 'class_no': n % 45 + 1})),
+        write('delete_spec', 'DELETE', lambda n: (
+            '/trademark_specs/{}'.format(workload.created(
+                n, workload.created_spec_ids, 0)), None)),
+        write('delete_trademark', 'DELETE', lambda n: (
+            '/trademarks/{}'.format(workload.created(
+                n, workload.created_app_nos, workload.prefix)), None)),
+        write('delete_trademarks_batch', 'DELETE', lambda n: (
+            '/trademarks', {'app_nos': workload.created_app_nos[
+                n * BATCH_SIZE:(n + 1) * BATCH_SIZE] or [workload.prefix]})),
+    ]
+
+
+def request_maker(scenario, headers):
+    """Return the next_request function of a scenario, see load_test."""
+    numbers = itertools.count()
+
+    def next_request():
+        path, payload = scenario.make_request(next(numbers))
+        if payload is None:
+            return scenario.method, path, None, dict(headers)
+        return (scenario.method, path, json.dumps(payload).encode(),
+                dict(headers, **{'Content-Type': 'application/json'}))
+
+    return next_request
+
+
+"""
+Drivers
+"""
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return round(peak / scale, 1)
+
+
+def drive_test_client(app, next_request, requests):
+    client = app.test_client()
+    latencies, statuses, errors = [], Counter(), 0
+    started = time.monotonic()
+    for _ in range(requests):
+        method, path, body, headers = next_request()
+        request_started = time.perf_counter()
+        response = client.open(path, method=method, data=body,
+                               headers=headers)
+        response.get_data()
+        statuses[response.status_code] += 1
+        if response.status_code >= 500:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - request_started)
+    return summarize(latencies, errors, statuses, time.monotonic() - started)
+
+
+class Server:
+    """Threaded WSGI server of werkzeug serving the app in the background."""
+
+    def __init__(self, app):
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.thread.join()
+
+
+def run_mode(app, workload, headers, drive, selected=None, report=print):
+    results = {}
+    for scenario in scenarios(workload):
+        if selected and scenario.name not in selected:
+            continue
+        report('{}...'.format(scenario.name))
+        result = drive(scenario, request_maker(scenario, headers))
+        result['peak_rss_mb'] = peak_rss_mb()
+        results[scenario.name] = result
+        if scenario.writes:
+            workload.refresh()
+    workload.cleanup()
+    return results
+
+
+"""
+Suite
+"""
+
+
+def load_app(database_url, config):
+    # The app module creates an app on import, on DATABASE_PATH
+    os.environ['DATABASE_PATH'] = database_url
+    from app import create_app
+    return create_app(dict(config, DATABASE_PATH=database_url))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default=DEFAULT_DATABASE_URL)
+    parser.add_argument('--trademarks', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-generate', dest='generate',
+                        action='store_false',
+                        help='benchmark the register already in the database')
+    parser.add_argument('--mode', choices=['test-client', 'server', 'both'],
+                        default='both')
+    parser.add_argument('--scenario', dest='scenarios', action='append',
+                        help='name of a scenario to run, all by default')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per scenario in the test client')
+    parser.add_argument('--heavy-requests', type=int, default=3,
+                        help='requests per export in the test client')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds per scenario on the server')
+    parser.add_argument('--url', help='benchmark a running server instead, '
+                        'e.g. gunicorn, on the same database')
+    parser.add_argument('--response-cache', default='none',
+                        help='RESPONSE_CACHE of the app')
+    parser.add_argument('--token', default=os.environ.get('BENCHMARK_TOKEN'))
+    parser.add_argument('--issuer-key',
+                        help='PEM file of the key of the local issuer, '
+                        'created if missing')
+    parser.add_argument('--verify-every-request', action='store_true',
+                        help='verify the signature of the token on every '
+                        'request instead of caching verified tokens')
+    parser.add_argument('--output', help='JSON file, stdout by default')
+    args = parser.parse_args()
+
+    def report(message):
+        print(message, file=sys.stderr)
+
+    counts = None
+    if args.generate:
+        counts = generate_register(args.database_url, args.trademarks,
+                                   seed=args.seed, report=report)
+    app = load_app(args.database_url, {'RESPONSE_CACHE': args.response_cache})
+    token = args.token
+    if token is None:
+        issuer = (LocalIssuer.from_file(args.issuer_key) if args.issuer_key
+                  else LocalIssuer())
+        auth.set_key_provider(issuer)
+        token = issuer.mint(PERMISSIONS, subject='benchmark',
+                            expires_in=24 * 3600)
+    if args.verify_every_request:
+        auth.token_cache.maxsize = 0
+    headers = {'Authorization': 'Bearer ' + token}
+
+    results = {
+        'started_at': datetime.datetime.utcnow().isoformat() + 'Z',
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'database': db.engine.dialect.name,
+        'register': counts,
+        'settings': {name: getattr(args, name) for name in (
+            'requests', 'heavy_requests', 'concurrency', 'duration',
+            'response_cache', 'url', 'verify_every_request')},
+        'json_backend': app.extensions['json_backend'].name,
+    }
+    run_id = '{:x}'.format(int(time.time()))
+
+    if args.mode in ('test-client', 'both'):
+        report('Test client')
+
+        def drive(scenario, next_request):
+            requests = args.heavy_requests if scenario.heavy else args.requests
+            return drive_test_client(app, next_request, requests)
+
+        workload = Workload(app, 'BENCH{}C'.format(run_id))
+        results['test_client'] = run_mode(app, workload, headers, drive,
+                                          args.scenarios, report)
+
+    if args.mode in ('server', 'both'):
+        report('WSGI server')
+        server = None if args.url else Server(app)
+        url = args.url or server.url
+
+        def drive(scenario, next_request):
+            concurrency = 1 if scenario.heavy else args.concurrency
+            return run(url, next_request, concurrency, args.duration)
+
+        workload = Workload(app, 'BENCH{}S'.format(run_id))
+        with server or contextlib.nullcontext():
+            results['server'] = run_mode(app, workload, headers, drive,
+                                         args.scenarios, report)
+
+    results['peak_rss_mb'] = peak_rss_mb()
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
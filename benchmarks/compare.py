@@ -0,0 +1,70 @@
+"""Compare two results of api_suite.py.
+
+Prints the p50, p95 and p99 latency and the throughput of every scenario
+run in both results, with the relative change, and exits with status 1 if
+the p95 latency of a scenario grew, or its throughput dropped, by more than
+--threshold, e.g. in continuous integration:
+
+    python benchmarks/compare.py before.json after.json --threshold 0.1
+"""
+import argparse
+import json
+import sys
+
+MODES = ('test_client', 'server')
+METRICS = ('p50_ms', 'p95_ms', 'p99_ms', 'requests_per_s')
+
+
+def change(before, after):
+    if not before or after is None:
+        return None
+    return (after - before) / before
+
+
+def compare(baseline, current, threshold):
+    """Return the rows of the comparison and the regressed scenarios."""
+    rows, regressions = [], []
+    for mode in MODES:
+        for name, before in baseline.get(mode, {}).items():
+            after = current.get(mode, {}).get(name)
+            if after is None:
+                continue
+            changes = {metric: change(before.get(metric), after.get(metric))
+                       for metric in METRICS}
+            rows.append((mode, name, before, after, changes))
+            slower = (changes['p95_ms'] or 0) > threshold
+            fewer = (changes['requests_per_s'] or 0) < -threshold
+            if slower or fewer:
+                regressions.append('{}/{}'.format(mode, name))
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative change reported as a regression')
+    args = parser.parse_args()
+
+    with open(args.baseline) as baseline, open(args.current) as current:
+        rows, regressions = compare(json.load(baseline), json.load(current),
+                                    args.threshold)
+
+    print('{:<12} {:<24}'.format('mode', 'scenario') + ''.join(
+        '{:>24}'.format(metric) for metric in METRICS))
+    for mode, name, before, after, changes in rows:
+        print('{:<12} {:<24}'.format(mode, name) + ''.join(
+            '{:>24}'.format('{} -> {} ({})'.format(
+                before.get(metric), after.get(metric),
+                '-' if changes[metric] is None
+                else '{:+.0%}'.format(changes[metric])))
+            for metric in METRICS))
+
+    if regressions:
+        print('Regressions: ' + ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""Generate a synthetic register of trademarks and specifications.
+
+Writes --trademarks trademarks, each with specifications in one to a few of
+the 45 Nice classes, into a PostgreSQL or SQLite database with the bulk
+import of bulk.py. The register only depends on --seed, so that benchmark
+runs on registers of the same size are comparable. On PostgreSQL, the
+tables and indexes are created by the migrations, as in production.
+
+    python benchmarks/generate_register.py \\
+        --database-url sqlite:////tmp/hktm_benchmark.db --trademarks 100000
+"""
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from flask import Flask  # noqa: E402
+from flask_migrate import Migrate, upgrade  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+
+from bulk import DEFAULT_BATCH_SIZE, import_records  # noqa: E402
+from models import db, Trademark, Spec, RowCount  # noqa: E402
+
+MIGRATIONS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), 'migrations')
+
+NICE_CLASSES = range(1, 46)
+# Classes filed most often get a higher weight, e.g. 9, 25 and 35
+CLASS_WEIGHTS = {3: 4, 5: 3, 9: 8, 14: 3, 16: 3, 18: 3, 25: 6, 30: 4, 35: 8,
+                 41: 4, 42: 5, 43: 3}
+
+WORDS = ('APPLE', 'BAMBOO', 'CRANE', 'DRAGON', 'EAGLE', 'FORTUNE', 'GOLDEN',
+         'HARBOUR', 'IVORY', 'JADE', 'KOWLOON', 'LOTUS', 'MOON', 'NOBLE',
+         'OCEAN', 'PEARL', 'PHOENIX', 'RIVER', 'SILK', 'STAR', 'SUN', 'TIGER',
+         'VICTORIA', 'WISDOM')
+SUFFIXES = ('', ' CLUB', ' EXPRESS', ' GARDEN', ' GROUP', ' HOUSE', ' LAB',
+            ' PLUS', ' TEA', ' TECH')
+COMPANY_TYPES = ('Limited', 'Company Limited', 'Holdings Limited', 'Inc.',
+                 'Corporation', 'GmbH', 'Co., Ltd.')
+STATUSES = ('Registered', 'Registered', 'Registered', 'Expired', 'Pending',
+            'Withdrawn', 'Refused')
+TYPES = ('Word', 'Device', 'Word and Device', 'Series')
+GOODS = ('apparatus for recording sound', 'bags', 'beverages', 'biscuits',
+         'clothing', 'computer software', 'cosmetics', 'education services',
+         'footwear', 'furniture', 'headgear', 'jewellery', 'medicines',
+         'paper', 'perfumery', 'restaurant services', 'retail services',
+         'soaps', 'tea', 'telecommunications', 'toys', 'watches')
+
+
+def trademark_records(count, seed=0):
+    """Yield count trademarks, the same ones for the same seed."""
+    rng = random.Random(seed)
+    for index in range(count):
+        owner = '{} {} {}'.format(rng.choice(WORDS).title(),
+                                  rng.choice(WORDS).title(),
+                                  rng.choice(COMPANY_TYPES))
+        yield {
+            'app_no': '{:09d}'.format(300000000 + index),
+            'name': rng.choice(WORDS) + rng.choice(SUFFIXES),
+            'status': rng.choice(STATUSES),
+            'owners': repr([owner]),
+            'applicant': owner,
+            'type': rng.choice(TYPES),
+            'trademark_id': 'T{:08d}'.format(index),
+        }
+
+
+def spec_records(count, classes_per_trademark=3, seed=0):
+    """Yield the specifications of the count first trademarks, in one to
+    2 * classes_per_trademark - 1 distinct classes each."""
+    rng = random.Random(seed + 1)
+    weights = [CLASS_WEIGHTS.get(class_no, 1) for class_no in NICE_CLASSES]
+    spec_id = 0
+    for index in range(count):
+        classes = set()
+        for _ in range(rng.randint(1, 2 * classes_per_trademark - 1)):
+            classes.add(rng.choices(NICE_CLASSES, weights)[0])
+        for class_no in sorted(classes):
+            spec_id += 1
+            yield {
+                'id': spec_id,
+                'class_no': class_no,
+                'class_spec': '; '.join(rng.sample(GOODS, rng.randint(1, 4))),
+                'tm_app_no': '{:09d}'.format(300000000 + index),
+            }
+
+
+def create_schema():
+    """Create the tables, with the migrations on PostgreSQL."""
+    if db.engine.dialect.name == 'postgresql':
+        upgrade(directory=MIGRATIONS)
+    else:
+        db.create_all()
+
+
+def generate_register(database_url, trademarks, classes_per_trademark=3,
+                      seed=0, batch_size=DEFAULT_BATCH_SIZE, reset=False,
+                      report=print):
+    """Write the register into the database and return its row counts."""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    Migrate(app, db, directory=MIGRATIONS)
+
+    with app.app_context():
+        if reset:
+            db.drop_all()
+            db.session.execute(text('DROP TABLE IF EXISTS alembic_version'))
+            db.session.commit()
+        create_schema()
+        import_records(db.engine, Trademark.__table__,
+                       trademark_records(trademarks, seed), batch_size,
+                       report)
+        import_records(db.engine, Spec.__table__,
+                       spec_records(trademarks, classes_per_trademark, seed),
+                       batch_size, report)
+        counts = {model.__tablename__: RowCount.refresh(model.__tablename__)
+                  for model in (Trademark, Spec)}
+        db.session.remove()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', required=True)
+    parser.add_argument('--trademarks', type=int, default=100000)
+    parser.add_argument('--classes-per-trademark', type=int, default=3,
+                        help='average number of classes of a trademark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--reset', action='store_true',
+                        help='drop the tables of the database first')
+    args = parser.parse_args()
+
+    print(generate_register(args.database_url, args.trademarks,
+                            args.classes_per_trademark, args.seed,
+                            args.batch_size, args.reset))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""Load test of a running API server.
+
+Keeps --concurrency clients busy for --duration seconds, each sending GET
+requests over its own keep-alive connection, round-robin over the paths,
+and prints the throughput and the latency percentiles as JSON, e.g. to
+compare the serving modes of gunicorn.conf.py:
+
+    WEB_WORKER_CLASS=sync gunicorn --config gunicorn.conf.py app:app
+    python benchmarks/load_test.py --url http://127.0.0.1:8000 \\
+        --concurrency 64 --path /trademarks --path /trademarks/19914141
+"""
+import argparse
+from collections import Counter
+import http.client
+import itertools
+import json
+import statistics
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(latencies, errors, statuses, elapsed):
+    """Return the throughput and latency percentiles of a run."""
+    def ms(value):
+        return None if value is None else round(value * 1000, 2)
+
+    return {
+        'duration_s': round(elapsed, 2),
+        'requests': len(latencies),
+        'errors': errors,
+        'statuses': {str(status): count
+                     for status, count in sorted(statuses.items())},
+        'requests_per_s': round(len(latencies) / max(elapsed, 1e-9), 1),
+        'mean_ms': ms(statistics.mean(latencies) if latencies else None),
+        'p50_ms': ms(percentile(latencies, 0.50)),
+        'p95_ms': ms(percentile(latencies, 0.95)),
+        'p99_ms': ms(percentile(latencies, 0.99)),
+    }
+
+
+def get_requests(paths):
+    """Return a next_request function cycling over GET requests of paths.
+
+    A next_request function returns the method, path, body and headers of
+    the next request, and is shared by all the clients.
+    """
+    paths = itertools.cycle(paths)
+
+    def next_request():
+        return 'GET', next(paths), None, {}
+
+    return next_request
+
+
+class Client(threading.Thread):
+    def __init__(self, url, next_request, deadline):
+        super().__init__(daemon=True)
+        self.url = urlsplit(url)
+        self.next_request = next_request
+        self.deadline = deadline
+        self.latencies = []
+        self.errors = 0
+        self.statuses = Counter()
+
+    def connect(self):
+        return http.client.HTTPConnection(self.url.hostname,
+                                          self.url.port or 80, timeout=30)
+
+    def run(self):
+        connection = self.connect()
+        while time.monotonic() < self.deadline:
+            method, path, body, headers = self.next_request()
+            started = time.perf_counter()
+            try:
+                connection.request(method, self.url.path.rstrip('/') + path,
+                                   body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException):
+                self.errors += 1
+                connection.close()
+                connection = self.connect()
+                continue
+            self.statuses[response.status] += 1
+            if response.status >= 500:
+                self.errors += 1
+                continue
+            self.latencies.append(time.perf_counter() - started)
+        connection.close()
+
+
+def run(url, next_request, concurrency, duration):
+    deadline = time.monotonic() + duration
+    clients = [Client(url, next_request, deadline)
+               for _ in range(concurrency)]
+    started = time.monotonic()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.monotonic() - started
+
+    result = summarize(
+        [latency for client in clients for latency in client.latencies],
+        sum(client.errors for client in clients),
+        sum((client.statuses for client in clients), Counter()), elapsed)
+    return dict(concurrency=concurrency, **result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--path', dest='paths', action='append')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=30)
+    args = parser.parse_args()
+
+    next_request = get_requests(args.paths or ['/trademarks'])
+    print(json.dumps(run(args.url, next_request, args.concurrency,
+                         args.duration), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Micro-benchmark of the serialization of a page of trademarks.
+
+Compares the original path, which loads ORM entities, formats them with
+format() and encodes the page with jsonify, with the column tuples and JSON
+backends of serializers.py, on an in-memory SQLite database.
+
+    python benchmarks/serialization.py --rows 10000 --page-size 100
+
+Prints the median time per page of each path, in milliseconds, as JSON.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from flask import Flask, jsonify  # noqa: E402
+
+from models import db, Trademark  # noqa: E402
+from serializers import (  # noqa: E402
+    available_json_backends,
+    get_json_backend,
+    row_formatter,
+    TRADEMARK_COLUMNS
+)
+
+
+def create_app(rows):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        db.session.bulk_insert_mappings(Trademark, [
+            {'app_no': '{:08d}'.format(index),
+             'name': 'TRADEMARK {}'.format(index),
+             'status': 'Registered',
+             'owners': "['Owner {} Limited']".format(index % 977)}
+            for index in range(rows)])
+        db.session.commit()
+    return app
+
+
+def measure(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return round(statistics.median(timings) * 1000, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    app = create_app(args.rows)
+    format_trademarks = row_formatter(TRADEMARK_COLUMNS)
+
+    def entities_and_jsonify():
+        trademarks = Trademark.query.order_by(Trademark.app_no).offset(
+            args.rows // 2).limit(args.page_size).all()
+        jsonify({'success': True,
+                 'trademarks': [trademark.format()
+                                for trademark in trademarks]}).get_data()
+
+    def tuples_and(backend):
+        def serialize():
+            trademarks = db.session.query(*TRADEMARK_COLUMNS).order_by(
+                Trademark.app_no).offset(args.rows // 2).limit(
+                args.page_size).all()
+            backend.dumps({'success': True,
+                           'trademarks': format_trademarks(trademarks)})
+        return serialize
+
+    results = {'rows': args.rows, 'page_size': args.page_size}
+    with app.test_request_context():
+        results['entities_jsonify_ms'] = measure(entities_and_jsonify,
+                                                 args.repeat)
+        for name in available_json_backends():
+            results['tuples_{}_ms'.format(name)] = measure(
+                tuples_and(get_json_backend(name)), args.repeat)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+import csv
+import io
+import json
+import os
+import time
+
+from sqlalchemy import select
+from sqlalchemy.dialects import sqlite
+
+DEFAULT_BATCH_SIZE = 10000
+# Largest number of records accepted by the batch endpoints
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 1000))
+
+# Fields accepted by the batch endpoints: name -> (type, required)
+TRADEMARK_FIELDS = {
+    'app_no': (str, True),
+    'name': (str, True),
+    'status': (str, True),
+    'owners': (str, True),
+    'applicant': (str, False),
+    'type': (str, False),
+    'trademark_id': (str, False),
+}
+SPEC_FIELDS = {
+    'class_no': (int, True),
+    'class_spec': (str, True),
+    'tm_app_no': (str, True),
+}
+
+"""
+Reading Exports
+"""
+
+
+def read_records(path, file_format=None):
+    """Yield the records of a CSV or JSONL file one at a time."""
+    if file_format is None:
+        is_jsonl = path.endswith(('.jsonl', '.ndjson'))
+        file_format = 'jsonl' if is_jsonl else 'csv'
+
+    with open(path, newline='', encoding='utf-8') as export:
+        if file_format == 'csv':
+            for record in csv.DictReader(export):
+                yield record
+        elif file_format == 'jsonl':
+            for line in export:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            raise ValueError('Unsupported format: {}'.format(file_format))
+
+
+def coerce_record(table, record):
+    """Keep the columns of the table and convert them to their types."""
+    row = {}
+    for column in table.columns:
+        if column.name not in record:
+            continue
+        value = record[column.name]
+        if value is None or value == '':
+            row[column.name] = None
+        else:
+            row[column.name] = column.type.python_type(value)
+    return row
+
+
+def batches(records, batch_size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Progress:
+    """Print the number of rows processed and the throughput so far."""
+
+    def __init__(self, label, report=print):
+        self.label = label
+        self.report = report
+        self.rows = 0
+        self.started = time.monotonic()
+
+    def add(self, rows):
+        self.rows += rows
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        self.report('{}: {} rows ({:.0f} rows/s)'.format(
+            self.label, self.rows, self.rows / elapsed))
+
+
+"""
+Importing
+"""
+
+'''
+import_records function that loads records into a table in one transaction
+and returns the number of records read. Existing rows with the same primary
+key are updated, and new rows are inserted.
+(1) on PostgreSQL, each batch is streamed with COPY into a temporary staging
+        table, which is then upserted into the table with a single
+        INSERT ... SELECT ... ON CONFLICT DO UPDATE,
+(2) on other databases, each batch is upserted with executemany.
+Only one batch is held in memory at a time. All records are expected to carry
+the same columns, e.g. either every specification has an id or none has.
+Records without a primary key, e.g. specifications without an id, replace
+all the rows with the same replace_by column, e.g. all the specifications of
+the imported tm_app_nos, so that importing an export again does not
+duplicate them. Without replace_by, such records raise ValueError.
+Among records with the same primary key, the last one of the file wins.
+Given the change_log table, the key of every row written is logged in it with
+the "upsert" operation, and of every row replaced with the "delete"
+operation, in the same transaction.
+'''
+
+
+def import_records(engine, table, records, batch_size=DEFAULT_BATCH_SIZE,
+                   report=print, change_log=None, replace_by=None):
+    rows = (coerce_record(table, record) for record in records)
+    with engine.begin() as connection:
+        if connection.dialect.name == 'postgresql':
+            return _copy_and_upsert(connection, table, rows, batch_size,
+                                    report, change_log, replace_by)
+        return _executemany_upsert(connection, table, rows, batch_size,
+                                   report, change_log, replace_by)
+
+
+def _keyless_columns(table, columns, replace_by):
+    """Return whether the columns lack the primary key, which requires the
+    replace_by column."""
+    keys = [column.name for column in table.primary_key.columns]
+    if all(key in columns for key in keys):
+        return False
+    if replace_by is None or replace_by not in columns:
+        raise ValueError('The {} records have no {}, give the column of the '
+                         'rows they replace.'.format(table.name,
+                                                     ', '.join(keys)))
+    return True
+
+
+def _log_statement(statement, table, keys, change_log, operation):
+    return ('WITH logged AS ({} RETURNING {}) '
+            'INSERT INTO {} (table_name, row_key, operation, changed_at) '
+            "SELECT '{}', concat_ws(',', {}), '{}', "
+            "timezone('utc', now()) FROM logged").format(
+        statement, ', '.join(keys), change_log.name, table.name,
+        ', '.join(keys), operation)
+
+
+def _copy_and_upsert(connection, table, rows, batch_size, report,
+                     change_log=None, replace_by=None):
+    cursor = connection.connection.cursor()
+    staging = 'import_{}'.format(table.name)
+
+    progress = Progress('{} staged'.format(table.name), report)
+    columns = None
+    for batch in batches(rows, batch_size):
+        if columns is None:
+            columns = list(batch[0])
+            keyless = _keyless_columns(table, columns, replace_by)
+            # Stage the imported columns only, without their constraints
+            cursor.execute('CREATE TEMPORARY TABLE {} ON COMMIT DROP AS '
+                           'SELECT {} FROM {} WITH NO DATA'.format(
+                               staging, ', '.join(columns), table.name))
+            # Number the rows in the order of the file
+            cursor.execute('ALTER TABLE {} ADD COLUMN import_row '
+                           'bigserial'.format(staging))
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in batch:
+            writer.writerow([row.get(column) for column in columns])
+        buffer.seek(0)
+        cursor.copy_expert('COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+            staging, ', '.join(columns)), buffer)
+        progress.add(len(batch))
+
+    if columns is None:
+        return 0
+
+    targets = list(columns)
+    values = list(columns)
+    if 'updated_at' in table.columns and 'updated_at' not in columns:
+        targets.append('updated_at')
+        values.append("timezone('utc', now())")
+
+    keys = [column.name for column in table.primary_key.columns]
+    if change_log is not None:
+        # Same lock as the writers of the change log, see models.Change
+        cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s))',
+                       (change_log.name,))
+    if keyless:
+        statement = ('DELETE FROM {0} WHERE {1} IN '
+                     '(SELECT {1} FROM {2})').format(
+            table.name, replace_by, staging)
+        if change_log is not None:
+            statement = _log_statement(statement, table, keys, change_log,
+                                       'delete')
+        cursor.execute(statement)
+        report('{}: {} rows replaced'.format(table.name, cursor.rowcount))
+        statement = ('INSERT INTO {} ({}) SELECT {} FROM {} '
+                     'ORDER BY import_row').format(
+            table.name, ', '.join(targets), ', '.join(values), staging)
+    else:
+        updates = ', '.join('{0} = EXCLUDED.{0}'.format(column)
+                            for column in targets if column not in keys)
+        # Keep the last row per key, ON CONFLICT cannot update a row twice
+        statement = ('INSERT INTO {0} ({1}) SELECT DISTINCT ON ({4}) {2} '
+                     'FROM {3} ORDER BY {4}, import_row DESC '
+                     'ON CONFLICT ({4}) {5}').format(
+            table.name, ', '.join(targets), ', '.join(values), staging,
+            ', '.join(keys),
+            'DO UPDATE SET ' + updates if updates else 'DO NOTHING')
+    if change_log is not None:
+        statement = _log_statement(statement, table, keys, change_log,
+                                   'upsert')
+    started = time.monotonic()
+    cursor.execute(statement)
+    report('{}: {} rows upserted in {:.1f}s'.format(
+        table.name, cursor.rowcount, time.monotonic() - started))
+
+    # Move serial sequences past explicitly imported ids
+    for column in table.primary_key.columns:
+        if column.name in columns and column.type.python_type is int:
+            cursor.execute(
+                "SELECT setval(pg_get_serial_sequence('{0}', '{1}'), "
+                "(SELECT max({1}) FROM {0})) "
+                "WHERE EXISTS (SELECT 1 FROM {0})".format(
+                    table.name, column.name))
+    return progress.rows
+
+
+def _executemany_upsert(connection, table, rows, batch_size, report,
+                        change_log=None, replace_by=None):
+    keys = [column.name for column in table.primary_key.columns]
+    progress = Progress('{} upserted'.format(table.name), report)
+    # Values of replace_by whose rows were replaced by earlier batches
+    replaced = set()
+    for batch in batches(rows, batch_size):
+        columns = list(batch[0])
+        if _keyless_columns(table, columns, replace_by):
+            values = {row[replace_by] for row in batch
+                      if row[replace_by] is not None} - replaced
+            _replace_rows(connection, table, replace_by, values, change_log)
+            replaced |= values
+        if 'updated_at' in table.columns:
+            # Refresh the row version of updated rows, it has a default
+            columns.append('updated_at')
+        updates = [column for column in columns if column not in keys]
+        upsert = all(key in columns for key in keys) and updates
+        if connection.dialect.name == 'sqlite' and upsert:
+            statement = sqlite.insert(table)
+            statement = statement.on_conflict_do_update(
+                index_elements=keys,
+                set_={column: statement.excluded[column]
+                      for column in updates})
+        else:
+            statement = table.insert()
+
+        if change_log is None:
+            connection.execute(statement, batch)
+        elif all(key in columns for key in keys):
+            connection.execute(statement, batch)
+            _log_changes(connection, change_log, table,
+                         [[row[key] for key in keys] for row in batch])
+        else:
+            # Insert one row at a time to learn the generated keys
+            _log_changes(connection, change_log, table, [
+                connection.execute(statement, row).inserted_primary_key
+                for row in batch])
+        progress.add(len(batch))
+    return progress.rows
+
+
+def _replace_rows(connection, table, replace_by, values, change_log=None):
+    column = table.columns[replace_by]
+    # Chunks stay under the limit of bound parameters of SQLite
+    for chunk in batches(sorted(values), 500):
+        criterion = column.in_(chunk)
+        if change_log is not None:
+            _log_changes(connection, change_log, table, connection.execute(
+                select(*table.primary_key.columns).where(criterion)
+            ).fetchall(), 'delete')
+        connection.execute(table.delete().where(criterion))
+
+
+def _log_changes(connection, change_log, table, keys, operation='upsert'):
+    if not keys:
+        return
+    connection.execute(change_log.insert(), [
+        {'table_name': table.name,
+         'row_key': ','.join(str(value) for value in key),
+         'operation': operation}
+        for key in keys])
+
+
+"""
+Batch Requests
+"""
+
+
+def get_batch(req, name):
+    """Return the records of a batch request, or None if it is malformed.
+
+    The body is either a list of records or an object with the list under
+    the given name, holding between 1 and MAX_BATCH_SIZE records.
+    """
+    records = req.get(name) if isinstance(req, dict) else req
+    if not isinstance(records, list):
+        return None
+    if not 0 < len(records) <= MAX_BATCH_SIZE:
+        return None
+    return records
+
+
+def validate_record(record, fields):
+    """Return the row to insert and None, or None and the error."""
+    if not isinstance(record, dict):
+        return None, 'record must be an object'
+
+    row = {}
+    for name, (field_type, required) in fields.items():
+        value = record.get(name)
+        if value is None or value == '':
+            if required:
+                return None, 'missing {}'.format(name)
+            continue
+        if not isinstance(value, field_type) or isinstance(value, bool):
+            return None, 'invalid {}'.format(name)
+        row[name] = value
+    return row, None
@@ -0,0 +1,265 @@
+from collections import OrderedDict
+from functools import wraps
+import hashlib
+import json
+import os
+import threading
+import time
+
+from flask import current_app, g, make_response, request
+
+from conditional import not_modified
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+RESPONSE_CACHE = os.environ.get('RESPONSE_CACHE', 'lru')
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 60))
+RESPONSE_CACHE_URL = os.environ.get('RESPONSE_CACHE_URL')
+
+"""
+Cache Backends
+"""
+
+'''
+A cache backend stores bytes under string keys and supports get, set with a
+TTL in seconds, and incr, which atomically increments an integer counter.
+'''
+
+
+class LRUCache:
+    """In-process backend holding at most maxsize entries.
+
+    Counters are kept apart from the entries, so that they are never evicted.
+    """
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._counters:
+                return self._counters[key]
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+
+class LocalSharedClient:
+    """Local stand-in for a Redis client, e.g. in tests and development.
+
+    It implements the subset of the Redis commands used by SharedCache on
+    an in-process dictionary, so it is only shared within the process.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        expires_at = None if ex is None else time.monotonic() + ex
+        with self._lock:
+            self._data[key] = (value, expires_at)
+
+    def incr(self, key):
+        with self._lock:
+            value = int(self._data.get(key, (0, None))[0]) + 1
+            self._data[key] = (str(value).encode(), None)
+            return value
+
+
+class SharedCache:
+    """Backend shared by all the workers, stored in Redis."""
+
+    def __init__(self, client, prefix='hktm:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, value, ex=ttl)
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + key)
+
+
+"""
+Response Cache
+"""
+
+'''
+ResponseCache class that keeps the serialized JSON responses of read
+endpoints.
+(1) the key of a response is made of the path, the query string and the
+        digest of the request body, prefixed with the current data version
+        and with the database it is read from, a replica or the primary,
+(2) only 200 responses are stored, for at most ttl seconds, with their
+        ETag and Last-Modified headers, so that a conditional request is
+        answered with a 304 from the cache, without reading the row
+        versions; decorate the view with @conditional under @cached so
+        that the validators only run on a miss,
+(3) every write advances the data version, so that responses cached before
+        it are never served again and age out of the backend.
+The data version is read with get_version, e.g. the seq of the last change
+in the database, which every worker process reads alike whatever the
+backend. Without it, the version is a counter of the backend that
+bump_version increments, which is only seen by the processes sharing the
+backend.
+'''
+
+
+class ResponseCache:
+    VERSION_KEY = 'data_version'
+
+    def __init__(self, backend, ttl=RESPONSE_CACHE_TTL, get_version=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.get_version = get_version
+        self.endpoints = set()
+        self._stats_lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def version(self):
+        if self.get_version is not None:
+            return self.get_version()
+        return int(self.backend.get(self.VERSION_KEY) or 0)
+
+    def bump_version(self):
+        # A version read from the database advances with the write itself
+        if self.get_version is not None:
+            return self.get_version()
+        return self.backend.incr(self.VERSION_KEY)
+
+    def key(self, version):
+        args = sorted(request.args.items(multi=True))
+        body = hashlib.sha1(request.get_data()).hexdigest()
+        source = 'replica' if g.get('read_replica') else 'primary'
+        return 'response:{}:{}:{} {}?{}#{}'.format(
+            version, source, request.method, request.path, args, body)
+
+    VALIDATOR_HEADERS = ('ETag', 'Last-Modified')
+
+    def pack(self, response):
+        """Return the body of a response preceded by its validators."""
+        headers = {name: response.headers[name]
+                   for name in self.VALIDATOR_HEADERS
+                   if name in response.headers}
+        return json.dumps(headers).encode() + b'\n' + response.get_data()
+
+    def unpack(self, entry):
+        """Return the response of a cache entry, or a 304 if the client
+        already holds it."""
+        headers, body = entry.split(b'\n', 1)
+        response = current_app.response_class(
+            body, status=200, mimetype='application/json',
+            headers=json.loads(headers))
+        etag, _ = response.get_etag()
+        if etag is not None and not_modified(etag, response.last_modified):
+            return current_app.response_class(status=304,
+                                              headers=json.loads(headers))
+        return response
+
+    def cached(self, view):
+        """Decorate a read-only view to serve its responses from the cache."""
+        self.endpoints.add(view.__name__)
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = self.key(self.version())
+            entry = self.backend.get(key)
+            if entry is not None:
+                self._count('hits')
+                return self.unpack(entry)
+
+            self._count('misses')
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                self.backend.set(key, self.pack(response), self.ttl)
+            return response
+
+        return wrapper
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._stats, version=self.version())
+
+
+class NullResponseCache(ResponseCache):
+    """Response cache that stores nothing."""
+
+    def __init__(self):
+        super().__init__(backend=None, ttl=0)
+
+    def version(self):
+        return 0
+
+    def bump_version(self):
+        return 0
+
+    def cached(self, view):
+        self.endpoints.add(view.__name__)
+        return view
+
+
+def create_response_cache(config, get_version=None):
+    """Create the response cache configured by RESPONSE_CACHE: lru, shared
+    or none, whose data version is read with get_version."""
+    kind = config.get('RESPONSE_CACHE', RESPONSE_CACHE)
+    ttl = config.get('RESPONSE_CACHE_TTL', RESPONSE_CACHE_TTL)
+    if kind == 'none':
+        return NullResponseCache()
+    if kind == 'lru':
+        size = config.get('RESPONSE_CACHE_SIZE', RESPONSE_CACHE_SIZE)
+        return ResponseCache(LRUCache(size), ttl, get_version)
+    if kind == 'shared':
+        url = config.get('RESPONSE_CACHE_URL', RESPONSE_CACHE_URL)
+        if url is None:
+            return ResponseCache(SharedCache(LocalSharedClient()), ttl,
+                                 get_version)
+        if redis is None:
+            raise RuntimeError('RESPONSE_CACHE_URL requires redis-py.')
+        return ResponseCache(SharedCache(redis.Redis.from_url(url)), ttl,
+                             get_version)
+    raise ValueError('Unknown response cache: {}'.format(kind))
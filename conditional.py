@@ -0,0 +1,64 @@
+from functools import wraps
+import hashlib
+
+from flask import current_app, make_response, request
+
+"""
+Conditional Requests
+"""
+
+
+def make_etag(*parts):
+    """Return an entity tag made of the digest of the given values."""
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+'''
+not_modified function that tells whether the client already holds the
+current representation:
+(1) If-None-Match matches the entity tag, with the weak comparison,
+(2) otherwise, without If-None-Match, If-Modified-Since is not older than the
+        last modification, at the one second precision of HTTP dates.
+'''
+
+
+def not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since is None or last_modified is None:
+        return False
+    return (request.if_modified_since.replace(tzinfo=None) >=
+            last_modified.replace(microsecond=0, tzinfo=None))
+
+
+'''
+conditional decorator for read endpoints. get_validators is called with the
+arguments of the view and returns the entity tag and the last modification
+time of the resource, in UTC, or None to skip validation. It is expected to
+read row versions only, so that a 304 is answered without loading or
+serializing the resource.
+'''
+
+
+def conditional(get_validators):
+    def conditional_decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            validators = get_validators(*args, **kwargs)
+            if validators is None:
+                return view(*args, **kwargs)
+
+            etag, last_modified = validators
+            if not_modified(etag, last_modified):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            return response
+
+        return wrapper
+    return conditional_decorator
@@ -0,0 +1,95 @@
+import csv
+import io
+import json
+import os
+import zlib
+
+# Rows fetched from the server-side cursor at a time
+EXPORT_FETCH_SIZE = int(os.environ.get('EXPORT_FETCH_SIZE', 1000))
+# Bytes of text buffered before a chunk of the response is sent
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+"""
+Exporting
+"""
+
+'''
+merge_children function that pairs each parent with the list of its children
+in a single pass over two streams of rows, e.g. trademarks and specifications.
+(1) both streams are ordered by the key in the database, so that the children
+        of a parent come in one run,
+(2) every child has a parent, so the run of a parent is made of the children
+        whose key equals its key; keys are only compared for equality, which
+        does not depend on the collation the database sorted them with.
+Only the children of the current parent are held in memory.
+'''
+
+
+def merge_children(parents, children, parent_key, child_key):
+    children = iter(children)
+    child = next(children, None)
+    for parent in parents:
+        run = []
+        while child is not None and child_key(child) == parent_key(parent):
+            run.append(child)
+            child = next(children, None)
+        yield parent, run
+
+
+def _compact_dumps(record):
+    return json.dumps(record, separators=(',', ':')).encode()
+
+
+def _ndjson_chunks(records, dumps):
+    lines = []
+    size = 0
+    for record in records:
+        line = dumps(record) + b'\n'
+        lines.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_SIZE:
+            yield b''.join(lines)
+            lines = []
+            size = 0
+    if lines:
+        yield b''.join(lines)
+
+
+def _csv_chunks(records, fieldnames):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames)
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def export_lines(records, fieldnames, file_format, dumps=_compact_dumps):
+    """Yield the records, one dict each, as chunks of NDJSON or CSV bytes.
+
+    dumps encodes a record into a line of JSON bytes, e.g. with the JSON
+    backend of the app.
+    """
+    if file_format == 'csv':
+        return _csv_chunks(records, fieldnames)
+    return _ndjson_chunks(records, dumps)
+
+
+def gzip_chunks(chunks):
+    """Compress chunks of bytes into a gzip stream as they come."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,110 @@
+from models import Trademark, Spec
+
+"""
+Trademark Filters
+"""
+
+'''
+The list and search endpoints narrow the trademarks with typed filters in
+the request arguments. Each filter is compiled to a clause that an index of
+the migrations serves:
+    status=Registered         trademarks (status, app_no)
+    type=Word                 trademarks (type, app_no)
+    class_no=9                EXISTS on specs (class_no, tm_app_no)
+    owner=Apple               ILIKE, trigram index on trademarks.owners
+status, type and class_no take comma-separated values, any of which match.
+Filters are combined with AND.
+'''
+
+
+def _values(value, convert=str):
+    values = [item.strip() for item in value.split(',') if item.strip()]
+    if not values:
+        raise ValueError('Empty filter.')
+    return [convert(item) for item in values]
+
+
+def filter_status(value, search):
+    return Trademark.status.in_(_values(value))
+
+
+def filter_type(value, search):
+    return Trademark.type.in_(_values(value))
+
+
+def filter_class_no(value, search):
+    # A trademark matches once, however many of its specifications do
+    return Trademark.specs.any(Spec.class_no.in_(_values(value, int)))
+
+
+def filter_owner(value, search):
+    if not value.strip():
+        raise ValueError('Empty filter.')
+    return search.match(Trademark.owners, value.strip())
+
+
+TRADEMARK_FILTERS = {
+    'status': filter_status,
+    'type': filter_type,
+    'class_no': filter_class_no,
+    'owner': filter_owner,
+}
+
+
+'''
+get_filters function that
+(1) reads the filters present in args, the request arguments or the filters
+        of a JSON body, whose values may also be numbers or lists, in a fixed
+        order,
+(2) returns their clauses and the (name, value) pairs that identify them,
+        e.g. in the entity tag of a page.
+It raises ValueError if a filter is empty or a value has the wrong type.
+'''
+
+
+def get_filters(args, search):
+    clauses, applied = [], []
+    for name, make_clause in TRADEMARK_FILTERS.items():
+        value = args.get(name)
+        if value is None:
+            continue
+        if isinstance(value, list):
+            value = ','.join(str(item) for item in value)
+        try:
+            clauses.append(make_clause(str(value), search))
+        except (TypeError, ValueError):
+            raise ValueError('Invalid filter: {}.'.format(name))
+        applied.append((name, value))
+    return clauses, tuple(applied)
+
+
+"""
+Trademark Sorting
+"""
+
+'''
+Only the sort keys below are accepted, each ordered by an index: app_no by
+the primary key, name by trademarks (name, app_no). Ties on name are broken
+by app_no so that pages are stable. A descending key starts with "-". The
+cursor of a page only seeks on app_no, so it requires the default sort.
+'''
+
+DEFAULT_SORT = 'app_no'
+
+TRADEMARK_SORTS = {
+    'app_no': (Trademark.app_no,),
+    '-app_no': (Trademark.app_no.desc(),),
+    'name': (Trademark.name, Trademark.app_no),
+    '-name': (Trademark.name.desc(), Trademark.app_no.desc()),
+}
+
+
+def get_sort(request, default=DEFAULT_SORT):
+    """Return the name and the ORDER BY clauses of the requested sort.
+
+    It raises ValueError if the sort key is not whitelisted.
+    """
+    name = request.args.get('sort', default)
+    if name not in TRADEMARK_SORTS:
+        raise ValueError('Invalid sort: {}.'.format(name))
+    return name, TRADEMARK_SORTS[name]
@@ -0,0 +1,43 @@
+import multiprocessing
+import os
+
+"""
+Gunicorn Config
+"""
+
+'''
+Serving modes, selected with WEB_WORKER_CLASS:
+(1) gthread (default): each worker process serves WEB_THREADS requests at a
+        time in threads, so that a request waiting on the database or on the
+        JWKS endpoint only holds its thread,
+(2) gevent: each worker serves up to WEB_WORKER_CONNECTIONS requests in
+        greenlets; requires gevent and psycogreen, which makes psycopg2 yield
+        to the other greenlets instead of blocking the worker on queries,
+(3) sync: one request at a time per worker, as before.
+Sessions are scoped to the request's thread or greenlet by Flask-SQLAlchemy
+and removed at the end of each request. The app is not preloaded, so that
+every worker opens its own database connections after the fork.
+'''
+
+worker_class = os.environ.get('WEB_WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('WEB_CONCURRENCY',
+                             multiprocessing.cpu_count() * 2 + 1))
+# Gunicorn turns sync workers into gthread workers when threads > 1
+threads = (int(os.environ.get('WEB_THREADS', 8))
+           if worker_class == 'gthread' else 1)
+worker_connections = int(os.environ.get('WEB_WORKER_CONNECTIONS', 100))
+timeout = int(os.environ.get('WEB_TIMEOUT', 30))
+keepalive = int(os.environ.get('WEB_KEEPALIVE', 5))
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', 8000))
+preload_app = False
+
+
+def post_fork(server, worker):
+    if worker_class != 'gevent':
+        return
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        raise RuntimeError('WEB_WORKER_CLASS=gevent requires psycogreen.')
+    patch_psycopg()
+    server.log.info('Worker %s: psycopg2 patched for gevent', worker.pid)
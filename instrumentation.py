@@ -0,0 +1,369 @@
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import bisect
+import logging
+import os
+import threading
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.exceptions import HTTPException
+
+# "true" records the SQL, serialization and total time of every request
+INSTRUMENTATION = os.environ.get('INSTRUMENTATION', 'false')
+# Executions of the same statement in one request reported as N+1 queries
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 5))
+
+# Client errors answered by the blanket "except Exception" blocks of the
+# views, which are counted as swallowed errors like server errors are
+SWALLOWED_ERROR_STATUSES = (404, 422)
+
+# Upper bounds in seconds of the buckets of the request latency histogram
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+logger = logging.getLogger(__name__)
+
+"""
+Request Profiles
+"""
+
+'''
+A RequestProfile is kept in flask.g while an instrumented app handles a
+request. It counts the SQL statements executed for the request and the time
+spent executing them, and the time of named phases, e.g. "load" for loading
+the rows of a page and "format" for turning them into dicts.
+'''
+
+
+class RequestProfile:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.statements = Counter()
+        self.timings = defaultdict(float)
+
+    def record_query(self, statement, seconds):
+        self.queries += 1
+        self.sql_seconds += seconds
+        self.statements[statement] += 1
+
+    def repeated_statements(self, threshold):
+        return [(statement, count)
+                for statement, count in self.statements.items()
+                if count >= threshold]
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self, total):
+        """Return the value of the Server-Timing header, in milliseconds."""
+        metrics = ['sql;dur={:.2f};desc="{} queries"'.format(
+            self.sql_seconds * 1000, self.queries)]
+        metrics.extend('{};dur={:.2f}'.format(name, seconds * 1000)
+                       for name, seconds in self.timings.items())
+        metrics.append('total;dur={:.2f}'.format(total * 1000))
+        return ', '.join(metrics)
+
+
+def current_profile():
+    """Return the profile of the current request, or None."""
+    if not has_request_context():
+        return None
+    return g.get('profile')
+
+
+@contextmanager
+def timing(name):
+    """Add the time spent in the block to a phase of the request profile."""
+    profile = current_profile()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.timings[name] += time.perf_counter() - started
+
+
+'''
+Engine events record the statements of every engine, the primary and the
+replicas, into the profile of the current request. They are only listened
+to once an app is instrumented, and statements executed outside of an
+instrumented request are ignored.
+'''
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if current_profile() is not None:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    profile = current_profile()
+    started = conn.info.get('query_started')
+    if profile is not None and started:
+        profile.record_query(statement, time.perf_counter() - started.pop())
+
+
+def listen_to_engines():
+    for name, listener in (('before_cursor_execute', _before_cursor_execute),
+                           ('after_cursor_execute', _after_cursor_execute)):
+        if not event.contains(Engine, name, listener):
+            event.listen(Engine, name, listener)
+
+
+class TimedJSONBackend:
+    """JSON backend that adds its encoding time to the request profile."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.name = backend.name
+
+    def dumps(self, payload):
+        with timing('serialize'):
+            return self.backend.dumps(payload)
+
+
+"""
+Metrics
+"""
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _labels(**labels):
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value))
+                          for name, value in labels.items()) + '}'
+
+
+class RequestMetrics:
+    """Counters of the requests of a worker process, safe to update from
+    threads, rendered in the Prometheus text format."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.requests = Counter()
+        self.latency_buckets = defaultdict(lambda: [0] * len(buckets))
+        self.latency_sum = Counter()
+        self.latency_count = Counter()
+        self.queries = Counter()
+        self.sql_seconds = Counter()
+        self.serialize_seconds = Counter()
+        self.n_plus_one = Counter()
+        self.swallowed_errors = Counter()
+
+    def record_request(self, endpoint, method, status, profile, total):
+        with self._lock:
+            self.requests[endpoint, method, status] += 1
+            index = bisect.bisect_left(self.buckets, total)
+            if index < len(self.buckets):
+                self.latency_buckets[endpoint][index] += 1
+            self.latency_sum[endpoint] += total
+            self.latency_count[endpoint] += 1
+            self.queries[endpoint] += profile.queries
+            self.sql_seconds[endpoint] += profile.sql_seconds
+            self.serialize_seconds[endpoint] += profile.timings.get(
+                'serialize', 0.0)
+
+    def record_n_plus_one(self, endpoint):
+        with self._lock:
+            self.n_plus_one[endpoint] += 1
+
+    def record_swallowed_error(self, endpoint, exception):
+        with self._lock:
+            self.swallowed_errors[endpoint, exception] += 1
+
+    def render(self, pools=None):
+        """Return the metrics, and the state of the given pools by database
+        name, see pool.pool_stats, in the Prometheus text format."""
+        lines = []
+
+        def family(name, kind, description, samples):
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            lines.extend('{}{} {}'.format(name, labels, value)
+                         for labels, value in samples)
+
+        with self._lock:
+            family('hktm_requests_total', 'counter',
+                   'Requests handled by endpoint, method and status.',
+                   [(_labels(endpoint=endpoint, method=method,
+                             status=status), count)
+                    for (endpoint, method, status), count
+                    in sorted(self.requests.items())])
+
+            latency = []
+            for endpoint in sorted(self.latency_count):
+                cumulative = 0
+                for bound, count in zip(self.buckets,
+                                        self.latency_buckets[endpoint]):
+                    cumulative += count
+                    latency.append(('_bucket' + _labels(
+                        endpoint=endpoint, le=bound), cumulative))
+                latency.append(('_bucket' + _labels(
+                    endpoint=endpoint, le='+Inf'),
+                    self.latency_count[endpoint]))
+                latency.append(('_sum' + _labels(endpoint=endpoint),
+                                round(self.latency_sum[endpoint], 6)))
+                latency.append(('_count' + _labels(endpoint=endpoint),
+                                self.latency_count[endpoint]))
+            family('hktm_request_duration_seconds', 'histogram',
+                   'Time to handle a request, by endpoint.', latency)
+
+            for name, description, counter in (
+                    ('hktm_db_queries_total',
+                     'SQL statements executed, by endpoint.', self.queries),
+                    ('hktm_db_query_seconds_total',
+                     'Time spent executing SQL, by endpoint.',
+                     self.sql_seconds),
+                    ('hktm_serialize_seconds_total',
+                     'Time spent encoding JSON, by endpoint.',
+                     self.serialize_seconds),
+                    ('hktm_n_plus_one_total',
+                     'Requests that repeated a statement at least '
+                     'N_PLUS_ONE_THRESHOLD times, by endpoint.',
+                     self.n_plus_one)):
+                family(name, 'counter', description,
+                       [(_labels(endpoint=endpoint), round(value, 6))
+                        for endpoint, value in sorted(counter.items())])
+
+            family('hktm_swallowed_errors_total', 'counter',
+                   'Exceptions turned into an error response by a view, by '
+                   'endpoint and exception.',
+                   [(_labels(endpoint=endpoint, exception=exception), count)
+                    for (endpoint, exception), count
+                    in sorted(self.swallowed_errors.items())])
+
+        for key, kind in (('size', 'gauge'), ('checked_out', 'gauge'),
+                          ('overflow', 'gauge'), ('checkouts', 'counter'),
+                          ('overflow_checkouts', 'counter'),
+                          ('timeouts', 'counter'),
+                          ('wait_seconds_total', 'counter'),
+                          ('wait_seconds_max', 'gauge')):
+            samples = [(_labels(database=database), stats[key])
+                       for database, stats in sorted((pools or {}).items())
+                       if key in stats]
+            if samples:
+                name = 'hktm_db_pool_' + key
+                if kind == 'counter' and not key.endswith('_total'):
+                    name += '_total'
+                family(name, kind, 'Connection pool {}, see GET '
+                       '/health.'.format(key.replace('_', ' ')), samples)
+
+        return '\n'.join(lines) + '\n'
+
+
+"""
+Instrumentation
+"""
+
+'''
+Instrumentation class that profiles every request of an app:
+(1) before the request, a RequestProfile is put in flask.g,
+(2) SQL statements are counted and timed with engine events, and the JSON
+        backend of the app is wrapped to time the encoding of responses,
+(3) after the request, the profile is returned in the Server-Timing header,
+        added to the metrics, and a warning is logged for every statement
+        executed at least n_plus_one_threshold times, the sign of rows
+        loaded one at a time. The body of a streamed response, e.g. an
+        export, is encoded while it is sent, so its profile stays current
+        until then and is added to the metrics once the response is closed,
+(4) exceptions that a view turned into an error response with abort() are
+        logged and counted, since the views do not report them, unless the
+        response is a validation error, i.e. a client error other than
+        those of SWALLOWED_ERROR_STATUSES, or one caused by a ValueError.
+The Server-Timing header of streamed responses does not include sending
+the body, their metrics do.
+'''
+
+
+class Instrumentation:
+    def __init__(self, n_plus_one_threshold=N_PLUS_ONE_THRESHOLD):
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.metrics = RequestMetrics()
+
+    def init_app(self, app):
+        app.extensions['instrumentation'] = self
+        app.extensions['json_backend'] = TimedJSONBackend(
+            app.extensions['json_backend'])
+        listen_to_engines()
+        app.before_request(self.start_profile)
+        app.after_request(self.finish_profile)
+
+        handle_http_exception = app.handle_http_exception
+
+        def handle_and_record(error):
+            self.record_error(error)
+            return handle_http_exception(error)
+
+        app.handle_http_exception = handle_and_record
+
+    def start_profile(self):
+        g.profile = RequestProfile()
+
+    def finish_profile(self, response):
+        profile = g.get('profile')
+        if profile is None:
+            return response
+
+        response.headers['Server-Timing'] = profile.server_timing(
+            profile.elapsed())
+        endpoint = request.endpoint or 'none'
+        method, status = request.method, response.status_code
+        if response.is_streamed:
+            response.call_on_close(lambda: self.record_profile(
+                endpoint, method, status, profile))
+        else:
+            g.pop('profile')
+            self.record_profile(endpoint, method, status, profile)
+        return response
+
+    def record_profile(self, endpoint, method, status, profile):
+        self.metrics.record_request(endpoint, method, status, profile,
+                                    profile.elapsed())
+        repeated = profile.repeated_statements(self.n_plus_one_threshold)
+        if repeated:
+            self.metrics.record_n_plus_one(endpoint)
+        for statement, count in repeated:
+            logger.warning('Possible N+1 queries in %s: %d executions of %s',
+                           endpoint, count, ' '.join(statement.split()))
+
+    def record_error(self, error):
+        cause = error.__context__
+        if cause is None or isinstance(cause, HTTPException):
+            return
+        code = error.code or 500
+        if code < 500 and (code not in SWALLOWED_ERROR_STATUSES or
+                           isinstance(cause, ValueError)):
+            return
+        endpoint = request.endpoint or 'none'
+        self.metrics.record_swallowed_error(endpoint, type(cause).__name__)
+        logger.warning('%s answered %s after an exception', endpoint,
+                       error.code, exc_info=(type(cause), cause,
+                                             cause.__traceback__))
+
+
+def setup_instrumentation(app):
+    """Instrument the app if INSTRUMENTATION is enabled, and return the
+    Instrumentation or None."""
+    enabled = app.config.get('INSTRUMENTATION', INSTRUMENTATION)
+    if isinstance(enabled, str):
+        enabled = enabled.lower() == 'true'
+    if not enabled:
+        return None
+
+    instrumentation = Instrumentation(app.config.get(
+        'N_PLUS_ONE_THRESHOLD', N_PLUS_ONE_THRESHOLD))
+    instrumentation.init_app(app)
+    return instrumentation
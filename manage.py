@@ -2,12 +2,44 @@ from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
-from models import db
+from bulk import DEFAULT_BATCH_SIZE, import_records, read_records
+from models import db, Trademark, Spec, RowCount, Change
 
 migrate = Migrate(app, db)
 manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
+
+@manager.option('-t', '--trademarks', dest='trademarks', default=None,
+                help='CSV or JSONL export of trademarks')
+@manager.option('-s', '--specs', dest='specs', default=None,
+                help='CSV or JSONL export of class specifications')
+@manager.option('-f', '--format', dest='file_format', default=None,
+                choices=['csv', 'jsonl'],
+                help='format of the exports, guessed from the file extension '
+                     'by default')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                default=DEFAULT_BATCH_SIZE,
+                help='number of records held in memory and sent at a time')
+def import_register(trademarks=None, specs=None, file_format=None,
+                    batch_size=DEFAULT_BATCH_SIZE):
+    """Bulk load trademarks and specifications, updating existing rows.
+
+    The rows are logged in the change log, which advances the data version
+    of the response caches of the running servers. Specifications without
+    an id replace all the specifications of their trademarks.
+    """
+    # Trademarks go first, specifications reference them
+    for path, model, replace_by in [(trademarks, Trademark, None),
+                                    (specs, Spec, 'tm_app_no')]:
+        if path is None:
+            continue
+        import_records(db.engine, model.__table__,
+                       read_records(path, file_format), batch_size,
+                       change_log=Change.__table__, replace_by=replace_by)
+        RowCount.refresh(model.__tablename__)
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,37 @@
+"""add trigram search indexes
+
+Revision ID: 3b8e5f0a9c41
+Revises: 68f91cd0b91d
+Create Date: 2026-10-16 09:12:31.402118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b8e5f0a9c41'
+down_revision = '68f91cd0b91d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    # Build the indexes without blocking writes on the register tables
+    with op.get_context().autocommit_block():
+        op.create_index('ix_trademarks_name_trgm', 'trademarks', ['name'],
+                        unique=False,
+                        postgresql_using='gin',
+                        postgresql_ops={'name': 'gin_trgm_ops'},
+                        postgresql_concurrently=True)
+        op.create_index('ix_specs_class_spec_trgm', 'specs', ['class_spec'],
+                        unique=False,
+                        postgresql_using='gin',
+                        postgresql_ops={'class_spec': 'gin_trgm_ops'},
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    op.drop_index('ix_specs_class_spec_trgm', table_name='specs')
+    op.drop_index('ix_trademarks_name_trgm', table_name='trademarks')
@@ -0,0 +1,31 @@
+"""add changes
+
+Revision ID: 4f7a2c9d1b36
+Revises: c51f8e2d7a90
+Create Date: 2026-10-16 15:21:40.573012
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4f7a2c9d1b36'
+down_revision = 'c51f8e2d7a90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('changes',
+    sa.Column('seq', sa.BigInteger(), nullable=False),
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('row_key', sa.String(), nullable=False),
+    sa.Column('operation', sa.String(), nullable=False),
+    sa.Column('changed_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('seq')
+    )
+
+
+def downgrade():
+    op.drop_table('changes')
@@ -0,0 +1,49 @@
+"""add query indexes
+
+Revision ID: 7e3b9a1c5d28
+Revises: 4f7a2c9d1b36
+Create Date: 2026-10-16 16:21:48.913207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e3b9a1c5d28'
+down_revision = '4f7a2c9d1b36'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Build the indexes without blocking writes on the register tables
+    with op.get_context().autocommit_block():
+        op.create_index('ix_specs_tm_app_no', 'specs', ['tm_app_no'],
+                        unique=False,
+                        postgresql_concurrently=True)
+        op.create_index('ix_specs_class_no_tm_app_no', 'specs',
+                        ['class_no', 'tm_app_no'],
+                        unique=False,
+                        postgresql_concurrently=True)
+        op.create_index('ix_trademarks_status_app_no', 'trademarks',
+                        ['status', 'app_no'],
+                        unique=False,
+                        postgresql_concurrently=True)
+        op.create_index('ix_trademarks_type_app_no', 'trademarks',
+                        ['type', 'app_no'],
+                        unique=False,
+                        postgresql_concurrently=True)
+        op.create_index('ix_trademarks_owners_trgm', 'trademarks', ['owners'],
+                        unique=False,
+                        postgresql_using='gin',
+                        postgresql_ops={'owners': 'gin_trgm_ops'},
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    op.drop_index('ix_trademarks_owners_trgm', table_name='trademarks')
+    op.drop_index('ix_trademarks_type_app_no', table_name='trademarks')
+    op.drop_index('ix_trademarks_status_app_no', table_name='trademarks')
+    op.drop_index('ix_specs_class_no_tm_app_no', table_name='specs')
+    op.drop_index('ix_specs_tm_app_no', table_name='specs')
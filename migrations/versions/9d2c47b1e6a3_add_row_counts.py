@@ -0,0 +1,32 @@
+"""add row counts
+
+Revision ID: 9d2c47b1e6a3
+Revises: 3b8e5f0a9c41
+Create Date: 2026-10-16 11:03:52.918254
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d2c47b1e6a3'
+down_revision = '3b8e5f0a9c41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('row_counts',
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('total', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('table_name')
+    )
+    op.execute("INSERT INTO row_counts (table_name, total) "
+               "SELECT 'trademarks', count(*) FROM trademarks")
+    op.execute("INSERT INTO row_counts (table_name, total) "
+               "SELECT 'specs', count(*) FROM specs")
+
+
+def downgrade():
+    op.drop_table('row_counts')
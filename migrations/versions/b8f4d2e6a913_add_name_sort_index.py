@@ -0,0 +1,29 @@
+"""add name sort index
+
+Revision ID: b8f4d2e6a913
+Revises: 7e3b9a1c5d28
+Create Date: 2026-10-16 17:05:12.640391
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8f4d2e6a913'
+down_revision = '7e3b9a1c5d28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Build the index without blocking writes on the register tables
+    with op.get_context().autocommit_block():
+        op.create_index('ix_trademarks_name_app_no', 'trademarks',
+                        ['name', 'app_no'],
+                        unique=False,
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    op.drop_index('ix_trademarks_name_app_no', table_name='trademarks')
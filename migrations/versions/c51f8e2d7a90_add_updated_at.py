@@ -0,0 +1,31 @@
+"""add updated_at
+
+Revision ID: c51f8e2d7a90
+Revises: 9d2c47b1e6a3
+Create Date: 2026-10-16 13:47:05.226731
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c51f8e2d7a90'
+down_revision = '9d2c47b1e6a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The server default fills the existing rows
+    op.add_column('trademarks', sa.Column(
+        'updated_at', sa.DateTime(), nullable=False,
+        server_default=sa.text("timezone('utc', now())")))
+    op.add_column('specs', sa.Column(
+        'updated_at', sa.DateTime(), nullable=False,
+        server_default=sa.text("timezone('utc', now())")))
+
+
+def downgrade():
+    op.drop_column('specs', 'updated_at')
+    op.drop_column('trademarks', 'updated_at')
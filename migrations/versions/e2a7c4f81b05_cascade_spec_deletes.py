@@ -0,0 +1,35 @@
+"""cascade spec deletes
+
+Revision ID: e2a7c4f81b05
+Revises: b8f4d2e6a913
+Create Date: 2026-10-16 18:32:57.118604
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2a7c4f81b05'
+down_revision = 'b8f4d2e6a913'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Replace the constraint without checking the existing rows, which the
+    # previous constraint already enforced, then validate them without
+    # blocking writes on specs
+    op.drop_constraint('specs_tm_app_no_fkey', 'specs', type_='foreignkey')
+    op.execute('ALTER TABLE specs ADD CONSTRAINT specs_tm_app_no_fkey '
+               'FOREIGN KEY (tm_app_no) REFERENCES trademarks (app_no) '
+               'ON DELETE CASCADE NOT VALID')
+    with op.get_context().autocommit_block():
+        op.execute('ALTER TABLE specs VALIDATE CONSTRAINT '
+                   'specs_tm_app_no_fkey')
+
+
+def downgrade():
+    op.drop_constraint('specs_tm_app_no_fkey', 'specs', type_='foreignkey')
+    op.create_foreign_key('specs_tm_app_no_fkey', 'specs', 'trademarks',
+                          ['tm_app_no'], ['app_no'])
@@ -1,8 +1,28 @@
 import os
 import json
+from datetime import datetime
 
-from sqlalchemy import Column, String, Integer, ForeignKey, create_engine
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    String,
+    Integer,
+    ForeignKey,
+    Index,
+    cast,
+    create_engine,
+    event,
+    func,
+    inspect,
+    literal,
+    select,
+    text
+)
+from sqlalchemy.exc import IntegrityError
+
+from pool import engine_options
+from replicas import DATABASE_REPLICA_URLS, RoutingSQLAlchemy, replica_binds
 
 # Connect the local postgres database
 database_name = "hktm"
@@ -12,21 +32,56 @@ database_path = "postgresql://{}/{}".format(
 # Connect the postgres database on Heroku
 # database_path = "postgresql" + os.environ['DATABASE_URL'][8:]
 
-db = SQLAlchemy()
+# "counter" reads totals from the row_counts table, "estimate" reads the
+# planner's row estimate of unfiltered tables on PostgreSQL instead
+ROW_COUNT_MODE = os.environ.get('ROW_COUNT_MODE', 'counter')
+
+db = RoutingSQLAlchemy()
+
 
+def get_database_path(config):
+    """Return the DATABASE_PATH of the app config or of the environment, e.g.
+    a synthetic register for benchmarks, or the database above."""
+    return config.get("DATABASE_PATH",
+                      os.environ.get("DATABASE_PATH", database_path))
 
-def setup_db(app, database_path=database_path):
+
+def setup_db(app, database_path=None, replica_paths=None):
+    if database_path is None:
+        database_path = get_database_path(app.config)
+    if replica_paths is None:
+        replica_paths = app.config.get("DATABASE_REPLICA_URLS",
+                                       DATABASE_REPLICA_URLS)
+    binds = replica_binds(replica_paths)
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    app.config["SQLALCHEMY_BINDS"] = binds
+    app.config["REPLICA_BINDS"] = sorted(binds)
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config,
+                                                             database_path)
     db.app = app
     db.init_app(app)
+    if db.engine.dialect.name == 'sqlite':
+        event.listen(db.engine, 'connect', enable_foreign_keys)
     db.create_all()
     return db
 
 
+def enable_foreign_keys(dbapi_connection, connection_record):
+    # SQLite only enforces foreign keys, and their ON DELETE CASCADE, on the
+    # connections that enable them
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.close()
+
+
 class helperMethodsClass(db.Model):
     __abstract__ = True
 
+    # Row version, set in UTC whenever a row is inserted or updated
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow,
+                        onupdate=datetime.utcnow)
+
     def insert(self):
         db.session.add(self)
         db.session.commit()
@@ -46,6 +101,14 @@ Trademark
 
 class Trademark(helperMethodsClass):
     __tablename__ = "trademarks"
+    # Filters on status and type keep the pages in app_no order, and pages
+    # sorted by name are read in the order of the name index. The trigram
+    # indexes on name and owners are created by the migrations
+    __table_args__ = (
+        Index("ix_trademarks_status_app_no", "status", "app_no"),
+        Index("ix_trademarks_type_app_no", "type", "app_no"),
+        Index("ix_trademarks_name_app_no", "name", "app_no"),
+    )
 
     app_no = Column(String, primary_key=True)
     name = Column(String, nullable=False)
@@ -54,10 +117,13 @@ class Trademark(helperMethodsClass):
     applicant = Column(String, nullable=True)
     type = Column(String, nullable=True)
     trademark_id = Column(String, nullable=True)
+    # Specifications are deleted by the ON DELETE CASCADE of their foreign
+    # key, without being loaded, see log_cascaded_deletes
     specs = db.relationship("Spec",
                             backref="trademark",
                             lazy=True,
-                            cascade="all,delete")
+                            cascade="all,delete",
+                            passive_deletes=True)
 
     def format(self):
         return {
@@ -78,6 +144,43 @@ class Trademark(helperMethodsClass):
             "trademark_id": self.trademark_id
         }
 
+    def details(self):
+        return {
+            "app_no": self.app_no,
+            "name": self.name,
+            "status": self.status,
+            "owners": self.owners,
+            "applicant": self.applicant,
+            "type": self.type,
+            "id": self.trademark_id,
+            "class_numbers_and_specifications": {
+                spec.class_no: spec.class_spec for spec in self.specs
+            }
+        }
+
+    @classmethod
+    def delete_matching(cls, *criteria):
+        """Delete the trademarks matching the criteria and, by the ON DELETE
+        CASCADE of the foreign key, their specifications, in set-based
+        statements that bypass the session.
+
+        The deletes are logged and counted in the same transaction, which the
+        caller commits. Returns the numbers of deleted trademarks and
+        specifications.
+        """
+        Change.lock()
+        matching = select(cls.app_no).where(*criteria)
+        specs = Change.record_matching(Spec.__tablename__, Spec.id,
+                                       [Spec.tm_app_no.in_(matching)],
+                                       'delete')
+        Change.record_matching(cls.__tablename__, cls.app_no, criteria,
+                               'delete')
+        trademarks = db.session.execute(
+            cls.__table__.delete().where(*criteria)).rowcount
+        RowCount.adjust(cls.__tablename__, -trademarks)
+        RowCount.adjust(Spec.__tablename__, -specs)
+        return trademarks, specs
+
 
 '''
 Trademark Class Specifications
@@ -86,11 +189,16 @@ Trademark Class Specifications
 
 class Spec(helperMethodsClass):
     __tablename__ = "specs"
+    __table_args__ = (
+        Index("ix_specs_class_no_tm_app_no", "class_no", "tm_app_no"),
+    )
 
     id = Column(Integer, primary_key=True)
     class_no = Column(Integer, nullable=False)
     class_spec = Column(String, nullable=False)
-    tm_app_no = Column(String, ForeignKey("trademarks.app_no"), nullable=True)
+    tm_app_no = Column(String,
+                       ForeignKey("trademarks.app_no", ondelete="CASCADE"),
+                       nullable=True, index=True)
 
     def format(self):
         return {
@@ -99,3 +207,263 @@ class Spec(helperMethodsClass):
             "class_spec": self.class_spec,
             "tm_app_no": self.tm_app_no
         }
+
+    @classmethod
+    def insert_many(cls, rows):
+        """Insert the rows, which have the same keys, in one statement that
+        bypasses the session, and return their generated ids.
+
+        PostgreSQL returns the ids of a multi-row INSERT. SQLite inserts the
+        rows with executemany, under the write lock of the database that the
+        transaction holds from then on, so they get the greatest ids.
+        """
+        if not rows:
+            return []
+        if db.session.connection().dialect.name == 'postgresql':
+            return [spec_id for spec_id, in db.session.execute(
+                cls.__table__.insert().values(rows).returning(cls.id))]
+
+        db.session.execute(cls.__table__.insert(), rows)
+        latest = db.session.query(cls.id).order_by(cls.id.desc()).limit(
+            len(rows))
+        return sorted(spec_id for spec_id, in latest)
+
+
+"""
+Row Counts
+"""
+
+
+class RowCount(db.Model):
+    """Number of rows of a table, kept up to date by the model helpers.
+
+    Rows added or deleted through the session, including deletes cascaded
+    from a trademark to its specifications, are counted in the same
+    transaction by the flush hooks below. Writes that bypass the session,
+    such as bulk inserts and deletes, call adjust() or refresh()
+    themselves.
+    """
+    __tablename__ = "row_counts"
+
+    table_name = Column(String, primary_key=True)
+    total = Column(BigInteger, nullable=False)
+
+    @classmethod
+    def adjust(cls, table_name, delta, session=None):
+        if not delta:
+            return
+        (session or db.session).execute(
+            cls.__table__.update()
+            .where(cls.table_name == table_name)
+            .values(total=cls.total + delta))
+
+    @classmethod
+    def refresh(cls, table_name):
+        """Count the rows of the table and store the total.
+
+        The counter is locked before the rows are counted. A write that has
+        already adjusted it is waited for and counted, and one that adjusts
+        it later adds its delta to the new total. A missing counter is
+        created, or locked once a concurrent refresh has created it.
+        """
+        table = db.metadata.tables[table_name]
+        counter = db.session.query(cls).filter(
+            cls.table_name == table_name).with_for_update().one_or_none()
+        total = db.session.query(func.count()).select_from(table).scalar()
+        if counter is not None:
+            counter.total = total
+        else:
+            try:
+                with db.session.begin_nested():
+                    db.session.add(cls(table_name=table_name, total=total))
+            except IntegrityError:
+                return cls.refresh(table_name)
+        db.session.commit()
+        return total
+
+    @classmethod
+    def get(cls, table_name, count=None):
+        """Return the number of rows of the table.
+
+        Reads may run on a replica, so a missing counter, e.g. in a database
+        created without the migrations, is not created here but the rows are
+        counted with count(), e.g. a cached count, or with count(*).
+        refresh() creates it, e.g. in manage.py import_register.
+        """
+        dialect = db.engine.dialect.name
+        if ROW_COUNT_MODE == 'estimate' and dialect == 'postgresql':
+            estimate = db.session.execute(
+                text('SELECT reltuples::bigint FROM pg_class '
+                     'WHERE oid = to_regclass(:table_name)'),
+                {'table_name': table_name}).scalar()
+            # reltuples is -1 for tables that were never analyzed
+            if estimate is not None and estimate >= 0:
+                return estimate
+
+        total = db.session.query(cls.total).filter(
+            cls.table_name == table_name).scalar()
+        if total is not None:
+            return total
+        if count is not None:
+            return count()
+        return db.session.query(func.count()).select_from(
+            db.metadata.tables[table_name]).scalar()
+
+
+"""
+Change Log
+"""
+
+
+class Change(db.Model):
+    """A row inserted, updated or deleted, in the order of the commits.
+
+    Changes made through the session are recorded by the flush hooks below,
+    and writes that bypass the session call record() themselves. On
+    PostgreSQL, writers hold a transaction-level advisory lock from their
+    first change until they commit, so that a change is never committed
+    after a change with a greater seq has been read from the feed.
+    """
+    __tablename__ = "changes"
+
+    seq = Column(BigInteger().with_variant(Integer, 'sqlite'),
+                 primary_key=True)
+    table_name = Column(String, nullable=False)
+    row_key = Column(String, nullable=False)
+    operation = Column(String, nullable=False)
+    changed_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def format(self):
+        return {
+            "seq": self.seq,
+            "table": self.table_name,
+            "key": self.row_key,
+            "operation": self.operation,
+            "changed_at": self.changed_at.isoformat()
+        }
+
+    @classmethod
+    def lock(cls, session=None):
+        session = session or db.session
+        if session.connection().dialect.name == 'postgresql':
+            session.execute(
+                text('SELECT pg_advisory_xact_lock(hashtext(:table_name))'),
+                {'table_name': cls.__tablename__})
+
+    @classmethod
+    def record(cls, table_name, keys, operation, session=None):
+        rows = [{'table_name': table_name, 'row_key': str(key),
+                 'operation': operation} for key in keys]
+        if rows:
+            (session or db.session).execute(cls.__table__.insert(), rows)
+
+    @classmethod
+    def record_matching(cls, table_name, key_column, criteria, operation,
+                        session=None):
+        """Record a change for every row matching the criteria, keyed by
+        key_column, in one INSERT ... SELECT. Returns the number of rows."""
+        rows = select(cast(key_column, String), literal(table_name),
+                      literal(operation), literal(datetime.utcnow())).where(
+            *criteria)
+        return (session or db.session).execute(
+            cls.__table__.insert().from_select(
+                ['row_key', 'table_name', 'operation', 'changed_at'], rows)
+        ).rowcount
+
+    @classmethod
+    def last_seq(cls):
+        return db.session.query(func.max(cls.seq)).scalar() or 0
+
+
+def row_key(instance):
+    keys = inspect(instance).mapper.primary_key_from_instance(instance)
+    return ','.join(str(key) for key in keys)
+
+
+@event.listens_for(db.session, 'before_flush')
+def lock_change_log(session, flush_context, instances):
+    # Take the lock before the flush writes any row, so that writers always
+    # lock the change log first and cannot deadlock on the rows
+    for instance in session.new | session.dirty | session.deleted:
+        if isinstance(instance, helperMethodsClass):
+            Change.lock(session)
+            return
+
+
+@event.listens_for(db.session, 'before_flush')
+def log_cascaded_deletes(session, flush_context, instances):
+    # The database deletes the specifications of deleted trademarks without
+    # them being loaded, so they are logged and counted before the flush
+    app_nos = [instance.app_no for instance in session.deleted
+               if isinstance(instance, Trademark)]
+    if not app_nos:
+        return
+    criteria = [Spec.tm_app_no.in_(app_nos)]
+    # Loaded specifications are deleted, logged and counted by the session
+    loaded = [instance.id for instance in session.deleted
+              if isinstance(instance, Spec)]
+    if loaded:
+        criteria.append(Spec.id.notin_(loaded))
+    specs = Change.record_matching(Spec.__tablename__, Spec.id, criteria,
+                                   'delete', session)
+    RowCount.adjust(Spec.__tablename__, -specs, session)
+
+
+@event.listens_for(db.session, 'before_flush')
+def touch_trademarks_of_removed_specs(session, flush_context, instances):
+    # The last modification of a trademark is the latest row version of it
+    # and of its specifications, which a specification deleted or moved to
+    # another trademark does not advance, so its trademark's is advanced
+    app_nos = set()
+    for instance in session.deleted:
+        if isinstance(instance, Spec):
+            app_nos.add(instance.tm_app_no)
+    for instance in session.dirty | session.deleted:
+        if isinstance(instance, Spec):
+            app_nos.update(inspect(instance).attrs.tm_app_no.history.deleted)
+    app_nos -= {instance.app_no for instance in session.deleted
+                if isinstance(instance, Trademark)}
+    app_nos.discard(None)
+    if app_nos:
+        session.execute(
+            Trademark.__table__.update()
+            .where(Trademark.app_no.in_(sorted(app_nos)))
+            .values(updated_at=datetime.utcnow()))
+
+
+@event.listens_for(db.session, 'after_flush')
+def log_flushed_rows(session, flush_context):
+    changes = []
+    for instance in session.new:
+        if isinstance(instance, helperMethodsClass):
+            changes.append((instance, 'insert'))
+    for instance in session.dirty:
+        if (isinstance(instance, helperMethodsClass) and
+                session.is_modified(instance, include_collections=False)):
+            changes.append((instance, 'update'))
+    for instance in session.deleted:
+        if isinstance(instance, helperMethodsClass):
+            changes.append((instance, 'delete'))
+
+    if changes:
+        session.execute(Change.__table__.insert(), [
+            {'table_name': instance.__tablename__,
+             'row_key': row_key(instance),
+             'operation': operation}
+            for instance, operation in changes])
+
+
+@event.listens_for(db.session, 'after_flush')
+def count_flushed_rows(session, flush_context):
+    deltas = {}
+    for instance in session.new:
+        if isinstance(instance, helperMethodsClass):
+            table_name = instance.__tablename__
+            deltas[table_name] = deltas.get(table_name, 0) + 1
+    for instance in session.deleted:
+        if isinstance(instance, helperMethodsClass):
+            table_name = instance.__tablename__
+            deltas[table_name] = deltas.get(table_name, 0) - 1
+
+    for table_name, delta in deltas.items():
+        RowCount.adjust(table_name, delta, session)
@@ -0,0 +1,161 @@
+import base64
+import json
+import os
+import threading
+import time
+
+from instrumentation import timing
+
+NUM_RESULTS_PER_PAGE = 100
+# Default and largest number of changes returned by the change feed
+CHANGES_PER_PAGE = 1000
+MAX_CHANGES_PER_PAGE = 10000
+
+# Seconds a computed total stays valid before it is counted again
+COUNT_CACHE_TTL = float(os.environ.get('COUNT_CACHE_TTL', 60))
+COUNT_CACHE_SIZE = int(os.environ.get('COUNT_CACHE_SIZE', 1024))
+
+_count_cache = {}
+_count_cache_lock = threading.Lock()
+
+
+def _count_key(query):
+    compiled = query.statement.compile()
+    # Values of IN clauses are bound as lists
+    params = ((name, tuple(value) if isinstance(value, list) else value)
+              for name, value in compiled.params.items())
+    return str(compiled), tuple(sorted(params, key=lambda item: item[0]))
+
+
+'''
+count_results function that
+(1) builds a cache key from the SQL and bound parameters of the query, and
+        the data version, e.g. the seq of the last change, so that totals
+        cached before a write handled by another worker are not served,
+(2) returns the cached total if it is younger than COUNT_CACHE_TTL,
+(3) otherwise runs a SELECT count(*) in the database and caches the result.
+Passing refresh=True forces a recount, e.g. right after a write.
+'''
+
+
+def count_results(query, refresh=False, version=None):
+    query = query.order_by(None)
+    key = (version,) + _count_key(query)
+    now = time.monotonic()
+    if not refresh:
+        with _count_cache_lock:
+            cached = _count_cache.get(key)
+        if cached is not None and now - cached[1] < COUNT_CACHE_TTL:
+            return cached[0]
+
+    total = query.count()
+    with _count_cache_lock:
+        _count_cache.pop(key, None)
+        while len(_count_cache) >= COUNT_CACHE_SIZE:
+            _count_cache.pop(next(iter(_count_cache)))
+        _count_cache[key] = (total, now)
+    return total
+
+
+def clear_count_cache():
+    with _count_cache_lock:
+        _count_cache.clear()
+
+
+'''
+Cursors
+Opaque cursors are the urlsafe base64 encoding of the last key of a page, so
+that clients can seek on the primary key instead of counting OFFSET rows.
+'''
+
+
+def encode_cursor(value):
+    raw = json.dumps({'after': value}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    return json.loads(base64.urlsafe_b64decode(padded.encode()))['after']
+
+
+'''
+get_cursor function that
+(1) reads an opaque "cursor" or a plain "after" key from the request
+        arguments,
+(2) converts it to the python type of the key column,
+(3) returns the key to seek after, or None when paging by page number.
+It raises ValueError if the cursor cannot be decoded.
+'''
+
+
+def get_cursor(request, key_column):
+    cursor = request.args.get('cursor')
+    after = request.args.get('after')
+    if cursor is None and after is None:
+        return None
+
+    try:
+        value = decode_cursor(cursor) if cursor is not None else after
+        return key_column.type.python_type(value)
+    except Exception:
+        raise ValueError('Invalid cursor.')
+
+
+'''
+page_query function that
+(1) seeks past the given key with WHERE key > after when a cursor is used,
+        or applies OFFSET from the page number otherwise,
+(2) limits the query to one page of rows,
+(3) returns the query, or None if the page number is out of range.
+'''
+
+
+def page_query(request, query, key_column, after=None,
+               num_results_per_page=NUM_RESULTS_PER_PAGE):
+    if after is not None:
+        query = query.filter(key_column > after)
+        query = query.order_by(None).order_by(key_column)
+    else:
+        page = request.args.get('page', 1, type=int)
+        if page < 1:
+            return None
+        query = query.offset((page - 1) * num_results_per_page)
+
+    return query.limit(num_results_per_page)
+
+
+'''
+paginate_query function that
+(1) loads only the rows of the current page from the database,
+(2) returns the formatted rows of the current page and the cursor of the
+        next page, which is None once the results are exhausted or when no
+        key column is given because the query is not ordered by its key.
+Rows are formatted with their format() method, or with format_rows, which
+takes the list of rows, e.g. for queries of column tuples. Loading and
+formatting are timed as the "load" and "format" phases of instrumented
+requests.
+'''
+
+
+def format_entities(results):
+    return [result.format() for result in results]
+
+
+def paginate_query(request, query, key_column, after=None,
+                   num_results_per_page=NUM_RESULTS_PER_PAGE,
+                   format_rows=format_entities):
+    query = page_query(request, query, key_column, after,
+                       num_results_per_page)
+    if query is None:
+        return [], None
+
+    with timing('load'):
+        results = query.all()
+    next_cursor = None
+    if key_column is not None and len(results) == num_results_per_page:
+        next_cursor = encode_cursor(getattr(results[-1], key_column.key))
+
+    with timing('format'):
+        rows = format_rows(results)
+    return rows, next_cursor
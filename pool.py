@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool, QueuePool
+
+# Connections kept open per worker process, and opened beyond them at most
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+# Seconds a request waits for a connection before failing
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+# Seconds after which a connection is replaced, -1 to keep them
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true')
+# "pgbouncer" leaves the pooling to an external pooler, e.g. PgBouncer in
+# transaction mode, and opens a connection per checkout instead
+DB_POOLER = os.environ.get('DB_POOLER', 'none')
+
+"""
+Pool Metrics
+"""
+
+
+class PoolMetrics:
+    """Counters of the checkouts of a pool, safe to update from threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.overflow_checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def record_checkout(self, wait, overflow):
+        with self._lock:
+            self.checkouts += 1
+            self.overflow_checkouts += overflow
+            self.wait_seconds_total += wait
+            self.wait_seconds_max = max(self.wait_seconds_max, wait)
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'overflow_checkouts': self.overflow_checkouts,
+                'timeouts': self.timeouts,
+                'wait_seconds_total': round(self.wait_seconds_total, 6),
+                'wait_seconds_max': round(self.wait_seconds_max, 6),
+            }
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long checkouts wait for a connection.
+
+    A checkout is counted as an overflow checkout when it leaves the pool
+    with more connections open than pool_size, and as a timeout when no
+    connection was returned within the pool timeout.
+    """
+
+    def __init__(self, *args, metrics=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = metrics or PoolMetrics()
+        self._checkout = threading.local()
+
+    def _do_get(self):
+        # QueuePool._do_get retries by calling itself, count the outer call
+        if getattr(self._checkout, 'active', False):
+            return super()._do_get()
+
+        started = time.perf_counter()
+        self._checkout.active = True
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.metrics.record_timeout()
+            raise
+        finally:
+            self._checkout.active = False
+        self.metrics.record_checkout(time.perf_counter() - started,
+                                     self.overflow() > 0)
+        return connection
+
+    def recreate(self):
+        pool = super().recreate()
+        # Keep counting across engine.dispose()
+        pool.metrics = self.metrics
+        return pool
+
+
+def pool_stats(engine):
+    """Return the state and the metrics of the pool of an engine."""
+    pool = engine.pool
+    stats = {'class': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(size=pool.size(), checked_out=pool.checkedout(),
+                     overflow=max(pool.overflow(), 0))
+    if isinstance(pool, InstrumentedQueuePool):
+        stats.update(pool.metrics.snapshot())
+    return stats
+
+
+"""
+Engine Options
+"""
+
+'''
+engine_options function that builds the SQLALCHEMY_ENGINE_OPTIONS of a
+database from the DB_POOL_* and DB_POOLER settings of the app config, e.g.
+passed as test_config, falling back to the environment variables.
+(1) with DB_POOLER=pgbouncer, connections are not pooled in the process,
+(2) otherwise, an InstrumentedQueuePool of the configured size is used,
+(3) SQLite keeps the pool chosen by Flask-SQLAlchemy.
+'''
+
+
+def engine_options(config, database_path):
+    if make_url(database_path).get_backend_name() == 'sqlite':
+        return {}
+
+    def setting(name, default):
+        return config.get(name, default)
+
+    if setting('DB_POOLER', DB_POOLER) == 'pgbouncer':
+        return {'poolclass': NullPool}
+
+    pre_ping = setting('DB_POOL_PRE_PING', DB_POOL_PRE_PING)
+    if isinstance(pre_ping, str):
+        pre_ping = pre_ping.lower() == 'true'
+    return {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': int(setting('DB_POOL_SIZE', DB_POOL_SIZE)),
+        'max_overflow': int(setting('DB_MAX_OVERFLOW', DB_MAX_OVERFLOW)),
+        'pool_timeout': float(setting('DB_POOL_TIMEOUT', DB_POOL_TIMEOUT)),
+        'pool_recycle': int(setting('DB_POOL_RECYCLE', DB_POOL_RECYCLE)),
+        'pool_pre_ping': pre_ping,
+    }
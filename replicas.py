@@ -0,0 +1,89 @@
+from functools import wraps
+import os
+import random
+
+from flask import g, has_app_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import orm
+
+# Comma-separated URLs of the read replicas of the database
+DATABASE_REPLICA_URLS = [url for url in os.environ.get(
+    'DATABASE_REPLICA_URLS', '').split(',') if url]
+# Seconds after a write during which the client reads from the primary
+READ_YOUR_WRITES_SECONDS = int(os.environ.get('READ_YOUR_WRITES_SECONDS', 10))
+
+PRIMARY_COOKIE = 'hktm_read_primary'
+PRIMARY_HEADER = 'X-Read-Primary'
+
+"""
+Replica Routing
+"""
+
+'''
+Replicas are registered as SQLAlchemy binds named replica_0, replica_1, ...
+which no model is bound to, so that create_all never creates tables on them.
+A session routes its statements to one of the replicas, picked once per
+session, while the request is marked read-only by the read_only decorator.
+Flushes, and every statement of other requests, go to the primary.
+'''
+
+
+def replica_binds(replica_paths):
+    return {'replica_{}'.format(index): path
+            for index, path in enumerate(replica_paths)}
+
+
+class RoutingSession(SignallingSession):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._replica_key = None
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        replica = self._replica_bind()
+        if replica is not None:
+            return replica
+        return super().get_bind(mapper, clause)
+
+    def _replica_bind(self):
+        if self._flushing or not has_app_context():
+            return None
+        if not g.get('read_replica'):
+            return None
+        keys = self.app.config.get('REPLICA_BINDS')
+        if not keys:
+            return None
+        if self._replica_key not in keys:
+            self._replica_key = random.choice(keys)
+        return get_state(self.app).db.get_engine(self.app,
+                                                 bind=self._replica_key)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def reads_primary(req):
+    """Tell whether a request asked to read its own writes."""
+    header = req.headers.get(PRIMARY_HEADER, '').lower()
+    return header in ('1', 'true') or PRIMARY_COOKIE in req.cookies
+
+
+def read_only(view):
+    """Route the statements of a read-only view to a replica.
+
+    Requests that read their own writes, see remember_write, stay on the
+    primary.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_replica = not reads_primary(request)
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def remember_write(response, seconds=READ_YOUR_WRITES_SECONDS):
+    """Have the client read from the primary for a while after a write."""
+    response.set_cookie(PRIMARY_COOKIE, '1', max_age=seconds, httponly=True)
+    return response
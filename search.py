@@ -0,0 +1,53 @@
+from sqlalchemy import case, func
+
+"""
+Search Backends
+"""
+
+'''
+A search backend turns a case-insensitive "contains" search on a column into
+(1) a filter clause that selects the matching rows and
+(2) a list of ORDER BY clauses that put the most relevant rows first.
+Backends are registered per SQLAlchemy dialect name, so that PostgreSQL uses
+the pg_trgm GIN indexes while SQLite in tests falls back to plain LIKE.
+'''
+
+
+class LikeSearchBackend:
+    """Portable substring search without index support."""
+
+    def match(self, column, search_term):
+        return column.ilike("%" + search_term + "%")
+
+    def ranking(self, column, search_term):
+        # Exact matches first, then the shortest values containing the term
+        exact = case([(func.lower(column) == search_term.lower(), 0)],
+                     else_=1)
+        return [exact, func.length(column)]
+
+
+class TrigramSearchBackend(LikeSearchBackend):
+    """PostgreSQL substring search backed by pg_trgm GIN indexes.
+
+    ILIKE '%term%' is answered from a gin_trgm_ops index on the column, see
+    the migration that adds ix_trademarks_name_trgm and
+    ix_specs_class_spec_trgm. Results are ranked by trigram similarity.
+    """
+
+    def ranking(self, column, search_term):
+        return [func.word_similarity(search_term, column).desc(),
+                func.similarity(column, search_term).desc()]
+
+
+_search_backends = {
+    'postgresql': TrigramSearchBackend(),
+    'sqlite': LikeSearchBackend(),
+}
+
+
+def register_search_backend(dialect_name, backend):
+    _search_backends[dialect_name] = backend
+
+
+def get_search_backend(dialect_name):
+    return _search_backends.get(dialect_name, LikeSearchBackend())
@@ -0,0 +1,127 @@
+from datetime import date
+import json
+import os
+
+from flask import current_app
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from models import Trademark, Spec
+
+# "auto" encodes with orjson when it is installed, with json otherwise
+JSON_BACKEND = os.environ.get('JSON_BACKEND', 'auto')
+
+"""
+Column Tuples
+"""
+
+'''
+The list and search endpoints select these columns as tuples instead of
+loading ORM entities. They hold the fields of Trademark.format(),
+Trademark.long() and Spec.format(), under the same names.
+'''
+
+TRADEMARK_COLUMNS = (Trademark.app_no, Trademark.name, Trademark.status,
+                     Trademark.owners)
+TRADEMARK_LONG_COLUMNS = TRADEMARK_COLUMNS + (
+    Trademark.applicant, Trademark.type, Trademark.trademark_id)
+SPEC_COLUMNS = (Spec.id, Spec.class_no, Spec.class_spec, Spec.tm_app_no)
+
+
+'''
+select_fields function that projects the columns named in the comma-separated
+fields argument of a request, e.g. "fields=app_no,name".
+(1) without fields, the default columns are selected,
+(2) the key column is always selected, first if it was not named, so that
+        the cursor of the next page can be read from the last row,
+(3) a name that is not one of the available columns raises ValueError.
+'''
+
+
+def select_fields(fields, available, default, key_column):
+    if fields is None:
+        return tuple(default)
+
+    by_name = {column.key: column for column in available}
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    unknown = [name for name in names if name not in by_name]
+    if unknown:
+        raise ValueError('Unknown fields: {}'.format(', '.join(unknown)))
+    if key_column.key not in names:
+        names.insert(0, key_column.key)
+    return tuple(by_name[name] for name in dict.fromkeys(names))
+
+
+def row_formatter(columns):
+    """Return a function that turns rows of the columns into dicts."""
+    keys = tuple(column.key for column in columns)
+
+    def format_rows(rows):
+        return [dict(zip(keys, row)) for row in rows]
+
+    return format_rows
+
+
+"""
+JSON Backends
+"""
+
+'''
+A JSON backend encodes a payload into compact UTF-8 JSON bytes, without
+indentation or sorted keys. Integer keys, as in Trademark.details(), and
+dates are accepted by every backend.
+'''
+
+
+def _encode_default(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError('{} is not JSON serializable'.format(type(value)))
+
+
+class StdlibJSONBackend:
+    name = 'json'
+
+    def dumps(self, payload):
+        return json.dumps(payload, separators=(',', ':'), ensure_ascii=False,
+                          default=_encode_default).encode()
+
+
+class OrjsonJSONBackend:
+    name = 'orjson'
+
+    def dumps(self, payload):
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+
+
+_json_backends = {'json': StdlibJSONBackend()}
+if orjson is not None:
+    _json_backends['orjson'] = OrjsonJSONBackend()
+
+
+def register_json_backend(name, backend):
+    _json_backends[name] = backend
+
+
+def available_json_backends():
+    return sorted(_json_backends)
+
+
+def get_json_backend(name=JSON_BACKEND):
+    if name == 'auto':
+        name = 'orjson' if 'orjson' in _json_backends else 'json'
+    if name == 'orjson' and orjson is None:
+        raise RuntimeError('JSON_BACKEND=orjson requires orjson.')
+    if name not in _json_backends:
+        raise ValueError('Unknown JSON backend: {}'.format(name))
+    return _json_backends[name]
+
+
+def json_response(payload, status=200):
+    """Encode the payload with the JSON backend of the app."""
+    backend = current_app.extensions.get('json_backend') or get_json_backend()
+    return current_app.response_class(backend.dumps(payload), status=status,
+                                      mimetype='application/json')
@@ -1,11 +1,118 @@
+import functools
+import gzip
 import os
+import re
+import tempfile
+import threading
+import time
 import unittest
+from datetime import datetime
+from unittest import mock
 import json
 
+from flask import Flask, Response, abort, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine
+from sqlalchemy import event, exc, text
+from sqlalchemy.orm import joinedload
+from sqlalchemy.pool import NullPool
 
 from app import create_app
-from models import setup_db, Trademark, Spec
+from bulk import import_records, read_records
+from conditional import conditional
+from export import export_lines, gzip_chunks, merge_children
+from filters import filter_class_no
+from cache import (
+    LocalSharedClient,
+    LRUCache,
+    ResponseCache,
+    SharedCache
+)
+import auth
+from auth import (
+    AuthError,
+    JWKSCache,
+    LocalIssuer,
+    VerifiedTokenCache,
+    requires_auth
+)
+from models import db, setup_db, Trademark, Spec, RowCount, Change
+from pagination import clear_count_cache
+from instrumentation import setup_instrumentation
+from pool import InstrumentedQueuePool, engine_options, pool_stats
+from replicas import PRIMARY_COOKIE, read_only, remember_write
+from search import LikeSearchBackend, get_search_backend
+from serializers import (
+    StdlibJSONBackend,
+    get_json_backend,
+    json_response,
+    row_formatter,
+    select_fields,
+    SPEC_COLUMNS
+)
+
+
+@functools.lru_cache(maxsize=None)
+def local_issuer():
+    """Return the local issuer of the tests, generating its key once."""
+    return LocalIssuer()
+
+
+def used_indexes(engine, query):
+    """Return the names of the indexes in the plan of a query, given by
+    EXPLAIN on PostgreSQL, with sequential scans disabled so that an index
+    that can serve the query is used whatever the size of the tables, and by
+    EXPLAIN QUERY PLAN on SQLite."""
+    statement = getattr(query, 'statement', query)
+    sql = str(statement.compile(dialect=engine.dialect,
+                                compile_kwargs={'literal_binds': True}))
+    with engine.connect() as connection:
+        if engine.dialect.name != 'postgresql':
+            return {name for row in connection.execute(
+                        text('EXPLAIN QUERY PLAN ' + sql))
+                    for name in re.findall(r'INDEX (\w+)', row[-1])}
+
+        with connection.begin() as transaction:
+            connection.execute(text('SET LOCAL enable_seqscan = off'))
+            plan = connection.execute(
+                text('EXPLAIN (FORMAT JSON) ' + sql)).scalar()
+            transaction.rollback()
+    names, nodes = set(), [plan[0]['Plan']]
+    while nodes:
+        node = nodes.pop()
+        if 'Index Name' in node:
+            names.add(node['Index Name'])
+        nodes.extend(node.get('Plans', []))
+    return names
+
+
+def hot_queries(app_no):
+    """Return the hot queries of the API and the index each one needs."""
+    trademark = Trademark.query.get(app_no)
+    return [
+        ('specs of a trademark, also loaded by its cascade delete',
+         Spec.query.with_parent(trademark, 'specs'), 'ix_specs_tm_app_no'),
+        ('trademark details',
+         Trademark.query.options(joinedload(Trademark.specs))
+         .filter(Trademark.app_no == app_no), 'ix_specs_tm_app_no'),
+        ('trademarks by status',
+         Trademark.query.filter(Trademark.status == 'Registered')
+         .order_by(Trademark.app_no).limit(10),
+         'ix_trademarks_status_app_no'),
+        ('trademarks by type',
+         Trademark.query.filter(Trademark.type == 'Word')
+         .order_by(Trademark.app_no).limit(10),
+         'ix_trademarks_type_app_no'),
+        ('specs by class',
+         Spec.query.filter(Spec.class_no == 9), 'ix_specs_class_no_tm_app_no'),
+        ('trademarks by class',
+         Trademark.query.filter(filter_class_no('9', None))
+         .order_by(Trademark.app_no).limit(10),
+         'ix_specs_class_no_tm_app_no'),
+        ('trademarks by name',
+         Trademark.query.order_by(Trademark.name, Trademark.app_no)
+         .limit(10), 'ix_trademarks_name_app_no'),
+    ]
 
 
 class HKTMTestCase(unittest.TestCase):
@@ -13,6 +120,16 @@ class HKTMTestCase(unittest.TestCase):
 
     def setUp(self):
         """"Define test variables and intialize app."""
+        # Tokens of the Editor and Admin roles, signed by a local issuer
+        issuer = local_issuer()
+        patch = mock.patch.object(auth, 'key_provider', issuer)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.editor = issuer.mint(['patch:trademark', 'patch:trademark_spec'],
+                                  subject='editor')
+        self.admin = issuer.mint(['post:trademark', 'post:trademark_spec',
+                                  'delete:trademark', 'delete:trademark_spec'],
+                                 subject='admin')
         self.app = create_app()
         self.client = self.app.test_client()
         self.database_name = "hktm_test"
@@ -41,6 +158,90 @@ class HKTMTestCase(unittest.TestCase):
         self.assertTrue(len(data['trademarks']))
         self.assertTrue(data['total_trademarks'])
 
+    def test_total_trademarks_matches_table_count(self):
+        res = self.client.get('/trademarks')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_trademarks'], Trademark.query.count())
+
+    def test_get_trademarks_second_page(self):
+        res = self.client.get('/trademarks?page=2')
+        data = json.loads(res.data)
+        first_page = json.loads(self.client.get('/trademarks').data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['trademarks']), 100)
+        self.assertEqual(data['total_trademarks'],
+                         first_page['total_trademarks'])
+        self.assertNotEqual(data['trademarks'][0]['app_no'],
+                            first_page['trademarks'][0]['app_no'])
+
+    def test_get_trademarks_with_cursor(self):
+        first_page = json.loads(self.client.get('/trademarks').data)
+        res = self.client.get('/trademarks?cursor={}'.format(
+            first_page['next_cursor']))
+        data = json.loads(res.data)
+        second_page = json.loads(self.client.get('/trademarks?page=2').data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['trademarks'], second_page['trademarks'])
+        self.assertTrue(data['next_cursor'])
+
+    def test_400_get_trademarks_with_invalid_cursor(self):
+        res = self.client.get('/trademarks?cursor=invalid')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Bad Request')
+
+    def test_get_trademarks_with_fields(self):
+        res = self.client.get('/trademarks?fields=name,type')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data['trademarks'][0]),
+                         {'app_no', 'name', 'type'})
+        self.assertTrue(data['next_cursor'])
+
+    def test_400_get_trademarks_with_unknown_fields(self):
+        res = self.client.get('/trademarks?fields=name,password')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Bad Request')
+
+    def test_health(self):
+        res = self.client.get('/health')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['database'], 'ok')
+        self.assertEqual(data['pool']['class'], 'InstrumentedQueuePool')
+        self.assertTrue(data['pool']['checkouts'])
+
+    def test_metrics_are_opt_in(self):
+        res = self.client.get('/trademarks')
+
+        self.assertNotIn('Server-Timing', res.headers)
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+    def test_metrics_with_instrumentation(self):
+        client = create_app({'INSTRUMENTATION': True}).test_client()
+        res = client.get('/trademarks')
+        metrics = client.get('/metrics').data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('sql;dur=', res.headers['Server-Timing'])
+        self.assertIn('hktm_requests_total{endpoint="get_trademarks",'
+                      'method="GET",status="200"} 1', metrics)
+        self.assertIn('hktm_db_pool_checkouts_total{database="primary"}',
+                      metrics)
+
     def test_404_requesting_beyond_valid_page(self):
         res = self.client.get('/trademarks?page=10000')
         data = json.loads(res.data)
@@ -60,6 +261,27 @@ class HKTMTestCase(unittest.TestCase):
         self.assertIsNotNone(data['name'])
         self.assertIsNotNone(data['class_numbers_and_specifications'])
 
+    def test_get_trademarks_with_app_nos(self):
+        res = self.client.get('/trademarks?app_no=19914141,19831491,0000000')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual([trademark['app_no']
+                          for trademark in data['trademarks']],
+                         ['19831491', '19914141'])
+        self.assertIsNotNone(
+            data['trademarks'][0]['class_numbers_and_specifications'])
+        self.assertEqual(data['not_found'], ['0000000'])
+
+    def test_404_get_trademarks_with_nonexistent_app_nos(self):
+        res = self.client.get('/trademarks?app_no=0000000')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Not Found')
+
     def test_get_trademark_with_nonexistent_app_no(self):
         res = self.client.get('/trademarks/0000000')
         data = json.loads(res.data)
@@ -68,6 +290,190 @@ class HKTMTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Not Found')
 
+    def test_304_get_trademark_with_matching_etag(self):
+        res = self.client.get('/trademarks/19914141')
+        not_modified = self.client.get('/trademarks/19914141', headers={
+            'If-None-Match': res.headers['ETag']})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.headers['Last-Modified'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.data, b'')
+        self.assertEqual(not_modified.headers['ETag'], res.headers['ETag'])
+
+    def test_get_trademark_etag_changes_after_update(self):
+        res = self.client.get('/trademarks/19831491')
+        self.client.patch('/trademarks/19831491',
+                          headers={'Authorization': 'Bearer {}'.format(
+                              self.editor
+                          )},
+                          json={'name': 'pear', 'status': 'Expired'})
+        modified = self.client.get('/trademarks/19831491', headers={
+            'If-None-Match': res.headers['ETag']})
+
+        self.assertEqual(modified.status_code, 200)
+        self.assertNotEqual(modified.headers['ETag'], res.headers['ETag'])
+
+    def test_filtered_total_is_counted_once(self):
+        clear_count_cache()
+        statements = []
+
+        def record(connection, cursor, statement, *args):
+            if 'count(*)' in statement and 'min(' not in statement:
+                statements.append(statement)
+
+        with self.app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', record)
+            self.addCleanup(event.remove, db.engine, 'before_cursor_execute',
+                            record)
+        res = self.client.get('/trademarks?status=Expired')
+        projected = self.client.get(
+            '/trademarks?status=Expired&fields=app_no,name&sort=name')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(projected.status_code, 200)
+        self.assertEqual(len(statements), 1)
+
+    def test_304_get_trademarks_with_matching_etag(self):
+        res = self.client.get('/trademarks')
+        not_modified = self.client.get('/trademarks', headers={
+            'If-None-Match': res.headers['ETag']})
+        second_page = self.client.get('/trademarks?page=2', headers={
+            'If-None-Match': res.headers['ETag']})
+
+        self.assertNotIn('Last-Modified', res.headers)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(second_page.status_code, 200)
+
+    def test_get_trademark_modified_since_a_spec_was_deleted(self):
+        self.add_trademarks_to_purge(['M0000001'])
+        self.addCleanup(self.remove_imported_trademark, 'M0000001')
+        with self.app.app_context():
+            deleted = Spec.query.filter(Spec.tm_app_no == 'M0000001').one()
+            deleted_id = deleted.id
+            time.sleep(1)
+            Spec(class_no=9, class_spec='newer',
+                 tm_app_no='M0000001').insert()
+        res = self.client.get('/trademarks/M0000001')
+        time.sleep(1)
+        self.client.delete('/trademark_specs/{}'.format(deleted_id),
+                           headers={'Authorization': 'Bearer {}'.format(
+                               self.admin
+                           )})
+        modified = self.client.get('/trademarks/M0000001', headers={
+            'If-Modified-Since': res.headers['Last-Modified']})
+        data = json.loads(modified.data)
+
+        self.assertEqual(modified.status_code, 200)
+        self.assertEqual(data['class_numbers_and_specifications'],
+                         {'9': 'newer'})
+
+    def test_get_changes_since_seq(self):
+        since = json.loads(self.client.get('/changes?limit=1').data)[
+            'last_seq']
+        self.client.patch('/trademarks/19831491',
+                          headers={'Authorization': 'Bearer {}'.format(
+                              self.editor
+                          )},
+                          json={'name': 'pear', 'status': 'Expired'})
+        res = self.client.get('/changes?since={}'.format(since))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['changes'][0]['table'], 'trademarks')
+        self.assertEqual(data['changes'][0]['key'], '19831491')
+        self.assertEqual(data['changes'][0]['operation'], 'update')
+        self.assertEqual(data['next_since'], data['changes'][-1]['seq'])
+        self.assertFalse(data['has_more'])
+
+    def test_400_get_changes_with_invalid_limit(self):
+        res = self.client.get('/changes?limit=0')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Bad Request')
+
+    def test_export_trademarks_with_specs(self):
+        res = self.client.get('/export/trademarks?include=specs')
+        lines = [json.loads(line) for line in res.data.splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(lines), Trademark.query.count())
+        apple = next(line for line in lines if line['app_no'] == '19914141')
+        self.assertEqual([spec['class_no'] for spec in apple['specs']], [16])
+
+    def test_export_specs_as_gzip_csv(self):
+        res = self.client.get('/export/specs?format=csv',
+                              headers={'Accept-Encoding': 'gzip'})
+        lines = gzip.decompress(res.data).decode().splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(lines[0], 'id,class_no,class_spec,tm_app_no')
+        self.assertEqual(len(lines) - 1, Spec.query.count())
+
+    def test_400_export_in_unknown_format(self):
+        res = self.client.get('/export/specs?format=xml')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Bad Request')
+
+    def test_filter_trademarks_by_status_and_type(self):
+        res = self.client.get('/trademarks?status=Registered&fields=type'
+                              '&type=Word')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(len(data['trademarks']))
+        self.assertEqual({(trademark['status'], trademark['type'])
+                          for trademark in data['trademarks']},
+                         {('Registered', 'Word')})
+        self.assertEqual(data['total_trademarks'], Trademark.query.filter(
+            Trademark.status == 'Registered',
+            Trademark.type == 'Word').count())
+
+    def test_filter_trademarks_by_class_and_owner(self):
+        res = self.client.get('/trademarks?class_no=9,25&owner=limited')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        for trademark in data['trademarks']:
+            self.assertIn('limited', trademark['owners'].lower())
+            self.assertTrue(Spec.query.filter(
+                Spec.tm_app_no == trademark['app_no'],
+                Spec.class_no.in_([9, 25])).count())
+
+    def test_sort_trademarks_by_name(self):
+        res = self.client.get('/trademarks?sort=name')
+        data = json.loads(res.data)
+        names = [trademark['name'] for trademark in data['trademarks']]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(names, sorted(names))
+        self.assertIsNone(data['next_cursor'])
+
+    def test_filters_change_the_etag(self):
+        etag = self.client.get('/trademarks').headers['ETag']
+        filtered = self.client.get('/trademarks?status=Registered')
+
+        self.assertEqual(filtered.status_code, 200)
+        self.assertNotEqual(filtered.headers['ETag'], etag)
+
+    def test_400_get_trademarks_with_invalid_filter_or_sort(self):
+        for query in ('class_no=nine', 'status=', 'sort=password',
+                      'sort=name&after=1'):
+            res = self.client.get('/trademarks?' + query)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400, query)
+            self.assertEqual(data['success'], False)
+            self.assertEqual(data['message'], 'Bad Request')
+
     def test_search_trademarks(self):
         res = self.client.post('/trademarks/search',
                                json={'searchTerm': 'apple'})
@@ -78,6 +484,40 @@ class HKTMTestCase(unittest.TestCase):
         self.assertTrue(len(data['trademarks']))
         self.assertTrue(data['total_trademarks'])
 
+    def test_search_trademarks_with_filters(self):
+        res = self.client.post('/trademarks/search?status=Registered'
+                               '&sort=-name',
+                               json={'searchTerm': 'apple'})
+        data = json.loads(res.data)
+        names = [trademark['name'] for trademark in data['trademarks']]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(len(data['trademarks']))
+        self.assertEqual({trademark['status']
+                          for trademark in data['trademarks']},
+                         {'Registered'})
+        self.assertEqual(names, sorted(names, reverse=True))
+        self.assertIsNone(data['next_cursor'])
+
+    def test_search_trademarks_by_relevance(self):
+        res = self.client.post('/trademarks/search?sort=relevance',
+                               json={'searchTerm': 'apple'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['trademarks'][0]['name'].lower(), 'apple')
+        self.assertIsNone(data['next_cursor'])
+
+    def test_400_search_trademarks_by_relevance_with_cursor(self):
+        res = self.client.post('/trademarks/search?sort=relevance&after=1',
+                               json={'searchTerm': 'apple'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Bad Request')
+
     def test_422_search_trademarks_without_search_term(self):
         res = self.client.post('/trademarks/search', json={'searchTerm': ''})
         data = json.loads(res.data)
@@ -96,6 +536,15 @@ class HKTMTestCase(unittest.TestCase):
         self.assertTrue(len(data['specs']))
         self.assertTrue(data['total_specs'])
 
+    def test_search_trademark_specs_after_id(self):
+        res = self.client.post('/trademark_specs/search?after=1000',
+                               json={'searchTerm': 'apple'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(all(spec['id'] > 1000 for spec in data['specs']))
+
     def test_422_search_trademark_specs_without_search_term(self):
         res = self.client.post('/trademark_specs/search',
                                json={'searchTerm': ''})
@@ -108,7 +557,7 @@ class HKTMTestCase(unittest.TestCase):
     def test_patch_trademark(self):
         res = self.client.patch('/trademarks/19831491',
                                 headers={'Authorization': 'Bearer {}'.format(
-                                    os.environ.get('EDITOR')
+                                    self.editor
                                 )},
                                 json={'name': 'apple', 'status': 'Expired'})
         data = json.loads(res.data)
@@ -120,7 +569,7 @@ class HKTMTestCase(unittest.TestCase):
     def test_404_patch_nonexistent_trademark(self):
         res = self.client.patch('/trademarks/0000000',
                                 headers={'Authorization': 'Bearer {}'.format(
-                                    os.environ.get('EDITOR')
+                                    self.editor
                                 )},
                                 json={'name': 'apple',
                                       'status': 'Registered'})
@@ -133,7 +582,7 @@ class HKTMTestCase(unittest.TestCase):
     def test_422_patch_trademark_without_info(self):
         res = self.client.patch('/trademarks/19831491',
                                 headers={'Authorization': 'Bearer {}'.format(
-                                    os.environ.get('EDITOR')
+                                    self.editor
                                 )},
                                 json={})
         data = json.loads(res.data)
@@ -145,7 +594,7 @@ class HKTMTestCase(unittest.TestCase):
     def test_patch_trademark_spec(self):
         res = self.client.patch('/trademark_specs/915609',
                                 headers={'Authorization': 'Bearer {}'.format(
-                                    os.environ.get('EDITOR')
+                                    self.editor
                                 )},
                                 json={'class_no': 30, 'class_spec': 'apple'})
         data = json.loads(res.data)
@@ -157,7 +606,7 @@ class HKTMTestCase(unittest.TestCase):
     def test_404_patch_nonexistent_trademark_spec(self):
         res = self.client.patch('/trademark_specs/99999999',
                                 headers={'Authorization': 'Bearer {}'.format(
-                                    os.environ.get('EDITOR')
+                                    self.editor
                                 )},
                                 json={'class_no': 30, 'class_spec': 'apple'})
         data = json.loads(res.data)
@@ -169,7 +618,7 @@ class HKTMTestCase(unittest.TestCase):
     def test_422_patch_trademark_spec_without_info(self):
         res = self.client.patch('/trademark_specs/915609',
                                 headers={'Authorization': 'Bearer {}'.format(
-                                    os.environ.get('EDITOR')
+                                    self.editor
                                 )},
                                 json={})
         data = json.loads(res.data)
@@ -181,7 +630,7 @@ class HKTMTestCase(unittest.TestCase):
     def test_post_trademark(self):
         res = self.client.post('/trademarks',
                                headers={'Authorization': 'Bearer {}'.format(
-                                   os.environ.get('ADMIN')
+                                   self.admin
                                )},
                                json={'app_no': '00000000',
                                      'name': 'apple',
@@ -193,13 +642,14 @@ class HKTMTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertEqual(data['added_trademark_app_no'], '00000000')
-        self.assertTrue(len(data['trademarks']))
+        self.assertEqual(data['trademark']['app_no'], '00000000')
+        self.assertNotIn('trademarks', data)
         self.assertTrue(data['total_trademarks'])
 
     def test_422_post_trademark_without_required_info(self):
         res = self.client.post('/trademarks',
                                headers={'Authorization': 'Bearer {}'.format(
-                                   os.environ.get('ADMIN')
+                                   self.admin
                                )},
                                json={'app_no': '00000000'})
         data = json.loads(res.data)
@@ -208,10 +658,64 @@ class HKTMTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Unprocessable')
 
+    def test_post_trademarks_batch(self):
+        res = self.client.post('/trademarks/batch',
+                               headers={'Authorization': 'Bearer {}'.format(
+                                   self.admin
+                               )},
+                               json={'trademarks': [
+                                   {'app_no': '00000001',
+                                    'name': 'apple',
+                                    'status': 'Registered',
+                                    'owners': '["Steve Jobs"]'},
+                                   {'app_no': '19914141',
+                                    'name': 'apple',
+                                    'status': 'Registered',
+                                    'owners': '["Apple Inc."]'},
+                                   {'app_no': '00000002'}]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['created'], 1)
+        self.assertEqual([result['status'] for result in data['results']],
+                         ['created', 'conflict', 'invalid'])
+
+    def test_422_post_empty_trademarks_batch(self):
+        res = self.client.post('/trademarks/batch',
+                               headers={'Authorization': 'Bearer {}'.format(
+                                   self.admin
+                               )},
+                               json={'trademarks': []})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Unprocessable')
+
+    def test_post_trademark_specs_batch(self):
+        res = self.client.post('/trademark_specs/batch',
+                               headers={'Authorization': 'Bearer {}'.format(
+                                   self.admin
+                               )},
+                               json={'specs': [
+                                   {'class_no': 30,
+                                    'class_spec': 'apple',
+                                    'tm_app_no': '19893299'},
+                                   {'class_no': 30,
+                                    'class_spec': 'apple',
+                                    'tm_app_no': '0000000'}]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['created'], 1)
+        self.assertEqual(data['results'][1]['error'], 'trademark not found')
+
     def test_post_trademark_spec(self):
         res = self.client.post('/trademark_specs',
                                headers={'Authorization': 'Bearer {}'.format(
-                                   os.environ.get('ADMIN')
+                                   self.admin
                                )},
                                json={'class_no': 30,
                                      'class_spec': 'apple',
@@ -221,13 +725,29 @@ class HKTMTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertEqual(data['added_spec_class_no'], 30)
+        self.assertEqual(data['spec']['tm_app_no'], '19893299')
+        self.assertNotIn('specs', data)
+        self.assertTrue(data['total_specs'])
+
+    def test_post_trademark_spec_with_full_response(self):
+        res = self.client.post('/trademark_specs?full=true',
+                               headers={'Authorization': 'Bearer {}'.format(
+                                   self.admin
+                               )},
+                               json={'class_no': 30,
+                                     'class_spec': 'apple',
+                                     'tm_app_no': '19893299'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
         self.assertTrue(len(data['specs']))
         self.assertTrue(data['total_specs'])
 
     def test_422_post_trademark_spec_without_required_info(self):
         res = self.client.post('/trademark_specs',
                                headers={'Authorization': 'Bearer {}'.format(
-                                   os.environ.get('ADMIN')
+                                   self.admin
                                )},
                                json={'class_no': 30})
         data = json.loads(res.data)
@@ -239,7 +759,7 @@ class HKTMTestCase(unittest.TestCase):
     def test_delete_trademark(self):
         res = self.client.delete('/trademarks/19801301',
                                  headers={'Authorization': 'Bearer {}'.format(
-                                     os.environ.get('ADMIN')
+                                     self.admin
                                  )})
         data = json.loads(res.data)
         trademark = Trademark.query.filter(
@@ -249,13 +769,142 @@ class HKTMTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(data['deleted_trademark_app_no'], '19801301')
         self.assertIsNone(trademark)
-        self.assertTrue(len(data['trademarks']))
-        self.assertTrue(data['total_trademarks'])
+        self.assertNotIn('trademarks', data)
+        self.assertEqual(data['total_trademarks'], Trademark.query.count())
+        self.assertEqual(RowCount.get('specs'), Spec.query.count())
+
+    def add_trademarks_to_purge(self, app_nos):
+        with self.app.app_context():
+            for app_no in app_nos:
+                db.session.add(Trademark(app_no=app_no, name='lapsed',
+                                         status='Lapsed (test)',
+                                         owners='["Lapsed Ltd."]'))
+                db.session.add(Spec(class_no=30, class_spec='lapsed',
+                                    tm_app_no=app_no))
+            db.session.commit()
+
+    def test_delete_trademarks_by_app_no(self):
+        self.add_trademarks_to_purge(['L0000001', 'L0000002'])
+        res = self.client.delete('/trademarks',
+                                 headers={'Authorization': 'Bearer {}'.format(
+                                     self.admin
+                                 )},
+                                 json={'app_nos': ['L0000001', 'L0000002',
+                                                   'L0000009']})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['deleted_trademarks'], 2)
+        self.assertEqual(data['deleted_specs'], 2)
+        self.assertEqual(data['not_found'], ['L0000009'])
+        self.assertEqual(Spec.query.filter(
+            Spec.tm_app_no.in_(['L0000001', 'L0000002'])).count(), 0)
+        self.assertEqual(data['total_trademarks'], Trademark.query.count())
+        self.assertEqual(data['total_specs'], Spec.query.count())
+
+    def test_delete_trademarks_by_filter(self):
+        self.add_trademarks_to_purge(['L0000003', 'L0000004'])
+        res = self.client.delete('/trademarks',
+                                 headers={'Authorization': 'Bearer {}'.format(
+                                     self.admin
+                                 )},
+                                 json={'filters': {'status': 'Lapsed (test)',
+                                                   'class_no': [30]}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted_trademarks'], 2)
+        self.assertEqual(data['deleted_specs'], 2)
+        self.assertEqual(Trademark.query.filter(
+            Trademark.status == 'Lapsed (test)').count(), 0)
+
+    def test_422_delete_trademarks_without_filters(self):
+        res = self.client.delete('/trademarks',
+                                 headers={'Authorization': 'Bearer {}'.format(
+                                     self.admin
+                                 )},
+                                 json={'filters': {}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Unprocessable')
+
+    def test_401_delete_trademarks_without_token(self):
+        res = self.client.delete('/trademarks',
+                                 json={'app_nos': ['L0000001']})
+
+        self.assertEqual(res.status_code, 401)
+
+    def import_export(self, table, name, content, **options):
+        """Load an export with COPY, as manage.py import_register does."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, name)
+        with open(path, 'w') as export:
+            export.write(content)
+        with self.app.app_context():
+            import_records(db.engine, table, read_records(path),
+                           report=lambda line: None,
+                           change_log=Change.__table__, **options)
+            RowCount.refresh(table.name)
+
+    def remove_imported_trademark(self, app_no):
+        with self.app.app_context():
+            Trademark.delete_matching(Trademark.app_no == app_no)
+            db.session.commit()
+
+    def test_copy_import_keeps_the_last_row_of_a_key(self):
+        self.addCleanup(self.remove_imported_trademark, 'I0000001')
+        self.import_export(Trademark.__table__, 'trademarks.csv', (
+            'app_no,name,status,owners\n'
+            'I0000001,IMPORTED,Registered,[]\n'
+            'I0000001,IMPORTED,Expired,[]\n'))
+
+        with self.app.app_context():
+            trademark = Trademark.query.get('I0000001')
+            logged = Change.query.filter(
+                Change.table_name == 'trademarks',
+                Change.row_key == 'I0000001').count()
+            self.assertEqual(trademark.status, 'Expired')
+            self.assertEqual(logged, 1)
+
+    def test_copy_import_replaces_the_specs_of_keyless_records(self):
+        self.addCleanup(self.remove_imported_trademark, 'I0000002')
+        self.import_export(Trademark.__table__, 'trademarks.csv', (
+            'app_no,name,status,owners\n'
+            'I0000002,IMPORTED,Registered,[]\n'))
+        with self.app.app_context():
+            seq = Change.last_seq()
+        for _ in range(2):
+            self.import_export(Spec.__table__, 'specs.csv', (
+                'class_no,class_spec,tm_app_no\n'
+                '9,computers,I0000002\n'
+                '16,stationery,I0000002\n'), replace_by='tm_app_no')
+
+        with self.app.app_context():
+            specs = Spec.query.filter(
+                Spec.tm_app_no == 'I0000002').order_by(Spec.id).all()
+            operations = [operation for operation, in db.session.query(
+                Change.operation).filter(
+                    Change.seq > seq,
+                    Change.table_name == 'specs').order_by(Change.seq)]
+            self.assertEqual([spec.class_no for spec in specs], [9, 16])
+            self.assertEqual(operations, ['upsert', 'upsert', 'delete',
+                                          'delete', 'upsert', 'upsert'])
+            self.assertEqual(RowCount.get('specs'), Spec.query.count())
+
+    def test_copy_import_rejects_keyless_records_without_replace_by(self):
+        with self.assertRaises(ValueError):
+            self.import_export(Spec.__table__, 'specs.csv', (
+                'class_no,class_spec,tm_app_no\n'
+                '9,computers,19914141\n'))
 
     def test_404_delete_nonexistent_trademark(self):
         res = self.client.delete('/trademarks/0000000',
                                  headers={'Authorization': 'Bearer {}'.format(
-                                     os.environ.get('ADMIN')
+                                     self.admin
                                  )})
         data = json.loads(res.data)
 
@@ -266,7 +915,7 @@ class HKTMTestCase(unittest.TestCase):
     def test_delete_trademark_spec(self):
         res = self.client.delete('/trademark_specs/120310',
                                  headers={'Authorization': 'Bearer {}'.format(
-                                     os.environ.get('ADMIN')
+                                     self.admin
                                  )})
         data = json.loads(res.data)
         spec = Spec.query.filter(Spec.id == 120310).one_or_none()
@@ -275,13 +924,13 @@ class HKTMTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(data['deleted_spec_id'], 120310)
         self.assertIsNone(spec)
-        self.assertTrue(len(data['specs']))
+        self.assertNotIn('specs', data)
         self.assertTrue(data['total_specs'])
 
     def test_404_delete_nonexistent_trademark_spec(self):
         res = self.client.delete('/trademark_specs/9999999',
                                  headers={'Authorization': 'Bearer {}'.format(
-                                     os.environ.get('ADMIN')
+                                     self.admin
                                  )})
         data = json.loads(res.data)
 
@@ -289,6 +938,969 @@ class HKTMTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Not Found')
 
+    def test_hot_queries_use_indexes(self):
+        with self.app.app_context():
+            app_no = Spec.query.first().tm_app_no
+            for description, query, index in hot_queries(app_no):
+                with self.subTest(description):
+                    self.assertIn(index, used_indexes(db.engine, query))
+
+
+class SearchBackendTestCase(unittest.TestCase):
+    """This class represents the search fallback test case on SQLite"""
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        self.table = Table('trademarks', MetaData(),
+                           Column('app_no', Integer, primary_key=True),
+                           Column('name', String))
+        self.table.create(self.engine)
+        self.engine.execute(self.table.insert(), [
+            {'app_no': 1, 'name': 'PINEAPPLE EXPRESS'},
+            {'app_no': 2, 'name': 'Apple'},
+            {'app_no': 3, 'name': 'BANANA'},
+            {'app_no': 4, 'name': 'APPLE PIE'},
+        ])
+
+    def test_sqlite_uses_like_backend(self):
+        self.assertIsInstance(get_search_backend('sqlite'), LikeSearchBackend)
+
+    def test_like_backend_ranks_closest_matches_first(self):
+        search = get_search_backend('sqlite')
+        name = self.table.c.name
+        query = (self.table.select()
+                 .where(search.match(name, 'apple'))
+                 .order_by(*search.ranking(name, 'apple')))
+        rows = self.engine.execute(query).fetchall()
+
+        self.assertEqual([row.app_no for row in rows], [2, 4, 1])
+
+
+class JWKSCacheTestCase(unittest.TestCase):
+    """This class represents the JWKS cache test case with a local file"""
+
+    def setUp(self):
+        self.jwks_file = tempfile.NamedTemporaryFile('w', suffix='.json',
+                                                     delete=False)
+        self.write_keys('key-1')
+
+    def tearDown(self):
+        os.remove(self.jwks_file.name)
+
+    def write_keys(self, *kids):
+        with open(self.jwks_file.name, 'w') as jwks_file:
+            json.dump({'keys': [{'kty': 'RSA', 'kid': kid, 'use': 'sig',
+                                 'n': 'n-' + kid, 'e': 'AQAB'}
+                                for kid in kids]}, jwks_file)
+
+    def test_keys_are_loaded_once_within_ttl(self):
+        cache = JWKSCache(path=self.jwks_file.name, ttl=600)
+        cache.get_key('key-1')
+        key = cache.get_key('key-1')
+        stats = cache.stats()
+
+        self.assertEqual(key['n'], 'n-key-1')
+        self.assertEqual(stats['refreshes'], 1)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_keys_are_reloaded_after_ttl(self):
+        cache = JWKSCache(path=self.jwks_file.name, ttl=0.01)
+        cache.get_key('key-1')
+        time.sleep(0.02)
+        cache.get_key('key-1')
+
+        self.assertEqual(cache.stats()['refreshes'], 2)
+
+    def test_unknown_kid_triggers_refresh(self):
+        cache = JWKSCache(path=self.jwks_file.name, ttl=600,
+                          min_refresh_interval=0)
+        cache.get_key('key-1')
+        self.write_keys('key-1', 'key-2')
+        key = cache.get_key('key-2')
+
+        self.assertEqual(key['kid'], 'key-2')
+        self.assertEqual(cache.stats()['refreshes'], 2)
+
+    def test_unknown_kid_refresh_is_rate_limited(self):
+        cache = JWKSCache(path=self.jwks_file.name, ttl=600,
+                          min_refresh_interval=600)
+        cache.get_key('key-1')
+        self.write_keys('key-1', 'key-2')
+
+        self.assertIsNone(cache.get_key('key-2'))
+        self.assertEqual(cache.stats()['refreshes'], 1)
+
+    def test_stale_keys_are_kept_when_refresh_fails(self):
+        cache = JWKSCache(path=self.jwks_file.name, ttl=0)
+        cache.get_key('key-1')
+        os.remove(self.jwks_file.name)
+        key = cache.get_key('key-1')
+        self.write_keys('key-1')
+
+        self.assertEqual(key['kid'], 'key-1')
+        self.assertEqual(cache.stats()['errors'], 1)
+
+    def test_503_without_any_keys(self):
+        cache = JWKSCache(path=self.jwks_file.name + '.missing')
+
+        with self.assertRaises(AuthError) as context:
+            cache.get_key('key-1')
+        self.assertEqual(context.exception.status_code, 503)
+
+
+class VerifiedTokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified token cache test case with a local
+    issuer"""
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(auth, 'key_provider', local_issuer()),
+            mock.patch.object(auth, 'token_cache',
+                              VerifiedTokenCache(maxsize=2)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.app = Flask(__name__)
+
+        @requires_auth('post:trademark')
+        def view(payload):
+            return payload
+        self.view = view
+
+    def mint(self, permissions, expires_in=3600):
+        return local_issuer().mint(permissions, expires_in=expires_in)
+
+    def call(self, token):
+        with self.app.test_request_context(
+                headers={'Authorization': 'Bearer {}'.format(token)}):
+            return self.view()
+
+    def test_verified_token_is_not_verified_again(self):
+        token = self.mint(['post:trademark'])
+        with mock.patch.object(auth, 'verify_decode_jwt',
+                               wraps=auth.verify_decode_jwt) as verify:
+            first = self.call(token)
+            second = self.call(token)
+
+        self.assertEqual(verify.call_count, 1)
+        self.assertEqual(first, second)
+        self.assertEqual(second['permissions'], ['post:trademark'])
+
+    def test_permissions_are_checked_against_cached_payload(self):
+        token = self.mint(['patch:trademark'])
+        with mock.patch.object(auth, 'verify_decode_jwt',
+                               wraps=auth.verify_decode_jwt) as verify:
+            for _ in range(2):
+                with self.assertRaises(AuthError) as context:
+                    self.call(token)
+                self.assertEqual(context.exception.status_code, 403)
+
+        self.assertEqual(verify.call_count, 1)
+
+    def test_expired_entry_is_not_served(self):
+        cache = VerifiedTokenCache()
+        cache.set('token', {'exp': time.time() - 1})
+
+        self.assertIsNone(cache.get('token'))
+        self.assertEqual(len(cache), 0)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = VerifiedTokenCache(maxsize=2)
+        exp = time.time() + 3600
+        cache.set('a', {'sub': 'a', 'exp': exp})
+        cache.set('b', {'sub': 'b', 'exp': exp})
+        cache.get('a')
+        cache.set('c', {'sub': 'c', 'exp': exp})
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a')['sub'], 'a')
+        self.assertEqual(cache.get('c')['sub'], 'c')
+
+
+class LocalIssuerTestCase(unittest.TestCase):
+    """This class represents the local issuer test case"""
+
+    def setUp(self):
+        self.issuer = local_issuer()
+        patch = mock.patch.object(auth, 'key_provider', self.issuer)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_minted_token_is_verified(self):
+        payload = auth.verify_decode_jwt(
+            self.issuer.mint(['post:trademark'], subject='benchmark'))
+
+        self.assertEqual(payload['sub'], 'benchmark')
+        self.assertEqual(payload['iss'], 'https://hktm.local/')
+        self.assertEqual(payload['permissions'], ['post:trademark'])
+
+    def test_expired_token_is_rejected(self):
+        with self.assertRaises(AuthError) as context:
+            auth.verify_decode_jwt(self.issuer.mint([], expires_in=-60))
+        self.assertEqual(context.exception.error['code'], 'token_expired')
+
+    def test_token_of_another_issuer_is_rejected(self):
+        other = LocalIssuer(self.issuer.private_key,
+                            issuer='https://elsewhere.test/')
+
+        with self.assertRaises(AuthError) as context:
+            auth.verify_decode_jwt(other.mint(['post:trademark']))
+        self.assertEqual(context.exception.error['code'], 'invalid_claims')
+
+    def test_key_is_saved_and_loaded(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'issuer.pem')
+        saved = LocalIssuer.from_file(path, key_size=1024)
+        loaded = LocalIssuer.from_file(path)
+
+        self.assertEqual(loaded.kid, saved.kid)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        self.assertEqual(loaded.get_key(saved.kid), saved.public_key)
+
+    def test_concurrent_processes_load_the_same_key(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'issuer.pem')
+        # Both generate a key before either publishes it
+        barrier = threading.Barrier(2)
+        link = os.link
+
+        def link_together(source, target):
+            barrier.wait(timeout=30)
+            link(source, target)
+
+        issuers = []
+        with mock.patch.object(auth.os, 'link', link_together):
+            threads = [threading.Thread(target=lambda: issuers.append(
+                LocalIssuer.from_file(path, key_size=1024)))
+                for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(issuers), 2)
+        self.assertEqual(issuers[0].kid, issuers[1].kid)
+        self.assertEqual(LocalIssuer.from_file(path).kid, issuers[0].kid)
+        self.assertEqual(os.listdir(directory.name), ['issuer.pem'])
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+
+    def test_auth0_provider_verifies_with_jwks(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'jwks.json')
+        with open(path, 'w') as jwks_file:
+            json.dump(self.issuer.jwks(), jwks_file)
+        tenant = LocalIssuer(self.issuer.private_key,
+                             issuer='https://hktm.test/',
+                             audience='hk-trademark')
+        patches = [
+            mock.patch.object(auth, 'AUTH0_DOMAIN', 'hktm.test'),
+            mock.patch.object(auth, 'ALGORITHMS', ['RS256']),
+            mock.patch.object(auth, 'API_AUDIENCE', 'hk-trademark'),
+            mock.patch.object(auth, 'jwks_cache', JWKSCache(path=path)),
+            mock.patch.object(auth, 'key_provider', auth.Auth0KeyProvider()),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        payload = auth.verify_decode_jwt(tenant.mint(['patch:trademark']))
+
+        self.assertEqual(payload['permissions'], ['patch:trademark'])
+
+    def test_unknown_auth_mode(self):
+        with self.assertRaises(ValueError):
+            auth.create_key_provider('saml')
+
+
+class BulkImportTestCase(unittest.TestCase):
+    """This class represents the bulk import test case on SQLite"""
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        Trademark.metadata.create_all(self.engine, tables=[
+            Trademark.__table__, Spec.__table__])
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w') as export:
+            export.write(content)
+        return path
+
+    def test_import_csv_and_jsonl_exports(self):
+        trademarks = self.write('trademarks.csv', (
+            'app_no,name,status,owners,applicant,type,trademark_id\n'
+            '19914141,APPLE,Registered,[\'Apple Inc.\'],,Ordinary,1_1\n'
+            '19831491,PEAR,Expired,[\'Pear Ltd.\'],,,\n'))
+        specs = self.write('specs.jsonl', (
+            '{"id": 1, "class_no": 16, "class_spec": "stationery", '
+            '"tm_app_no": "19914141"}\n'
+            '{"id": 2, "class_no": 31, "class_spec": "fresh pears", '
+            '"tm_app_no": "19831491"}\n'))
+        reports = []
+
+        imported = import_records(self.engine, Trademark.__table__,
+                                  read_records(trademarks), batch_size=1,
+                                  report=reports.append)
+        import_records(self.engine, Spec.__table__, read_records(specs),
+                       report=reports.append)
+        rows = self.engine.execute(Spec.__table__.select()).fetchall()
+        applicant = self.engine.execute(
+            'SELECT applicant FROM trademarks').scalar()
+
+        self.assertEqual(imported, 2)
+        self.assertEqual(len(reports), 3)
+        self.assertEqual([(row.id, row.class_no) for row in rows],
+                         [(1, 16), (2, 31)])
+        self.assertIsNone(applicant)
+
+    def test_import_updates_existing_rows(self):
+        trademarks = self.write('trademarks.jsonl', (
+            '{"app_no": "19914141", "name": "APPLE", "status": "Registered", '
+            '"owners": "[]"}\n'))
+        import_records(self.engine, Trademark.__table__,
+                       read_records(trademarks), report=lambda line: None)
+        updated = self.write('updated.jsonl', (
+            '{"app_no": "19914141", "name": "APPLE", "status": "Expired", '
+            '"owners": "[]"}\n'))
+        import_records(self.engine, Trademark.__table__,
+                       read_records(updated), report=lambda line: None)
+        rows = self.engine.execute(Trademark.__table__.select()).fetchall()
+
+        self.assertEqual([row.status for row in rows], ['Expired'])
+
+    def test_import_logs_changed_keys(self):
+        Change.metadata.create_all(self.engine, tables=[Change.__table__])
+        trademarks = self.write('trademarks.jsonl', (
+            '{"app_no": "19914141", "name": "APPLE", "status": "Registered", '
+            '"owners": "[]"}\n'))
+        specs = self.write('specs.jsonl', (
+            '{"class_no": 16, "class_spec": "stationery", '
+            '"tm_app_no": "19914141"}\n'))
+        for path, table in [(trademarks, Trademark.__table__),
+                            (specs, Spec.__table__)]:
+            import_records(self.engine, table, read_records(path),
+                           report=lambda line: None,
+                           change_log=Change.__table__, replace_by='tm_app_no')
+        rows = self.engine.execute(Change.__table__.select().order_by(
+            Change.seq)).fetchall()
+
+        self.assertEqual(
+            [(row.table_name, row.row_key, row.operation) for row in rows],
+            [('trademarks', '19914141', 'upsert'), ('specs', '1', 'upsert')])
+
+    def test_import_keeps_the_last_row_of_a_key(self):
+        trademarks = self.write('trademarks.jsonl', (
+            '{"app_no": "19914141", "name": "APPLE", "status": "Registered", '
+            '"owners": "[]"}\n'
+            '{"app_no": "19914141", "name": "APPLE", "status": "Expired", '
+            '"owners": "[]"}\n'))
+        import_records(self.engine, Trademark.__table__,
+                       read_records(trademarks), report=lambda line: None)
+        rows = self.engine.execute(Trademark.__table__.select()).fetchall()
+
+        self.assertEqual([row.status for row in rows], ['Expired'])
+
+    def test_import_replaces_the_specs_of_keyless_records(self):
+        Change.metadata.create_all(self.engine, tables=[Change.__table__])
+        trademarks = self.write('trademarks.jsonl', (
+            '{"app_no": "19914141", "name": "APPLE", "status": "Registered", '
+            '"owners": "[]"}\n'))
+        specs = self.write('specs.csv', (
+            'class_no,class_spec,tm_app_no\n'
+            '9,computers,19914141\n'
+            '16,stationery,19914141\n'))
+        import_records(self.engine, Trademark.__table__,
+                       read_records(trademarks), report=lambda line: None)
+        for _ in range(2):
+            import_records(self.engine, Spec.__table__, read_records(specs),
+                           batch_size=1, report=lambda line: None,
+                           change_log=Change.__table__, replace_by='tm_app_no')
+        rows = self.engine.execute(Spec.__table__.select().order_by(
+            Spec.id)).fetchall()
+        changes = self.engine.execute(Change.__table__.select().order_by(
+            Change.seq)).fetchall()
+
+        self.assertEqual([row.class_no for row in rows], [9, 16])
+        self.assertEqual(
+            [row.operation for row in changes],
+            ['upsert', 'upsert', 'delete', 'delete', 'upsert', 'upsert'])
+        self.assertEqual([row.row_key for row in changes[-2:]],
+                         [str(row.id) for row in rows])
+
+    def test_import_rejects_keyless_records_without_replace_by(self):
+        specs = self.write('specs.jsonl', (
+            '{"class_no": 16, "class_spec": "stationery", '
+            '"tm_app_no": "19914141"}\n'))
+
+        with self.assertRaises(ValueError):
+            import_records(self.engine, Spec.__table__, read_records(specs),
+                           report=lambda line: None)
+
+
+class ExportTestCase(unittest.TestCase):
+    """This class represents the streaming export test case"""
+
+    def test_children_are_merged_with_their_parent(self):
+        merged = merge_children(['a', 'b', 'c'], ['a1', 'a2', 'c1'],
+                                lambda parent: parent,
+                                lambda child: child[0])
+
+        self.assertEqual(list(merged),
+                         [('a', ['a1', 'a2']), ('b', []), ('c', ['c1'])])
+
+    def test_records_are_written_as_ndjson_and_csv(self):
+        records = [{'id': 1, 'name': 'APPLE'}, {'id': 2, 'name': 'PEAR'}]
+
+        self.assertEqual(
+            b''.join(export_lines(records, ['id', 'name'], 'ndjson')),
+            b'{"id":1,"name":"APPLE"}\n{"id":2,"name":"PEAR"}\n')
+        self.assertEqual(
+            b''.join(export_lines(records, ['id', 'name'], 'csv')),
+            b'id,name\r\n1,APPLE\r\n2,PEAR\r\n')
+
+    def test_chunks_are_compressed_into_one_gzip_stream(self):
+        chunks = [b'{"id":1}\n', b'{"id":2}\n']
+
+        self.assertEqual(gzip.decompress(b''.join(gzip_chunks(chunks))),
+                         b'{"id":1}\n{"id":2}\n')
+
+
+class PoolTestCase(unittest.TestCase):
+    """This class represents the connection pool test case"""
+
+    def test_pool_is_configured_from_config(self):
+        options = engine_options({'DB_POOL_SIZE': 20, 'DB_MAX_OVERFLOW': 0,
+                                  'DB_POOL_PRE_PING': 'false'},
+                                 'postgresql://localhost/hktm')
+
+        self.assertIs(options['poolclass'], InstrumentedQueuePool)
+        self.assertEqual(options['pool_size'], 20)
+        self.assertEqual(options['max_overflow'], 0)
+        self.assertFalse(options['pool_pre_ping'])
+
+    def test_pgbouncer_mode_does_not_pool(self):
+        options = engine_options({'DB_POOLER': 'pgbouncer'},
+                                 'postgresql://localhost/hktm')
+
+        self.assertEqual(options, {'poolclass': NullPool})
+
+    def test_sqlite_keeps_its_pool(self):
+        self.assertEqual(engine_options({}, 'sqlite://'), {})
+
+    def test_checkouts_overflow_and_timeouts_are_counted(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        engine = create_engine(
+            'sqlite:///{}'.format(os.path.join(directory.name, 'pool.db')),
+            poolclass=InstrumentedQueuePool, pool_size=1, max_overflow=1,
+            pool_timeout=0.1, connect_args={'check_same_thread': False})
+        connections = [engine.connect(), engine.connect()]
+        with self.assertRaises(exc.TimeoutError):
+            engine.connect()
+        for connection in connections:
+            connection.close()
+        stats = pool_stats(engine)
+
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['overflow_checkouts'], 1)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['checked_out'], 0)
+
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+    """This class represents the read replica routing test case, with a
+    primary and a replica SQLite database that hold different rows"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        primary, replica = ['sqlite:///{}'.format(
+            os.path.join(directory.name, name))
+            for name in ('primary.db', 'replica.db')]
+        # Sessions are scoped to the thread, drop those bound to other apps
+        db.session.remove()
+        self.addCleanup(db.session.remove)
+        self.app = Flask(__name__)
+        setup_db(self.app, primary, [replica])
+
+        with self.app.app_context():
+            db.session.add(Trademark(app_no='1', name='PRIMARY',
+                                     status='Registered', owners='[]'))
+            db.session.commit()
+            replica_engine = db.get_engine(self.app, bind='replica_0')
+            db.Model.metadata.create_all(replica_engine)
+            replica_engine.execute(Trademark.__table__.insert(), {
+                'app_no': '1', 'name': 'REPLICA', 'status': 'Registered',
+                'owners': '[]', 'updated_at': datetime.utcnow()})
+
+        def names():
+            return jsonify([trademark.name
+                            for trademark in Trademark.query])
+
+        @read_only
+        def add_and_list():
+            db.session.add(Trademark(app_no='2', name='WRITTEN',
+                                     status='Registered', owners='[]'))
+            db.session.commit()
+            return names()
+
+        def write():
+            return remember_write(jsonify({'success': True}))
+
+        self.app.add_url_rule('/replica', 'replica', read_only(names))
+        self.app.add_url_rule('/primary', 'primary', names)
+        self.app.add_url_rule('/add', 'add', add_and_list)
+        self.app.add_url_rule('/write', 'write', write, methods=['POST'])
+        self.client = self.app.test_client()
+
+    def test_read_only_views_read_from_replica(self):
+        self.assertEqual(json.loads(self.client.get('/replica').data),
+                         ['REPLICA'])
+        self.assertEqual(json.loads(self.client.get('/primary').data),
+                         ['PRIMARY'])
+
+    def test_writes_go_to_primary(self):
+        self.client.get('/add')
+
+        with self.app.app_context():
+            self.assertEqual(
+                [trademark.name for trademark in
+                 Trademark.query.order_by(Trademark.app_no)],
+                ['PRIMARY', 'WRITTEN'])
+
+    def test_reads_after_a_write_go_to_primary(self):
+        res = self.client.post('/write')
+
+        self.assertIn(PRIMARY_COOKIE, res.headers['Set-Cookie'])
+        self.assertEqual(json.loads(self.client.get('/replica').data),
+                         ['PRIMARY'])
+
+    def test_read_primary_header(self):
+        res = self.client.get('/replica', headers={'X-Read-Primary': '1'})
+
+        self.assertEqual(json.loads(res.data), ['PRIMARY'])
+
+
+class InstrumentationTestCase(unittest.TestCase):
+    """This class represents the request instrumentation test case"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        db.session.remove()
+        self.addCleanup(db.session.remove)
+        self.app = Flask(__name__)
+        self.app.config.update(INSTRUMENTATION='true', N_PLUS_ONE_THRESHOLD=3)
+        setup_db(self.app, 'sqlite:///{}'.format(
+            os.path.join(directory.name, 'hktm.db')))
+        self.app.extensions['json_backend'] = StdlibJSONBackend()
+        self.instrumentation = setup_instrumentation(self.app)
+
+        with self.app.app_context():
+            for app_no in '1234':
+                db.session.add(Trademark(app_no=app_no, name='APPLE',
+                                         status='Registered', owners='[]'))
+            db.session.commit()
+
+        def lazy_specs():
+            return json_response([len(trademark.specs)
+                                  for trademark in Trademark.query])
+
+        def swallowed():
+            try:
+                1 / 0
+            except Exception:
+                abort(422)
+
+        def invalid():
+            try:
+                int('nine')
+            except ValueError:
+                abort(400)
+
+        def streamed():
+            # Encoded while the response is sent, as the exports are
+            dumps = self.app.extensions['json_backend'].dumps
+
+            def generate():
+                for trademark in Trademark.query:
+                    yield dumps(trademark.format()) + b'\n'
+
+            return Response(stream_with_context(generate()))
+
+        self.app.add_url_rule('/lazy', 'lazy', lazy_specs)
+        self.app.add_url_rule('/streamed', 'streamed', streamed)
+        self.app.add_url_rule('/swallowed', 'swallowed', swallowed)
+        self.app.add_url_rule('/invalid', 'invalid', invalid)
+        self.client = self.app.test_client()
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(setup_instrumentation(Flask(__name__)))
+
+    def test_server_timing(self):
+        res = self.client.get('/lazy')
+        timing = res.headers['Server-Timing']
+
+        self.assertIn('sql;dur=', timing)
+        self.assertIn('desc="5 queries"', timing)
+        self.assertIn('serialize;dur=', timing)
+        self.assertIn('total;dur=', timing)
+
+    def test_streamed_responses_are_recorded_once_sent(self):
+        res = self.client.get('/streamed', buffered=True)
+        metrics = self.instrumentation.metrics
+
+        self.assertEqual(len(res.data.splitlines()), 4)
+        self.assertEqual(metrics.requests['streamed', 'GET', 200], 1)
+        self.assertEqual(metrics.queries['streamed'], 1)
+        self.assertGreater(metrics.serialize_seconds['streamed'], 0)
+
+    def test_n_plus_one_queries_are_reported(self):
+        with self.assertLogs('instrumentation', 'WARNING') as logs:
+            self.client.get('/lazy')
+
+        self.assertIn('Possible N+1 queries in lazy: 4 executions',
+                      logs.output[0])
+        self.assertIn('hktm_n_plus_one_total{endpoint="lazy"} 1',
+                      self.instrumentation.metrics.render())
+
+    def test_swallowed_errors_are_reported(self):
+        with self.assertLogs('instrumentation', 'WARNING') as logs:
+            res = self.client.get('/swallowed')
+
+        self.assertEqual(res.status_code, 422)
+        self.assertIn('ZeroDivisionError', logs.output[0])
+        self.assertIn('hktm_swallowed_errors_total{endpoint="swallowed",'
+                      'exception="ZeroDivisionError"} 1',
+                      self.instrumentation.metrics.render())
+
+    def test_validation_errors_are_not_reported(self):
+        with mock.patch('instrumentation.logger') as logger:
+            res = self.client.get('/invalid')
+
+        self.assertEqual(res.status_code, 400)
+        logger.warning.assert_not_called()
+        self.assertEqual(self.instrumentation.metrics.swallowed_errors, {})
+
+    def test_metrics_render_histogram_and_pools(self):
+        self.client.get('/lazy')
+        metrics = self.instrumentation.metrics.render({
+            'primary': {'class': 'InstrumentedQueuePool', 'size': 5,
+                        'checkouts': 7, 'wait_seconds_total': 0.5}})
+
+        self.assertIn('# TYPE hktm_request_duration_seconds histogram',
+                      metrics)
+        self.assertIn('hktm_request_duration_seconds_bucket{endpoint="lazy",'
+                      'le="+Inf"} 1', metrics)
+        self.assertIn('hktm_db_queries_total{endpoint="lazy"} 5', metrics)
+        self.assertIn('hktm_db_pool_size{database="primary"} 5', metrics)
+        self.assertIn('hktm_db_pool_checkouts_total{database="primary"} 7',
+                      metrics)
+        self.assertIn('hktm_db_pool_wait_seconds_total{database="primary"} '
+                      '0.5', metrics)
+
+
+class SerializersTestCase(unittest.TestCase):
+    """This class represents the column tuples and JSON backends test case"""
+
+    def test_rows_are_formatted_by_column_names(self):
+        format_rows = row_formatter((Spec.id, Spec.class_no))
+
+        self.assertEqual(format_rows([(1, 16), (2, 31)]),
+                         [{'id': 1, 'class_no': 16},
+                          {'id': 2, 'class_no': 31}])
+
+    def test_stdlib_backend_writes_compact_json(self):
+        payload = {'success': True, 'specs': {16: 'stationery'},
+                   'changed_at': datetime(2026, 10, 16, 15, 30)}
+
+        self.assertEqual(
+            StdlibJSONBackend().dumps(payload),
+            b'{"success":true,"specs":{"16":"stationery"},'
+            b'"changed_at":"2026-10-16T15:30:00"}')
+
+    def test_fields_are_projected_with_the_key_column(self):
+        self.assertEqual(select_fields(None, SPEC_COLUMNS, SPEC_COLUMNS,
+                                       Spec.id), SPEC_COLUMNS)
+        self.assertEqual(select_fields('class_no,class_no', SPEC_COLUMNS,
+                                       SPEC_COLUMNS, Spec.id),
+                         (Spec.id, Spec.class_no))
+        with self.assertRaises(ValueError):
+            select_fields('class_no,updated_at', SPEC_COLUMNS, SPEC_COLUMNS,
+                          Spec.id)
+
+    def test_unknown_backend_is_rejected(self):
+        with self.assertRaises(ValueError):
+            get_json_backend('simplejson')
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    """This class represents the response cache test case"""
+
+    def setUp(self):
+        self.calls = 0
+        self.app = Flask(__name__)
+        self.client = self.app.test_client()
+
+    def route(self, cache):
+        @self.app.route('/items', methods=['GET'])
+        @cache.cached
+        def get_items():
+            self.calls += 1
+            return {'calls': self.calls}, 200
+
+    def test_response_is_served_from_cache(self):
+        cache = ResponseCache(LRUCache(16))
+        self.route(cache)
+        first = json.loads(self.client.get('/items').data)
+        second = json.loads(self.client.get('/items').data)
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_query_string_is_part_of_the_key(self):
+        cache = ResponseCache(LRUCache(16))
+        self.route(cache)
+        self.client.get('/items?page=1')
+        self.client.get('/items?page=2')
+
+        self.assertEqual(self.calls, 2)
+
+    def test_version_bump_invalidates_responses(self):
+        cache = ResponseCache(SharedCache(LocalSharedClient()))
+        self.route(cache)
+        self.client.get('/items')
+        cache.bump_version()
+        data = json.loads(self.client.get('/items').data)
+
+        self.assertEqual(data['calls'], 2)
+        self.assertEqual(cache.stats()['version'], 1)
+
+    def test_version_read_from_the_database_invalidates_responses(self):
+        # The seq of the last change, advanced by a write of another worker
+        versions = [7]
+        cache = ResponseCache(LRUCache(16), get_version=lambda: versions[0])
+        self.route(cache)
+        self.client.get('/items')
+        self.client.get('/items')
+        versions[0] = 8
+        data = json.loads(self.client.get('/items').data)
+
+        self.assertEqual(data['calls'], 2)
+        self.assertEqual(cache.stats()['version'], 8)
+        self.assertEqual(cache.bump_version(), 8)
+
+    def test_validators_only_run_on_a_miss(self):
+        cache = ResponseCache(LRUCache(16))
+        validations = []
+
+        def validators():
+            validations.append(1)
+            return 'v1', datetime(2026, 1, 1)
+
+        @self.app.route('/validated', methods=['GET'])
+        @cache.cached
+        @conditional(validators)
+        def get_validated():
+            return {'ok': True}, 200
+
+        first = self.client.get('/validated')
+        second = self.client.get('/validated')
+        not_modified = self.client.get(
+            '/validated', headers={'If-None-Match': first.headers['ETag']})
+        modified = self.client.get(
+            '/validated', headers={'If-None-Match': '"v0"'})
+
+        self.assertEqual(len(validations), 1)
+        self.assertEqual(second.headers['ETag'], first.headers['ETag'])
+        self.assertEqual(second.headers['Last-Modified'],
+                         first.headers['Last-Modified'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.headers['ETag'], '"v1"')
+        self.assertEqual(modified.status_code, 200)
+        self.assertEqual(json.loads(modified.data), {'ok': True})
+
+    def test_version_is_never_evicted(self):
+        backend = LRUCache(1)
+        backend.incr('data_version')
+        backend.set('a', b'a')
+        backend.set('b', b'b')
+
+        self.assertEqual(backend.get('data_version'), 1)
+        self.assertIsNone(backend.get('a'))
+
+
+class IndexUsageTestCase(unittest.TestCase):
+    """This class represents the query index test case"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        db.session.remove()
+        self.addCleanup(db.session.remove)
+        self.app = Flask(__name__)
+        setup_db(self.app, 'sqlite:///{}'.format(
+            os.path.join(directory.name, 'hktm.db')))
+        context = self.app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        db.session.add(Trademark(app_no='1', name='APPLE', status='Registered',
+                                 owners='[]', type='Word'))
+        db.session.add(Spec(class_no=9, class_spec='software', tm_app_no='1'))
+        db.session.commit()
+
+    def test_hot_queries_use_indexes(self):
+        for description, query, index in hot_queries('1'):
+            with self.subTest(description):
+                self.assertIn(index, used_indexes(db.engine, query))
+
+    def test_plan_without_index(self):
+        query = Trademark.query.filter(Trademark.applicant == 'Apple Inc.')
+
+        self.assertEqual(used_indexes(db.engine, query), set())
+
+
+class SetBasedWritesTestCase(unittest.TestCase):
+    """This class represents the set-based writes test case on SQLite"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        db.session.remove()
+        self.addCleanup(db.session.remove)
+        self.app = Flask(__name__)
+        setup_db(self.app, 'sqlite:///{}'.format(
+            os.path.join(directory.name, 'hktm.db')))
+        context = self.app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        for app_no, status in (('1', 'Registered'), ('2', 'Expired'),
+                               ('3', 'Expired')):
+            db.session.add(Trademark(app_no=app_no, name='APPLE',
+                                     status=status, owners='[]'))
+            for class_no in (9, 30):
+                db.session.add(Spec(class_no=class_no, class_spec='apples',
+                                    tm_app_no=app_no))
+        db.session.commit()
+        for table_name in ('trademarks', 'specs'):
+            RowCount.refresh(table_name)
+        self.seq = Change.last_seq()
+
+    def deleted(self, table_name):
+        return Change.query.filter(
+            Change.seq > self.seq, Change.table_name == table_name,
+            Change.operation == 'delete').count()
+
+    def record_statements(self):
+        statements = []
+
+        def record(connection, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute',
+                        record)
+        return statements
+
+    def test_insert_many_returns_ids_in_one_statement(self):
+        statements = self.record_statements()
+        spec_ids = Spec.insert_many([
+            {'class_no': class_no, 'class_spec': 'pears', 'tm_app_no': '1'}
+            for class_no in (3, 5, 29)])
+        db.session.commit()
+
+        self.assertEqual(len([statement for statement in statements
+                              if statement.startswith('INSERT')]), 1)
+        self.assertEqual(spec_ids, [spec_id for spec_id, in db.session.query(
+            Spec.id).filter(Spec.class_spec == 'pears').order_by(Spec.id)])
+
+    def test_specs_are_deleted_by_the_database(self):
+        statements = self.record_statements()
+        Trademark.query.get('1').delete()
+
+        self.assertEqual(Spec.query.filter(Spec.tm_app_no == '1').count(), 0)
+        self.assertFalse([statement for statement in statements
+                          if statement.startswith('DELETE FROM specs')])
+        self.assertEqual(self.deleted('specs'), 2)
+        self.assertEqual(RowCount.get('specs'), Spec.query.count())
+
+    def test_removed_specs_advance_their_trademark(self):
+        updated_at = datetime(2020, 1, 1)
+        Trademark.query.update({Trademark.updated_at: updated_at})
+        db.session.commit()
+        Spec.query.filter(Spec.tm_app_no == '1').first().delete()
+        moved = Spec.query.filter(Spec.tm_app_no == '2').first()
+        moved.tm_app_no = '3'
+        moved.update()
+        versions = dict(db.session.query(Trademark.app_no,
+                                         Trademark.updated_at))
+
+        self.assertGreater(versions['1'], updated_at)
+        self.assertGreater(versions['2'], updated_at)
+        self.assertEqual(versions['3'], updated_at)
+
+    def test_loaded_specs_are_counted_once(self):
+        trademark = Trademark.query.get('1')
+        self.assertEqual(len(trademark.specs), 2)
+        trademark.delete()
+
+        self.assertEqual(self.deleted('specs'), 2)
+        self.assertEqual(RowCount.get('specs'), Spec.query.count())
+
+    def test_delete_matching(self):
+        deleted = Trademark.delete_matching(Trademark.status == 'Expired')
+        db.session.commit()
+
+        self.assertEqual(deleted, (2, 4))
+        self.assertEqual(Trademark.query.count(), 1)
+        self.assertEqual(Spec.query.count(), 2)
+        self.assertEqual(self.deleted('trademarks'), 2)
+        self.assertEqual(self.deleted('specs'), 4)
+        self.assertEqual(RowCount.get('trademarks'), 1)
+        self.assertEqual(RowCount.get('specs'), 2)
+
+    def test_refresh_counts_under_a_lock_of_the_counter(self):
+        statements = self.record_statements()
+        RowCount.adjust('specs', 10)
+        db.session.commit()
+
+        self.assertEqual(RowCount.refresh('specs'), 6)
+        locked = [statement for statement in statements
+                  if 'FROM row_counts' in statement]
+        count = [statement for statement in statements
+                 if 'count(*)' in statement]
+        self.assertLess(statements.index(locked[-1]),
+                        statements.index(count[-1]))
+        Trademark.query.get('1').delete()
+        self.assertEqual(RowCount.get('specs'), 4)
+
+    def test_missing_counter_is_counted_without_writes(self):
+        RowCount.query.filter(RowCount.table_name == 'specs').delete()
+        db.session.commit()
+        statements = self.record_statements()
+
+        self.assertEqual(RowCount.get('specs'), 6)
+        self.assertEqual(RowCount.get('specs', lambda: 5), 5)
+        self.assertIsNone(RowCount.query.get('specs'))
+        self.assertEqual([statement for statement in statements
+                          if not statement.startswith('SELECT')], [])
+
+    def test_refresh_creates_a_missing_counter(self):
+        RowCount.query.filter(RowCount.table_name == 'specs').delete()
+        db.session.commit()
+
+        self.assertEqual(RowCount.refresh('specs'), 6)
+        self.assertEqual(RowCount.query.get('specs').total, 6)
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":